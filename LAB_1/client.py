@@ -2,10 +2,25 @@ import socket
 import os
 import sys
 import time
+import json
 import select
+import queue
+import argparse
+import threading
+from urllib.parse import quote, unquote
+from stream import reader_for, send_file_chunk, preallocate, write_at, PART_SUFFIX
+from digests import block_digests, mismatched_ranges, DIGEST_SIZE
+from compression import split_option, option, encode_block, decode_payload, FRAME, BLOCK_SIZE as COMPRESS_BLOCK
+from jobs import TransferManager, current_job
 
 HOST = '127.0.0.1'
 PORT = 9090
+TRANSFER_BLOCK = 262144
+MIN_SEGMENT = 1024 * 1024
+SEGMENT_RETRIES = 5
+MAX_IN_FLIGHT = 1024
+PROGRESS_INTERVAL = 0.2
+MAX_JOBS = 2
 
 def setup_keepalive(sock):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
@@ -68,18 +83,14 @@ def get_input_and_check_socket(sock):
             if sys.stdin in r:
                 return sys.stdin.readline().strip()
 
+def report_error(message):
+    print(message)
+    job = current_job()
+    if job is not None:
+        job.error = message.strip()
+
 def read_line(conn):
-    line = b''
-    while True:
-        r, _, _ = select.select([conn], [], [], 0.5)
-        if not r:
-            continue
-        char = conn.recv(1)
-        if not char:
-            return None
-        line += char
-        if char == b'\n':
-            return line.decode('utf-8', errors='ignore').strip()
+    return reader_for(conn).read_line()
 
 def connect_to_server_manual():
     while True:
@@ -107,43 +118,455 @@ def attempt_auto_reconnect():
             time.sleep(2)
     return None
 
-def calc_bitrate(bytes_transferred, duration):
+def calc_bitrate(bytes_transferred, duration, kernel_bytes=None, wire_bytes=None):
     if duration <= 0:
         duration = 0.001
     mbps = ((bytes_transferred * 8) / duration) / 1024 / 1024
     print(f"Transfer finished. Bitrate: {mbps:.2f} Mbps")
+    if wire_bytes is not None and wire_bytes != bytes_transferred:
+        wire_mbps = ((wire_bytes * 8) / duration) / 1024 / 1024
+        ratio = bytes_transferred / wire_bytes if wire_bytes else 0
+        print(f"On the wire: {wire_bytes}/{bytes_transferred} bytes, {wire_mbps:.2f} Mbps (x{ratio:.2f})")
+    if kernel_bytes is not None:
+        print(f"Sent via sendfile: {kernel_bytes}/{bytes_transferred} bytes")
 
-def print_progress(current, total, last_printed_percent):
+def print_progress(current, total, last_report, wire=None):
+    job = current_job()
+    if job is not None:
+        job.update(current, total, wire)
+        return last_report
+    now = time.monotonic()
     if total > 0:
-        percent = (current / total) * 100
-        if percent - last_printed_percent >= 0.1 or current == total:
+        if now - last_report >= PROGRESS_INTERVAL or current >= total:
+            percent = (current / total) * 100
             mb_curr = current / (1024 * 1024)
             mb_total = total / (1024 * 1024)
-            sys.stdout.write(f"\rProgress: {percent:.1f}%  ({mb_curr:.0f}/{mb_total:.0f} MB)   ")
+            line = f"\rProgress: {percent:.1f}%  ({mb_curr:.0f}/{mb_total:.0f} MB)"
+            if wire is not None:
+                line += f"  wire {wire / (1024 * 1024):.0f} MB"
+            sys.stdout.write(line + "   ")
             sys.stdout.flush()
-            return percent
-    return last_printed_percent
+            return now
+    return last_report
+
+def parse_response(resp_str):
+    resp, accepted = split_option(resp_str.split())
+    return resp, (accepted[0] if accepted else None)
+
+def read_exact(reader, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = reader.read(n - len(buf))
+        if not chunk:
+            raise ConnectionResetError()
+        buf += chunk
+    return bytes(buf)
+
+def recv_data(s, count, codec=None):
+    reader = reader_for(s)
+    while count > 0:
+        if codec is None:
+            chunk = reader.read(min(TRANSFER_BLOCK, count))
+            if not chunk:
+                raise ConnectionResetError()
+            wire = len(chunk)
+        else:
+            kind, wire, logical = FRAME.unpack(read_exact(reader, FRAME.size))
+            if wire > 2 * COMPRESS_BLOCK or logical > count:
+                raise ValueError("bad frame")
+            chunk = decode_payload(codec, kind, read_exact(reader, wire), logical)
+            wire += FRAME.size
+        count -= len(chunk)
+        yield chunk, wire
+
+def send_data(s, f, start, end, codec=None):
+    # TRANSFER_BLOCK per sendfile, not the server's SENDFILE_CHUNK: callers update progress
+    # and check for cancellation between slices
+    pos = start
+    kernel = True
+    while pos < end:
+        if codec is None:
+            sent, kernel = send_file_chunk(s, f, pos, min(TRANSFER_BLOCK, end - pos), kernel)
+            if not sent:
+                return
+            pos += sent
+            yield sent, sent, kernel
+        else:
+            f.seek(pos)
+            block = f.read(min(COMPRESS_BLOCK, end - pos))
+            if not block:
+                return
+            frame = encode_block(codec, block)
+            s.sendall(frame)
+            pos += len(block)
+            yield len(block), len(frame), False
+
+def open_data_connection():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    setup_keepalive(s)
+    s.connect((HOST, PORT))
+    return s
+
+def segments_path(filename):
+    return filename + '.segments'
+
+def load_segments(filename, filesize):
+    try:
+        with open(segments_path(filename)) as f:
+            state = json.load(f)
+        if state['size'] == filesize and os.path.getsize(filename) == filesize:
+            return state['segments']
+    except Exception:
+        pass
+    return None
+
+def save_segments(filename, filesize, segments):
+    tmp = segments_path(filename) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'size': filesize, 'segments': segments}, f)
+    os.replace(tmp, segments_path(filename))
+
+def verified_prefix(s, filename, filesize):
+    """Bytes at the start of the local file whose blocks match the server's digests."""
+    if not os.path.exists(filename) or not os.path.getsize(filename):
+        return 0
+    remote = fetch_remote_digests(s, filename)
+    if remote is None:
+        return 0
+    _, block_size, remote_digests = remote
+    have = 0
+    for local, digest in zip(block_digests(filename, block_size), remote_digests):
+        if local != digest:
+            break
+        have += block_size
+    return min(have, filesize)
+
+def plan_segments(filesize, connections, have=0):
+    segments = [{'start': 0, 'end': have, 'done': have}] if have else []
+    left = filesize - have
+    count = max(1, min(connections, left // MIN_SEGMENT))
+    step = -(-left // count)
+    for start in range(have, filesize, step):
+        segments.append({'start': start, 'end': min(start + step, filesize), 'done': 0})
+    return segments
+
+def fetch_segment(filename, seg, lock, stop, offer, counters):
+    fd = os.open(filename, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        retries = 0
+        while seg['start'] + seg['done'] < seg['end'] and not stop.is_set():
+            pos = seg['start'] + seg['done']
+            try:
+                s = open_data_connection()
+                try:
+                    s.sendall(f"DOWNLOAD {filename} {pos} {seg['end']}{option(offer)}\n".encode())
+                    resp, codec = parse_response(read_line(s) or '')
+                    if not resp or resp[0] != 'OK':
+                        raise ConnectionResetError()
+                    for chunk, wire in recv_data(s, seg['end'] - pos, codec):
+                        write_at(fd, chunk, pos)
+                        pos += len(chunk)
+                        with lock:
+                            seg['done'] = pos - seg['start']
+                            counters['wire'] += wire
+                        retries = 0
+                        if stop.is_set():
+                            break
+                finally:
+                    s.close()
+            except Exception:
+                retries += 1
+                if retries > SEGMENT_RETRIES:
+                    return
+                time.sleep(2)
+    finally:
+        os.close(fd)
+
+def do_parallel_download(s, filename, connections, offer=None):
+    s.sendall(f"DOWNLOAD {filename} 0 0\n".encode())
+    resp_str = read_line(s)
+    if not resp_str:
+        raise ConnectionResetError()
+
+    resp = resp_str.split()
+    if not resp or resp[0] == "ERROR":
+        err_msg = ' '.join(resp[1:]) if len(resp) > 1 else 'File not found'
+        report_error(f"Server error: {err_msg}")
+        return s
+
+    filesize = int(resp[1])
+    segments = load_segments(filename, filesize)
+    if segments is None:
+        # Without a segment file the local copy may be anything: keep only the blocks the server vouches for
+        have = verified_prefix(s, filename, filesize)
+        if have >= filesize:
+            print("File already fully downloaded.")
+            return s
+        if os.path.exists(filename) and os.path.getsize(filename) > have:
+            print(f"Local copy matches the server up to byte {have}, fetching the rest again...")
+        segments = plan_segments(filesize, connections, have)
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            preallocate(fd, filesize)
+        finally:
+            os.close(fd)
+    else:
+        print(f"Resuming segmented download of {filename}...")
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    counters = {'wire': 0}
+    save_segments(filename, filesize, segments)
+    start_done = sum(seg['done'] for seg in segments)
+    workers = [threading.Thread(target=fetch_segment, args=(filename, seg, lock, stop, offer, counters), daemon=True)
+               for seg in segments if seg['done'] < seg['end'] - seg['start']]
+    print(f"Downloading {filename} over {len(workers)} connections...")
+
+    start_time = time.time()
+    last_report = -1.0
+    try:
+        for w in workers:
+            w.start()
+        alive = workers
+        while alive:
+            alive[0].join(0.2)
+            alive = [w for w in alive if w.is_alive()]
+            with lock:
+                done = sum(seg['done'] for seg in segments)
+                save_segments(filename, filesize, segments)
+            last_report = print_progress(done, filesize, last_report, counters['wire'] if offer else None)
+    except KeyboardInterrupt:
+        stop.set()
+        for w in workers:
+            w.join()
+        raise
+    finally:
+        with lock:
+            save_segments(filename, filesize, segments)
+
+    done = sum(seg['done'] for seg in segments)
+    print_progress(done, filesize, last_report)
+    print()
+    if done < filesize:
+        report_error(f"Download incomplete ({done}/{filesize} bytes). Run DOWNLOAD again to resume.")
+        return s
+
+    os.remove(segments_path(filename))
+    calc_bitrate(done - start_done, time.time() - start_time, wire_bytes=counters['wire'])
+    return s
+
+def fetch_remote_digests(s, filename):
+    s.sendall(f"HASHES {filename}\n".encode())
+    resp_str = read_line(s)
+    if not resp_str:
+        raise ConnectionResetError()
+
+    resp = resp_str.split()
+    if resp[0] != 'OK':
+        return None
+
+    size, block_size, count = int(resp[1]), int(resp[2]), int(resp[3])
+    raw = read_exact(reader_for(s), count * DIGEST_SIZE)
+    digests = [bytes(raw[i:i + DIGEST_SIZE]) for i in range(0, len(raw), DIGEST_SIZE)]
+    return size, block_size, digests
+
+def do_delta_download(s, filename, remote, offer=None):
+    filesize, block_size, remote_digests = remote
+    local_size = os.path.getsize(filename)
+    ranges = mismatched_ranges(block_digests(filename, block_size), remote_digests, block_size, filesize)
+    if not ranges and local_size == filesize:
+        print("File already fully downloaded.")
+        return s
+
+    total = sum(end - start for start, end in ranges)
+    print(f"Local copy verified: refetching {total} of {filesize} bytes in {len(ranges)} ranges...")
+
+    start_time = time.time()
+    transferred = 0
+    wire_bytes = 0
+    last_report = -1.0
+    with open(filename, 'r+b') as f:
+        if local_size != filesize:
+            f.truncate(filesize)
+        s.sendall(''.join(f"DOWNLOAD {filename} {start} {end}{option(offer)}\n" for start, end in ranges).encode())
+        for start, end in ranges:
+            resp, codec = parse_response(read_line(s) or '')
+            if not resp or resp[0] != 'OK':
+                raise ConnectionResetError()
+            f.seek(start)
+            for chunk, wire in recv_data(s, end - start, codec):
+                f.write(chunk)
+                transferred += len(chunk)
+                wire_bytes += wire
+                last_report = print_progress(transferred, total, last_report, wire_bytes if offer else None)
+
+    print()
+    calc_bitrate(transferred, time.time() - start_time, wire_bytes=wire_bytes)
+    return s
+
+def split_ranges(ranges, pieces):
+    total = sum(end - start for start, end in ranges)
+    step = max(MIN_SEGMENT, -(-total // max(1, pieces)))
+    work = []
+    for start, end in ranges:
+        work.append([start, min(start + step, end)])
+        while work[-1][1] < end:
+            work.append([work[-1][1], min(work[-1][1] + step, end)])
+    return work
+
+def push_ranges(filename, filesize, work, lock, stop, offer, counters, conn=None):
+    own = conn is None
+    rng = None
+    try:
+        if own:
+            conn = open_data_connection()
+        with open(filename, 'rb') as f:
+            while not stop.is_set():
+                with lock:
+                    if not work:
+                        return
+                    rng = work.pop(0)
+                start, end = rng
+                conn.sendall(f"UPLOAD {filename} {filesize} {start} {end}{option(offer)}\n".encode())
+                resp, codec = parse_response(read_line(conn) or '')
+                if not resp or resp[0] != 'OK':
+                    with lock:
+                        counters['refused'] = ' '.join(resp[1:]) or 'no response'
+                    return
+                for sent, wire, kernel in send_data(conn, f, start, end, codec):
+                    with lock:
+                        counters['sent'] += sent
+                        counters['wire'] += wire
+                        counters['kernel'] += sent if kernel else 0
+                    if stop.is_set():
+                        # The server still expects the rest of the range, so the connection is done for
+                        try: conn.shutdown(socket.SHUT_RDWR)
+                        except OSError: pass
+                        return
+                done = (read_line(conn) or '').split()
+                if not done or done[0] != 'DONE':
+                    raise ConnectionResetError()
+                rng = None
+    except Exception:
+        pass
+    finally:
+        if rng is not None:
+            with lock:
+                work.append(rng)
+        if own and conn is not None:
+            conn.close()
+
+def do_ranged_upload(s, filename, filesize, connections, offer=None):
+    remote = fetch_remote_digests(s, filename + PART_SUFFIX)
+    staged = remote is not None
+    if remote is None:
+        remote = fetch_remote_digests(s, filename)
+
+    if remote is not None:
+        remote_size, block_size, remote_digests = remote
+        ranges = mismatched_ranges(remote_digests, block_digests(filename, block_size), block_size, filesize)
+        if not ranges and remote_size == filesize and not staged:
+            print("File already fully uploaded.")
+            return s
+    else:
+        ranges = [[0, filesize]] if filesize else []
+
+    total = sum(end - start for start, end in ranges)
+    if staged:
+        print(f"Resuming staged upload: sending {total} of {filesize} bytes in {len(ranges)} ranges...")
+    elif remote is not None:
+        print(f"Remote copy verified: sending {total} of {filesize} bytes in {len(ranges)} ranges...")
+    work = split_ranges(ranges, connections) if ranges else [[filesize, filesize]]
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    counters = {'sent': 0, 'wire': 0, 'kernel': 0, 'refused': None}
+    count = max(1, min(connections, len(work)))
+    workers = [threading.Thread(target=push_ranges, daemon=True,
+                                args=(filename, filesize, work, lock, stop, offer, counters, s if i == 0 else None))
+               for i in range(count)]
+    if count > 1:
+        print(f"Uploading {filename} over {count} connections...")
+
+    start_time = time.time()
+    last_report = -1.0
+    try:
+        for w in workers:
+            w.start()
+        alive = workers
+        while alive:
+            alive[0].join(0.2)
+            alive = [w for w in alive if w.is_alive()]
+            last_report = print_progress(counters['sent'], total, last_report, counters['wire'] if offer else None)
+    except KeyboardInterrupt:
+        stop.set()
+        for w in workers:
+            w.join()
+        raise
+
+    print()
+    if counters['refused']:
+        report_error(f"Server refused upload: {counters['refused']}")
+        return s
+    if work:
+        raise ConnectionResetError()
+
+    s.sendall(f"COMMIT {filename} {filesize}\n".encode())
+    resp_str = read_line(s)
+    if resp_str is None:
+        raise ConnectionResetError()
+    resp = resp_str.split()
+    if not resp or resp[0] != 'OK':
+        report_error(f"Server error: {' '.join(resp[1:]) or 'no response'}")
+        return s
+    calc_bitrate(counters['sent'], time.time() - start_time, counters['kernel'], counters['wire'])
+    return s
 
 def do_download(s, parts):
+    parts, offered = split_option(parts)
+    offer = ','.join(offered) or None
     if len(parts) < 2:
-        print("Usage: DOWNLOAD <filename>")
+        report_error("Usage: DOWNLOAD <filename> [connections] [Z=zlib|lzma|bz2]")
         return s
         
     filename = parts[1]
+    try:
+        connections = int(parts[2]) if len(parts) > 2 else 1
+    except ValueError:
+        report_error("Usage: DOWNLOAD <filename> [connections] [Z=zlib|lzma|bz2]")
+        return s
     
     while True:
+        if connections > 1 or os.path.exists(segments_path(filename)):
+            try:
+                return do_parallel_download(s, filename, connections, offer)
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                s = attempt_auto_reconnect()
+                if s is None:
+                    report_error("Failed to auto-reconnect.")
+                    return None
+                continue
         offset = os.path.getsize(filename) if os.path.exists(filename) else 0
         try:
-            s.sendall(f"DOWNLOAD {filename} {offset}\n".encode())
+            if offset > 0:
+                remote = fetch_remote_digests(s, filename)
+                if remote is None:
+                    report_error("Server error: file not found")
+                    return s
+                return do_delta_download(s, filename, remote, offer)
+
+            s.sendall(f"DOWNLOAD {filename} {offset}{option(offer)}\n".encode())
             resp_str = read_line(s)
             
             if not resp_str:
                 raise ConnectionResetError()
                 
-            resp = resp_str.split()
+            resp, codec = parse_response(resp_str)
             if not resp or resp[0] == "ERROR":
                 err_msg = ' '.join(resp[1:]) if len(resp) > 1 else 'File not found'
-                print(f"Server error: {err_msg}")
+                report_error(f"Server error: {err_msg}")
                 return s
                 
             filesize = int(resp[1])
@@ -155,105 +578,424 @@ def do_download(s, parts):
                 print(f"Resuming download from byte {offset}...")
                 
             start_time = time.time()
-            remaining = filesize - offset
             transferred = 0
-            last_percent = -1.0
+            wire_bytes = 0
+            last_report = -1.0
             
             with open(filename, 'ab') as f:
-                while remaining > 0:
-                    r, _, _ = select.select([s], [], [], 0.5)
-                    if not r:
-                        continue
-                    chunk = s.recv(min(4096, remaining))
-                    if not chunk:
-                        raise ConnectionResetError()
+                for chunk, wire in recv_data(s, filesize - offset, codec):
                     f.write(chunk)
-                    remaining -= len(chunk)
                     transferred += len(chunk)
-                    last_percent = print_progress(offset + transferred, filesize, last_percent)
+                    wire_bytes += wire
+                    last_report = print_progress(offset + transferred, filesize, last_report,
+                                                  wire_bytes if offer else None)
                     
             print()
-            calc_bitrate(transferred, time.time() - start_time)
+            calc_bitrate(transferred, time.time() - start_time, wire_bytes=wire_bytes)
             return s
             
         except Exception:
             s = attempt_auto_reconnect()
             if s is None:
-                print("Failed to auto-reconnect.")
+                report_error("Failed to auto-reconnect.")
                 return None
 
 def do_upload(s, parts):
+    parts, offered = split_option(parts)
+    offer = ','.join(offered) or None
     if len(parts) < 2:
-        print("Usage: UPLOAD <filename>")
+        report_error("Usage: UPLOAD <filename> [connections] [Z=zlib|lzma|bz2]")
         return s
         
     filename = parts[1]
+    try:
+        connections = int(parts[2]) if len(parts) > 2 else 1
+    except ValueError:
+        report_error("Usage: UPLOAD <filename> [connections] [Z=zlib|lzma|bz2]")
+        return s
     if not os.path.exists(filename):
-        print("Local file not found.")
+        report_error("Local file not found.")
         return s
         
     filesize = os.path.getsize(filename)
     
     while True:
         try:
-            s.sendall(f"UPLOAD {filename} {filesize}\n".encode())
-            resp_str = read_line(s)
-            
-            if not resp_str:
-                raise ConnectionResetError()
-                
-            resp = resp_str.split()
-            if not resp or resp[0] == "ERROR":
-                print("Server refused upload.")
-                return s
-                
-            offset = int(resp[1])
-            if offset >= filesize:
-                print("File already fully uploaded.")
-                return s
+            return do_ranged_upload(s, filename, filesize, connections, offer)
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            s = attempt_auto_reconnect()
+            if s is None:
+                report_error("Failed to auto-reconnect.")
+                return None
 
-            if offset > 0:
-                print(f"Resuming upload from byte {offset}...")
-                
-            start_time = time.time()
-            transferred = 0
-            last_percent = -1.0
-            
-            with open(filename, 'rb') as f:
-                f.seek(offset)
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    s.sendall(chunk)
-                    transferred += len(chunk)
-                    last_percent = print_progress(offset + transferred, filesize, last_percent)
-                    
-            print() 
-            calc_bitrate(transferred, time.time() - start_time)
-            return s
-            
+def list_remote(s, remote_dir):
+    s.sendall(f"LIST {remote_dir}\n".encode())
+    resp_str = read_line(s)
+    if not resp_str:
+        raise ConnectionResetError()
+    resp = resp_str.split()
+    if resp[0] != 'OK':
+        report_error(f"Server error: {' '.join(resp[1:])}")
+        return None
+    entries = []
+    for _ in range(int(resp[1])):
+        line = read_line(s)
+        if line is None:
+            raise ConnectionResetError()
+        size, rel = line.split(' ', 1)
+        entries.append((int(size), unquote(rel)))
+    return entries
+
+def mget_once(s, remote_dir, local_dir, offer):
+    entries = list_remote(s, remote_dir)
+    if entries is None:
+        return s
+
+    wanted = []
+    for size, rel in entries:
+        local = os.path.join(local_dir, *rel.split('/'))
+        have = os.path.getsize(local) if os.path.isfile(local) else -1
+        if have < size:
+            wanted.append((remote_dir.rstrip('/') + '/' + rel, local, max(have, 0)))
+    if not wanted:
+        print(f"All {len(entries)} files already downloaded.")
+        return s
+
+    s.sendall((f"MGET {len(wanted)}{option(offer)}\n" +
+               ''.join(f"{quote(remote)} {have}\n" for remote, _, have in wanted)).encode())
+    resp, codec = parse_response(read_line(s) or '')
+    if not resp or resp[0] != 'OK':
+        report_error(f"Server error: {' '.join(resp[1:])}")
+        return s
+
+    start_time = time.time()
+    files = failed = transferred = wire_bytes = 0
+    last_report = -1.0
+    while True:
+        hdr = (read_line(s) or '').split()
+        if not hdr:
+            raise ConnectionResetError()
+        if hdr[0] == 'END':
+            break
+        remote, local, _ = wanted[int(hdr[1])]
+        if hdr[2] == 'ERROR':
+            failed += 1
+            report_error(f"\nSkipped {remote}: not readable on server")
+            continue
+        size, offset = int(hdr[2]), int(hdr[3])
+        if os.path.dirname(local):
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, 'ab' if offset else 'wb') as f:
+            for chunk, wire in recv_data(s, size - offset, codec):
+                f.write(chunk)
+                transferred += len(chunk)
+                wire_bytes += wire
+        files += 1
+        last_report = print_progress(files, len(wanted), last_report)
+
+    print()
+    print(f"MGET finished: {files} files received, {failed} failed.")
+    calc_bitrate(transferred, time.time() - start_time, wire_bytes=wire_bytes)
+    return s
+
+def do_mget(s, parts):
+    parts, offered = split_option(parts)
+    offer = ','.join(offered) or None
+    if len(parts) < 2:
+        report_error("Usage: MGET <remote_dir> [local_dir] [Z=zlib|lzma|bz2]")
+        return s
+    remote_dir = parts[1]
+    local_dir = parts[2] if len(parts) > 2 else os.path.basename(os.path.normpath(remote_dir))
+
+    while True:
+        try:
+            return mget_once(s, remote_dir, local_dir, offer)
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            s = attempt_auto_reconnect()
+            if s is None:
+                report_error("Failed to auto-reconnect.")
+                return None
+
+def mput_once(s, files, offer):
+    s.sendall((f"MPUT {len(files)}{option(offer)}\n" +
+               ''.join(f"{quote(remote)} {size}\n" for _, remote, size in files)).encode())
+    resp, codec = parse_response(read_line(s) or '')
+    if not resp or resp[0] != 'OK':
+        report_error("Server refused upload.")
+        return s
+    offsets = []
+    for _ in files:
+        line = read_line(s)
+        if line is None:
+            raise ConnectionResetError()
+        offsets.append(int(line))
+
+    start_time = time.time()
+    sent_files = transferred = wire_bytes = kernel_bytes = 0
+    last_report = -1.0
+    for idx, ((local, _, size), offset) in enumerate(zip(files, offsets)):
+        if offset >= size and not (size == 0 and offset == 0):
+            continue
+        s.sendall(f"ENTRY {idx} {size - offset}\n".encode())
+        with open(local, 'rb') as f:
+            for sent, wire, kernel in send_data(s, f, offset, size, codec):
+                if kernel:
+                    kernel_bytes += sent
+                transferred += sent
+                wire_bytes += wire
+        sent_files += 1
+        last_report = print_progress(idx + 1, len(files), last_report)
+    s.sendall(b"END\n")
+
+    resp_str = read_line(s)
+    if not resp_str:
+        raise ConnectionResetError()
+    print()
+    print(f"MPUT finished: {sent_files} of {len(files)} files sent.")
+    calc_bitrate(transferred, time.time() - start_time, kernel_bytes, wire_bytes)
+    return s
+
+def do_mput(s, parts):
+    parts, offered = split_option(parts)
+    offer = ','.join(offered) or None
+    if len(parts) < 2:
+        report_error("Usage: MPUT <local_dir> [remote_dir] [Z=zlib|lzma|bz2]")
+        return s
+    local_dir = parts[1]
+    remote_dir = parts[2] if len(parts) > 2 else os.path.basename(os.path.normpath(local_dir))
+    if not os.path.isdir(local_dir):
+        report_error("Local directory not found.")
+        return s
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            local = os.path.join(dirpath, name)
+            rel = os.path.relpath(local, local_dir).replace(os.sep, '/')
+            files.append((local, remote_dir.rstrip('/') + '/' + rel, os.path.getsize(local)))
+
+    while True:
+        try:
+            return mput_once(s, files, offer)
+        except KeyboardInterrupt:
+            raise
         except Exception:
             s = attempt_auto_reconnect()
             if s is None:
-                print("Failed to auto-reconnect.")
+                report_error("Failed to auto-reconnect.")
                 return None
 
+def pipeline(s, commands):
+    # Only for commands answered with a single line (ECHO, TIME, COMMIT, CACHE, STATS, ...);
+    # the ones in UNPIPELINED are run by their handlers between batches
+    responses = []
+    for first in range(0, len(commands), MAX_IN_FLIGHT):
+        batch = commands[first:first + MAX_IN_FLIGHT]
+        s.sendall(''.join(f"#{first + n} {cmd}\n" for n, cmd in enumerate(batch)).encode())
+        pending = {f"#{first + n}": n for n in range(len(batch))}
+        results = [None] * len(batch)
+        while pending:
+            line = read_line(s)
+            if line is None:
+                raise ConnectionResetError()
+            tag, _, rest = line.partition(' ')
+            n = pending.pop(tag, None)
+            if n is not None:
+                results[n] = rest
+        responses.extend(results)
+    return responses
+
+def do_script(s, parts):
+    if len(parts) < 2:
+        print("Usage: SCRIPT <file>")
+        return s
+    try:
+        with open(parts[1]) as f:
+            lines = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    except OSError:
+        print("Script file not found.")
+        return s
+
+    start_time = time.time()
+    batch = []
+
+    def flush():
+        for resp in pipeline(s, batch):
+            if resp.startswith(('ERROR', 'UNKNOWN')):
+                report_error(resp)
+            else:
+                print(resp)
+        batch.clear()
+
+    for line in lines:
+        cmd = line.split()[0].upper()
+        if cmd in UNPIPELINED:
+            flush()
+            s = UNPIPELINED[cmd](s, line.split())
+            if s is None:
+                return None
+        elif cmd in ('CLOSE', 'EXIT', 'QUIT'):
+            break
+        else:
+            batch.append(line)
+    flush()
+    print(f"Script finished: {len(lines)} commands in {time.time() - start_time:.3f}s")
+    return s
+
+def do_list(s, parts):
+    entries = list_remote(s, parts[1] if len(parts) > 1 else '.')
+    for size, rel in entries or []:
+        print(f"{size:>12}  {rel}")
+    return s
+
+def do_hashes(s, parts):
+    if len(parts) < 2:
+        report_error("Usage: HASHES <filename>")
+        return s
+    remote = fetch_remote_digests(s, parts[1])
+    if remote is None:
+        report_error("Server error: file not found")
+        return s
+    size, block_size, digests = remote
+    print(f"OK {size} {block_size} {len(digests)}")
+    for n, digest in enumerate(digests):
+        print(f"{n * block_size:>12}  {digest.hex()}")
+    return s
+
+def do_command(s, parts):
+    s.sendall(' '.join(parts).encode() + b'\n')
+    resp = read_line(s)
+    if resp is None:
+        raise ConnectionResetError()
+    if resp.startswith(('ERROR', 'UNKNOWN')):
+        report_error(resp)
+    else:
+        print(resp)
+    return s
+
+TRANSFERS = {'DOWNLOAD': do_download, 'UPLOAD': do_upload, 'MGET': do_mget, 'MPUT': do_mput}
+
+# Replies of these are more than one line or a data stream, so SCRIPT sends them one at a time
+UNPIPELINED = dict(TRANSFERS, LIST=do_list, HASHES=do_hashes)
+
+HEADLESS = dict(UNPIPELINED, SCRIPT=do_script)
+
+def run_job(job):
+    s = open_data_connection()
+    try:
+        s = TRANSFERS[job.parts[0].upper()](s, job.parts)
+    finally:
+        if s is not None:
+            try: s.close()
+            except: pass
+    return s is not None and job.error is None
+
+def load_manifest(path):
+    f = sys.stdin if path == '-' else open(path)
+    with f:
+        lines = [line.split() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    for n, parts in enumerate(lines):
+        if parts[0].upper() in ('CLOSE', 'EXIT', 'QUIT'):
+            return lines[:n]
+    return lines
+
+def run_headless(commands, parallel):
+    idle = queue.LifoQueue()
+    try:
+        idle.put(open_data_connection())
+    except OSError:
+        print(f"Server at {HOST}:{PORT} is not running or unreachable.")
+        return 2
+
+    def run_entry(job):
+        try:
+            s = idle.get_nowait()
+        except queue.Empty:
+            s = open_data_connection()
+        try:
+            s = HEADLESS.get(job.parts[0].upper(), do_command)(s, job.parts)
+        except BaseException:
+            s.close()
+            raise
+        if s is None:
+            return False
+        idle.put(s)
+        return job.error is None
+
+    manager = TransferManager(run_entry, max(1, parallel), prompt='', full_output=True)
+    start_time = time.time()
+    for parts in commands:
+        manager.submit(parts)
+    try:
+        manager.wait()
+    except KeyboardInterrupt:
+        manager.shutdown()
+    manager.announce()
+    manager.shutdown(timeout=0)
+    while not idle.empty():
+        s = idle.get()
+        try: s.sendall(b"EXIT\n")
+        except: pass
+        s.close()
+
+    failed = sum(1 for job in manager.jobs.values() if job.state != 'done')
+    print(f"Finished {len(commands)} commands in {time.time() - start_time:.3f}s, {failed} failed.")
+    return 1 if failed else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="LAB_1 TCP file client. Without a command or --manifest it starts the interactive prompt.",
+        epilog="Exit status in headless mode: 0 when every command succeeded, 1 when some failed, "
+               "2 when the server is unreachable or the manifest cannot be read.")
+    parser.add_argument('--host', help="server address (asked interactively when omitted)")
+    parser.add_argument('--port', type=int, help="server port (asked interactively when omitted)")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="run the commands in FILE, one per line ('-' for stdin), and exit; each line waits "
+                             "for its reply, use 'script FILE' to pipeline single-line commands")
+    parser.add_argument('--parallel', type=int, default=1,
+                        help="manifest commands run at once; each runner reuses its own connection")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="run a single command and exit, e.g. download f.zip 4")
+    return parser.parse_args()
+
 def start_client():
     global HOST, PORT
-    
-    user_host = input(f"Enter server IP (default {HOST}): ").strip()
-    if user_host:
-        HOST = user_host
+    args = parse_args()
+    if args.host:
+        HOST = args.host
+    if args.port is not None:
+        PORT = args.port
+
+    if args.command or args.manifest:
+        commands = [args.command] if args.command else []
+        if args.manifest:
+            try:
+                commands += load_manifest(args.manifest)
+            except OSError as e:
+                print(f"Cannot read manifest: {e}")
+                sys.exit(2)
+        sys.exit(run_headless(commands, args.parallel))
+
+    if args.host is None:
+        user_host = input(f"Enter server IP (default {HOST}): ").strip()
+        if user_host:
+            HOST = user_host
         
-    user_port = input(f"Enter server port (default {PORT}): ").strip()
-    if user_port:
-        try:
-            PORT = int(user_port)
-        except ValueError:
-            print("Invalid port, using default.")
+    if args.port is None:
+        user_port = input(f"Enter server port (default {PORT}): ").strip()
+        if user_port:
+            try:
+                PORT = int(user_port)
+            except ValueError:
+                print("Invalid port, using default.")
 
     s = connect_to_server_manual()
+    manager = TransferManager(run_job, MAX_JOBS)
     
     while True:
         try:
@@ -282,6 +1024,44 @@ def start_client():
                 if s is None:
                     s = connect_to_server_manual()
                     
+            elif cmd in ('MGET', 'MPUT'):
+                s = do_mget(s, parts) if cmd == 'MGET' else do_mput(s, parts)
+                if s is None:
+                    s = connect_to_server_manual()
+                    
+            elif cmd == 'LIST':
+                s = do_list(s, parts)
+                    
+            elif cmd == 'HASHES':
+                s = do_hashes(s, parts)
+                    
+            elif cmd == 'SCRIPT':
+                s = do_script(s, parts)
+                if s is None:
+                    s = connect_to_server_manual()
+                    
+            elif cmd == 'BG':
+                if len(parts) < 3 or parts[1].upper() not in TRANSFERS:
+                    print("Usage: BG <DOWNLOAD|UPLOAD|MGET|MPUT> <args...>")
+                else:
+                    job = manager.submit(parts[1:])
+                    print(f"Queued job {job.id}: {' '.join(job.parts)}")
+                    
+            elif cmd == 'JOBS':
+                lines = manager.listing()
+                for line in lines:
+                    print(line)
+                if not lines:
+                    print("No jobs.")
+                    
+            elif cmd == 'CANCEL':
+                try:
+                    job_id = int(parts[1])
+                except (IndexError, ValueError):
+                    print("Usage: CANCEL <job id>")
+                    continue
+                print(f"Cancelling job {job_id}." if manager.cancel(job_id) else f"No active job {job_id}.")
+                    
             else:
                 s.sendall(cmd_input.encode() + b'\n')
                 resp = read_line(s)
@@ -296,6 +1076,7 @@ def start_client():
             except: pass
             s = connect_to_server_manual()
             
+    manager.shutdown()
     try: s.close()
     except: pass
 
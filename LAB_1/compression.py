@@ -0,0 +1,77 @@
+import bz2
+import lzma
+import struct
+import zlib
+
+FRAME = struct.Struct('!BII')
+FRAME_RAW = 0
+FRAME_COMPRESSED = 1
+BLOCK_SIZE = 256 * 1024
+SAMPLE_SIZE = 4096
+MAX_RATIO = 0.9
+OPTION_PREFIX = 'Z='
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompressobj),
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor),
+    'bz2': (lambda data: bz2.compress(data, 9), bz2.BZ2Decompressor),
+}
+
+
+def split_option(args):
+    """Strip a Z=<codec>[,<codec>...] token from args; returns (args, offered codecs)."""
+    rest, offered = [], []
+    for arg in args:
+        if arg.upper().startswith(OPTION_PREFIX):
+            offered = [name.lower() for name in arg[len(OPTION_PREFIX):].split(',') if name]
+        else:
+            rest.append(arg)
+    return rest, offered
+
+
+def choose(offered):
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+
+def option(codec):
+    return f" {OPTION_PREFIX}{codec}" if codec else ""
+
+
+def looks_compressible(data):
+    sample = data[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * MAX_RATIO
+
+
+def encode_block(codec, data):
+    """Frame one block, sending it raw when the codec does not shrink it."""
+    compress = CODECS[codec][0]
+    if looks_compressible(data):
+        packed = compress(data)
+        if len(packed) < len(data) * MAX_RATIO:
+            return FRAME.pack(FRAME_COMPRESSED, len(packed), len(data)) + packed
+    return FRAME.pack(FRAME_RAW, len(data), len(data)) + data
+
+
+def decode_payload(codec, kind, payload, logical_len):
+    """Unframe one block. The peer's frame is untrusted: a compressed payload is inflated to at
+    most logical_len + 1 bytes, and anything but exactly logical_len bytes is a bad frame."""
+    if logical_len > BLOCK_SIZE:
+        raise ValueError("bad frame")
+    if kind == FRAME_RAW:
+        data = payload
+    elif kind == FRAME_COMPRESSED:
+        decoder = CODECS[codec][1]()
+        try:
+            data = decoder.decompress(payload, logical_len + 1)
+        except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+            raise ValueError(f"bad frame: {e}")
+        if not decoder.eof or decoder.unused_data or getattr(decoder, 'unconsumed_tail', b''):
+            raise ValueError("bad frame")
+    else:
+        raise ValueError("bad frame")
+    if len(data) != logical_len:
+        raise ValueError("bad frame")
+    return data
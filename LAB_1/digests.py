@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+BLOCK_SIZE = 1024 * 1024
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 64 * 1024 * 1024
+DIGEST_SIZE = 16
+INDEX_DIR = '.digests'
+MAX_ENTRIES = 256
+
+
+def clamp_block_size(block_size):
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def block_digests(path, block_size=BLOCK_SIZE):
+    digests = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digests.append(hashlib.blake2b(block, digest_size=DIGEST_SIZE).digest())
+    return digests
+
+
+def mismatched_ranges(have, want, block_size, size):
+    """Byte ranges [start, end) of the wanted size-byte file whose blocks differ from what we have."""
+    ranges = []
+    for i, digest in enumerate(want):
+        if i < len(have) and have[i] == digest:
+            continue
+        start = i * block_size
+        end = min(start + block_size, size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+class DigestIndex:
+    """Block digests of served files, kept under INDEX_DIR across restarts and for the
+    max_entries most recently used files in memory."""
+
+    def __init__(self, directory=INDEX_DIR, max_entries=MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _entry_path(self, path, block_size):
+        name = hashlib.sha1(f"{path}:{block_size}".encode()).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def get(self, path, block_size=BLOCK_SIZE):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        key = (path, block_size)
+
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            try:
+                with open(self._entry_path(path, block_size)) as f:
+                    entry = json.load(f)
+            except Exception:
+                entry = None
+        if entry is not None and entry['stamp'] == stamp:
+            self._remember(key, entry)
+            return st.st_size, [bytes.fromhex(d) for d in entry['digests']]
+
+        digests = block_digests(path, block_size)
+        entry = {'stamp': stamp, 'digests': [d.hex() for d in digests]}
+        self._remember(key, entry)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{self._entry_path(path, block_size)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._entry_path(path, block_size))
+        except OSError:
+            pass
+        return st.st_size, digests
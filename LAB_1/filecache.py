@@ -0,0 +1,154 @@
+import mmap
+import os
+import stat
+import time
+from collections import OrderedDict
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+REVALIDATE_INTERVAL = 1.0
+MAX_ENTRIES = 512
+
+
+class CachedFile:
+    """An open file shared by every download of the same path. Plain downloads sendfile from the
+    fd; the mapping is made on first use of view (compressed downloads, the copy fallback)."""
+
+    def __init__(self, cache, path, fd, st):
+        self.cache = cache
+        self.name = path
+        self.fd = fd
+        self.size = st.st_size
+        self.stamp = (st.st_size, st.st_mtime_ns, st.st_ino)
+        self.checked = time.monotonic()
+        self.refs = 0
+        self.cached = False
+        self.mm = None
+        self._view = None
+
+    @property
+    def view(self):
+        if self._view is None:
+            if self.size:
+                self.mm = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+                self._view = memoryview(self.mm)
+                if self.cached:
+                    self.cache.mapped += self.size
+                    self.cache._evict()
+            else:
+                self._view = memoryview(b'')
+        return self._view
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        self.cache.release(self)
+
+    def unmap(self):
+        try:
+            if self._view is not None:
+                self._view.release()
+            if self.mm is not None:
+                self.mm.close()
+        except (BufferError, ValueError):
+            pass
+        os.close(self.fd)
+
+
+class FileCache:
+    def __init__(self, budget=DEFAULT_BUDGET, revalidate=REVALIDATE_INTERVAL, max_entries=MAX_ENTRIES):
+        self.budget = budget
+        self.max_entries = max_entries
+        self.revalidate = revalidate
+        self.entries = OrderedDict()
+        self.mapped = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.last_hit = False
+
+    def acquire(self, path):
+        path = os.path.abspath(path)
+        entry = self.entries.get(path)
+        if entry is not None and time.monotonic() - entry.checked > self.revalidate:
+            try:
+                st = os.stat(path)
+            except OSError:
+                self._drop(entry)
+                raise
+            if (st.st_size, st.st_mtime_ns, st.st_ino) != entry.stamp:
+                self._drop(entry)
+                entry = None
+            else:
+                entry.checked = time.monotonic()
+
+        self.last_hit = entry is not None
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(path)
+            entry.refs += 1
+            return entry
+
+        self.misses += 1
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise IsADirectoryError(path)
+            entry = CachedFile(self, path, fd, st)
+        except Exception:
+            os.close(fd)
+            raise
+        entry.refs += 1
+        if entry.size <= self.budget:
+            entry.cached = True
+            self.entries[path] = entry
+            self._evict()
+        return entry
+
+    def served(self, count):
+        if self.last_hit:
+            self.bytes_saved += count
+
+    def release(self, entry):
+        entry.refs -= 1
+        if entry.refs <= 0 and not entry.cached:
+            entry.unmap()
+        self._evict()
+
+    def _drop(self, entry):
+        if self.entries.get(entry.name) is entry:
+            del self.entries[entry.name]
+            if entry.mm is not None:
+                self.mapped -= entry.size
+        entry.cached = False
+        if entry.refs <= 0:
+            entry.unmap()
+
+    def _evict(self):
+        # The budget counts only mapped files: unmapped ones are just open fds, capped by max_entries
+        for entry in list(self.entries.values()):
+            too_many = len(self.entries) > self.max_entries
+            if self.mapped <= self.budget and not too_many:
+                break
+            if entry.refs <= 0 and (too_many or entry.mm is not None):
+                self._drop(entry)
+                self.evictions += 1
+
+    def clear(self):
+        for entry in list(self.entries.values()):
+            self._drop(entry)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'entries': len(self.entries),
+            'mapped_bytes': self.mapped,
+            'budget_bytes': self.budget,
+            'evictions': self.evictions,
+        }
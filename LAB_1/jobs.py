@@ -0,0 +1,188 @@
+import sys
+import time
+import queue
+import threading
+from collections import deque
+
+REPORT_INTERVAL = 1.0
+OUTPUT_LINES = 20
+
+_local = threading.local()
+
+
+class JobCancelled(KeyboardInterrupt):
+    """Raised inside a job's thread so transfer loops unwind the same way as on Ctrl+C."""
+
+
+def current_job():
+    return getattr(_local, 'job', None)
+
+
+class Job:
+    def __init__(self, job_id, parts, output_lines=OUTPUT_LINES):
+        self.id = job_id
+        self.parts = parts
+        self.state = 'queued'
+        self.current = 0
+        self.total = 0
+        self.wire = None
+        self.rate = 0.0
+        self.sampled = (time.monotonic(), 0)
+        self.message = ''
+        self.error = None
+        self.output = deque(maxlen=output_lines)
+        self.cancelled = threading.Event()
+
+    def update(self, current, total, wire=None):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        self.current = current
+        self.total = total
+        self.wire = wire
+
+    def log(self, text):
+        for line in text.replace('\r', '\n').split('\n'):
+            line = line.rstrip()
+            if line.strip() and not line.lstrip().startswith('Progress:'):
+                self.output.append(line)
+                self.message = line.strip()
+
+    def sample(self, now):
+        then, seen = self.sampled
+        if now > then:
+            self.rate = max(0, self.current - seen) / (now - then)
+        self.sampled = (now, self.current)
+
+    def describe(self):
+        percent = f"{self.current / self.total * 100:5.1f}%" if self.total else "    -"
+        rate = f"{self.rate / (1024 * 1024):7.2f} MB/s" if self.state == 'running' else ' ' * 12
+        return f"{self.id:>4}  {self.state:<9} {percent}  {rate}  {' '.join(self.parts)}  {self.message}"
+
+
+class JobOutput:
+    """stdout wrapper: text printed from a job's thread goes to that job instead of the terminal."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        job = current_job()
+        if job is None:
+            return self.stream.write(text)
+        job.log(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class TransferManager:
+    """Runs jobs on worker threads. With full_output (headless runs) every line a job printed
+    is written out when it finishes; otherwise only its last line shows in the announcement."""
+
+    def __init__(self, run, workers=2, interval=REPORT_INTERVAL, prompt='> ', full_output=False):
+        self.run = run
+        self.interval = interval
+        self.prompt = prompt
+        self.full_output = full_output
+        self.announced = set()
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        if not isinstance(sys.stdout, JobOutput):
+            sys.stdout = JobOutput(sys.stdout)
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        self.threads.append(threading.Thread(target=self._reporter, daemon=True))
+        for t in self.threads:
+            t.start()
+
+    def submit(self, parts):
+        with self.lock:
+            job = Job(self.next_id, parts, None if self.full_output else OUTPUT_LINES)
+            self.jobs[job.id] = job
+            self.next_id += 1
+        self.queue.put(job)
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.state not in ('queued', 'running'):
+            return False
+        job.cancelled.set()
+        if job.state == 'queued':
+            job.state = 'cancelled'
+        return True
+
+    def listing(self):
+        with self.lock:
+            return [job.describe() for job in self.jobs.values()]
+
+    def wait(self):
+        """Block until every submitted job has finished, failed or been cancelled."""
+        self.queue.join()
+
+    def shutdown(self, timeout=5.0):
+        self.stopping.set()
+        for job in list(self.jobs.values()):
+            self.cancel(job.id)
+        deadline = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0, deadline - time.monotonic()))
+
+    def _worker(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                if not job.cancelled.is_set():
+                    self._execute(job)
+            finally:
+                self.queue.task_done()
+
+    def _execute(self, job):
+        job.state = 'running'
+        job.sampled = (time.monotonic(), 0)
+        _local.job = job
+        try:
+            ok = self.run(job)
+            job.state = 'done' if ok is not False else 'failed'
+            if job.error:
+                job.message = job.error
+        except JobCancelled:
+            job.state = 'cancelled'
+        except Exception as e:
+            job.state = 'failed'
+            job.message = f"{type(e).__name__}: {e}"
+        finally:
+            _local.job = None
+
+    def announce(self):
+        """Print one line for every job that finished since the last call."""
+        lead = '\n' if self.prompt else ''
+        with self.lock:
+            for job in self.jobs.values():
+                if job.state in ('done', 'failed', 'cancelled') and job.id not in self.announced:
+                    self.announced.add(job.id)
+                    message = job.message
+                    if self.full_output:
+                        sys.stdout.write(''.join(line + '\n' for line in job.output))
+                        # The output above already ends with the message unless the job broke off
+                        message = message if job.state != 'done' else ''
+                    sys.stdout.write(f"{lead}[job {job.id}] {' '.join(job.parts)}: {job.state}"
+                                     f"{' - ' + message if message else ''}\n{self.prompt}")
+            sys.stdout.flush()
+
+    def _reporter(self):
+        while not self.stopping.wait(self.interval):
+            now = time.monotonic()
+            for job in list(self.jobs.values()):
+                if job.state == 'running':
+                    job.sample(now)
+            self.announce()
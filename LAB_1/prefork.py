@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import signal
+import socket
+import selectors
+import traceback
+from stream import StreamReader
+
+STATS_INTERVAL = 1.0
+MIN_UPTIME = 1.0
+
+
+def fork_worker(worker_id, run_worker, links):
+    parent, child = socket.socketpair()
+    pid = os.fork()
+    if pid == 0:
+        parent.close()
+        for link in links.values():
+            link.close()
+        code = 0
+        try:
+            run_worker(worker_id, child)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+    child.close()
+    return pid, parent
+
+
+def supervise(count, run_worker, aggregate):
+    """Fork count workers, relay their stats snapshots and restart the ones that crash.
+
+    The first SIGINT/SIGTERM is forwarded as SIGTERM so every worker drains; a second one
+    is forwarded again and makes the workers stop at once.
+    """
+    stopping = False
+    children = {}
+    links = {}
+    readers = {}
+    started = {}
+    sel = selectors.DefaultSelector()
+
+    def on_signal(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def spawn(worker_id):
+        pid, link = fork_worker(worker_id, run_worker, links)
+        children[pid] = worker_id
+        links[worker_id] = link
+        readers[worker_id] = StreamReader(link)
+        started[worker_id] = time.monotonic()
+        sel.register(link, selectors.EVENT_READ, worker_id)
+
+    def retire(worker_id):
+        link = links.pop(worker_id, None)
+        if link is not None:
+            try:
+                sel.unregister(link)
+            except (KeyError, ValueError):
+                pass
+            link.close()
+        readers.pop(worker_id, None)
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+    for worker_id in range(count):
+        spawn(worker_id)
+    print(f"Supervisor {os.getpid()} started {count} workers")
+
+    while children:
+        try:
+            events = sel.select(timeout=0.5)
+        except InterruptedError:
+            events = []
+        for key, _ in events:
+            worker_id = key.data
+            reader = readers.get(worker_id)
+            if reader is None:
+                continue
+            try:
+                received = reader.fill()
+            except OSError:
+                received = 0
+            if not received:
+                retire(worker_id)
+                continue
+            while True:
+                line = reader.pop_line()
+                if line is None:
+                    break
+                try:
+                    aggregate.update(worker_id, json.loads(line))
+                    links[worker_id].sendall(json.dumps(aggregate.snapshot()).encode() + b'\n')
+                except (ValueError, OSError):
+                    pass
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            worker_id = children.pop(pid, None)
+            if worker_id is None:
+                continue
+            retire(worker_id)
+            if stopping:
+                continue
+            if time.monotonic() - started[worker_id] < MIN_UPTIME:
+                print(f"Worker {worker_id} exited right after start (status {status}); not restarting it")
+                continue
+            print(f"Worker {worker_id} (pid {pid}) exited with status {status}; restarting")
+            spawn(worker_id)
+
+    sel.close()
+    print("All workers stopped")
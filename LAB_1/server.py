@@ -2,23 +2,149 @@ import socket
 import os
 import datetime
 import sys
-import select
+import selectors
 import signal
+import argparse
+import queue
+import time
+import json
+from collections import deque
+from urllib.parse import quote, unquote
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from stream import StreamReader, send_file_chunk, preallocate, write_at, copy_into, SENDFILE_CHUNK, PART_SUFFIX
+from digests import DigestIndex, clamp_block_size, BLOCK_SIZE as DIGEST_BLOCK_SIZE
+from filecache import FileCache, DEFAULT_BUDGET as CACHE_BUDGET
+from shaping import Scheduler, DIRECTIONS
+from prefork import supervise, STATS_INTERVAL
+from compression import split_option, choose, option, encode_block, decode_payload, FRAME, BLOCK_SIZE as COMPRESS_BLOCK
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.metrics import Registry, Aggregate, start_exporter, summary as metrics_summary, THROUGHPUT_BUCKETS
+from common.timerwheel import TimerWheel
 
 HOST = '0.0.0.0'
 PORT = 9090
+BACKLOG = 128
+RECV_SIZE = 65536
+BACKGROUND_WORKERS = 4
+DRAIN_TIMEOUT = 30.0
+IDLE_TIMEOUT = 300.0
+STALL_TIMEOUT = 60.0
+UPLOAD_BUFFER = 1024 * 1024
 running = True
-current_conn = None
+draining = False
+worker_id = None
+cluster_snapshot = None
+reported_transfers = {}
+sel = selectors.DefaultSelector()
+sessions = {}
+executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS)
+completions = queue.SimpleQueue()
+wake_r, wake_w = socket.socketpair()
+digest_index = DigestIndex()
+file_cache = FileCache()
+part_files = {}
+scheduler = Scheduler()
+timers = TimerWheel()
+reap_after = {'idle': IDLE_TIMEOUT, 'stalled': STALL_TIMEOUT}
+COMMANDS = ('ECHO', 'TIME', 'CLOSE', 'EXIT', 'QUIT', 'DOWNLOAD', 'UPLOAD', 'COMMIT', 'HASHES', 'CACHE', 'LIST', 'MGET',
+            'MPUT', 'STATS')
+
+metrics = Registry('lab1')
+bytes_sent_total = metrics.counter('bytes_sent_total', "Bytes written to client sockets")
+bytes_received_total = metrics.counter('bytes_received_total', "Bytes read from client sockets")
+sessions_total = metrics.counter('sessions_total', "Accepted client connections")
+metrics.callback('sessions_active', "Currently connected clients", lambda: len(sessions))
+commands_total = metrics.counter('commands_total', "Commands handled, by command")
+command_latency = metrics.histogram('command_latency_seconds', "Time until a command is answered, by command")
+transfer_throughput = metrics.histogram('transfer_throughput_mbps', "Per-transfer throughput in MB/s, by direction",
+                                        THROUGHPUT_BUCKETS)
+throttle_waits = metrics.counter('throttle_waits_total', "Times a transfer was paused by the bandwidth scheduler")
+sessions_reaped = metrics.counter('sessions_reaped_total', "Sessions closed by the idle/stall watchdog, by reason")
+metrics.callback('timers_pending', "Timers waiting in the timer wheel", lambda: len(timers))
+metrics.callback('shaped_transfers', "Transfers currently tracked by the bandwidth scheduler",
+                 lambda: [({'direction': d}, scheduler.active(d)) for d in DIRECTIONS])
+for _name, _kind in (('hits', 'counter'), ('misses', 'counter'), ('bytes_saved', 'counter'),
+                     ('evictions', 'counter'), ('entries', 'gauge'), ('mapped_bytes', 'gauge')):
+    metrics.callback(f'cache_{_name}', f"Hot-file cache {_name.replace('_', ' ')}",
+                     lambda _name=_name: file_cache.stats()[_name], _kind)
+
+
+def observe_transfer(direction, nbytes, started):
+    elapsed = time.monotonic() - started
+    if nbytes and elapsed > 0:
+        transfer_throughput.observe(nbytes / elapsed / (1024 * 1024), direction=direction)
+
+
+def count_sent(sess, n):
+    bytes_sent_total.inc(n)
+    scheduler.consume(sess, n)
+
+
+def shape(sess, direction, want):
+    if sess.resume_timer is not None:
+        return 0
+    if not scheduler.enabled:
+        return want
+    scheduler.start(sess, sess.addr[0], direction)
+    allowed, delay = scheduler.grant(sess, want)
+    if not allowed:
+        throttle_waits.inc(direction=direction)
+        sess.resume_timer = timers.schedule(delay, resume_session, sess)
+    return allowed
+
+
+def resume_session(sess):
+    sess.resume_timer = None
+    if sessions.get(sess.conn.fileno()) is sess:
+        update_interest(sess)
+
+
+def watch(sess, now):
+    limits = [limit for limit in reap_after.values() if limit]
+    if not limits:
+        return
+    quiet = now - sess.last_active
+    delay = min(limits) - quiet
+    if delay <= 0:
+        delay = (reap_after[session_state(sess)] or min(limits)) - quiet
+    sess.watchdog = timers.schedule(max(delay, timers.tick), check_session, sess)
+
+
+def session_state(sess):
+    return 'stalled' if sess.transfer is not None or sess.outbuf else 'idle'
+
+
+def check_session(sess):
+    sess.watchdog = None
+    if sessions.get(sess.conn.fileno()) is not sess:
+        return
+    now = time.monotonic()
+    if isinstance(sess.transfer, BackgroundJob):
+        sess.last_active = now
+    reason = session_state(sess)
+    limit = reap_after[reason]
+    if limit and now - sess.last_active >= limit:
+        sessions_reaped.inc(reason=reason)
+        print(f"Reaping {reason} client {sess.addr}")
+        close_session(sess)
+        return
+    watch(sess, now)
 
 
 def signal_handler(sig, frame):
-    global running
-    running = False
-    if current_conn:
-        try:
-            current_conn.close()
-        except:
-            pass
+    global running, draining
+    if draining:
+        running = False
+    draining = True
+    try:
+        wake_w.send(b'\0')
+    except OSError:
+        pass
 
 
 def get_local_ip():
@@ -42,186 +168,1043 @@ def setup_keepalive(sock):
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
 
 
-def read_line(conn):
-    line = b''
-    while running:
+class Session:
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.reader = StreamReader(conn, RECV_SIZE)
+        self.outbuf = bytearray()
+        self.transfer = None
+        self.closing = False
+        self.events = 0
+        self.tag = None
+        self.unanswered = []    # (command, start) for command_latency until the reply leaves outbuf
+        self.last_active = time.monotonic()
+        self.watchdog = None
+        self.resume_timer = None
+
+    def sendall(self, data):
+        if self.tag:
+            self.outbuf += self.tag.encode() + b' '
+            self.tag = None
+        self.outbuf += data
+
+
+class DownloadTransfer:
+    direction = 'send'
+
+    def __init__(self, f, offset, count):
+        self.f = f
+        self.offset = offset
+        self.remaining = count
+        self.kernel = True
+        self.kernel_bytes = 0
+        self.copied_bytes = 0
+        self.started = time.monotonic()
+
+    def on_writable(self, sess, limit=SENDFILE_CHUNK):
+        sent, self.kernel = send_file_chunk(sess.conn, self.f, self.offset,
+                                            min(limit, self.remaining), self.kernel)
+        if not sent:
+            return True
+        count_sent(sess, sent)
+        if self.kernel:
+            self.kernel_bytes += sent
+        else:
+            self.copied_bytes += sent
+        self.offset += sent
+        self.remaining -= sent
+        return self.remaining <= 0
+
+    def close(self):
+        self.f.close()
+        sent = self.kernel_bytes + self.copied_bytes
+        observe_transfer('download', sent, self.started)
+        print(f"Download of {self.f.name}: sent {sent} bytes ({self.kernel_bytes} via sendfile)")
+
+
+class CompressedDownloadTransfer(DownloadTransfer):
+    def __init__(self, f, offset, count, codec):
+        super().__init__(f, offset, count)
+        self.codec = codec
+        self.pending = b''
+        self.logical_bytes = 0
+        self.wire_bytes = 0
+
+    def on_writable(self, sess, limit=SENDFILE_CHUNK):
+        if not self.pending:
+            block = self.f.view[self.offset:self.offset + min(COMPRESS_BLOCK, self.remaining)]
+            if not block:
+                return True
+            self.offset += len(block)
+            self.remaining -= len(block)
+            self.logical_bytes += len(block)
+            self.pending = memoryview(encode_block(self.codec, block))
+        sent = sess.conn.send(self.pending[:limit])
+        count_sent(sess, sent)
+        self.pending = self.pending[sent:]
+        self.wire_bytes += sent
+        return not self.pending and self.remaining <= 0
+
+    def close(self):
+        self.f.close()
+        observe_transfer('download', self.logical_bytes, self.started)
+        print(f"Download of {self.f.name}: sent {self.logical_bytes} bytes "
+              f"as {self.wire_bytes} on the wire ({self.codec})")
+
+
+class UploadTransfer:
+    direction = 'recv'
+
+    def __init__(self, f, remaining, codec=None):
+        self.f = f
+        self.remaining = remaining
+        self.codec = codec
+        self.frame = None
+        self.received = 0
+        self.started = time.monotonic()
+
+    def on_data(self, reader):
+        if self.codec is not None:
+            return self.on_frames(reader)
+        chunk = reader.take(self.remaining)
+        self.write(chunk)
+        self.remaining -= len(chunk)
+        self.received += len(chunk)
+        return bool(chunk)
+
+    def on_frames(self, reader):
+        progressed = False
+        while self.remaining > 0:
+            if self.frame is None:
+                if len(reader) < FRAME.size:
+                    break
+                self.frame = FRAME.unpack(reader.take(FRAME.size))
+                if self.frame[1] > 2 * COMPRESS_BLOCK or self.frame[2] > self.remaining:
+                    raise ValueError("bad frame")
+            kind, wire_len, logical_len = self.frame
+            if len(reader) < wire_len:
+                break
+            data = decode_payload(self.codec, kind, reader.take(wire_len), logical_len)
+            self.write(data)
+            self.remaining -= len(data)
+            self.received += len(data)
+            self.frame = None
+            progressed = True
+        return progressed
+
+    def write(self, data):
+        self.f.write(data)
+
+    def done(self):
+        return self.remaining <= 0
+
+    def close(self):
+        self.f.close()
+        observe_transfer('upload', self.received, self.started)
+
+
+class PartFile:
+    """Preallocated <name>.part that ranged uploads write into until COMMIT renames it over <name>."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.name = path + PART_SUFFIX
+        self.size = size
+        self.fd = None
+        self.refs = 0
+        self.ready = executor.submit(self._prepare)
+
+    def _prepare(self):
+        fd = os.open(self.name, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
         try:
-            r, _, _ = select.select([conn], [], [], 0.5)
-            if not r:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            have = os.fstat(fd).st_size
+            if have == 0 and os.path.isfile(self.path):
+                have = copy_into(self.path, fd, min(os.path.getsize(self.path), self.size))
+            if have > self.size:
+                os.ftruncate(fd, self.size)
+            preallocate(fd, self.size)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def close(self):
+        self.refs -= 1
+        if self.refs > 0:
+            return
+        if part_files.get(self.path) is self:
+            del part_files[self.path]
+        self.ready.add_done_callback(lambda fut: self._close_fd())
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def open_part(filename, size):
+    path = os.path.abspath(filename)
+    part = part_files.get(path)
+    if part is not None and part.size != size:
+        return None
+    if part is None:
+        part = part_files[path] = PartFile(path, size)
+    part.refs += 1
+    return part
+
+
+class RangedUploadTransfer(UploadTransfer):
+    def __init__(self, part, offset, count, codec=None):
+        super().__init__(part, count, codec)
+        self.offset = offset
+        self.buffer = memoryview(bytearray(min(UPLOAD_BUFFER, count))) if codec is None else None
+
+    def write(self, data):
+        write_at(self.f.fd, data, self.offset)
+        self.offset += len(data)
+
+    def recv_into(self, conn, limit=UPLOAD_BUFFER):
+        n = conn.recv_into(self.buffer, min(len(self.buffer), self.remaining, limit))
+        if n:
+            self.write(self.buffer[:n])
+            self.remaining -= n
+            self.received += n
+        return n
+
+    def on_complete(self, sess):
+        sess.sendall(f"DONE {self.received}\n".encode())
+
+
+class LineCollector:
+    def __init__(self, count, on_lines):
+        self.count = count
+        self.lines = []
+        self.on_lines = on_lines
+
+    def on_data(self, reader):
+        progressed = False
+        while len(self.lines) < self.count:
+            line = reader.pop_line()
+            if line is None:
+                break
+            self.lines.append(line)
+            progressed = True
+        return progressed
+
+    def done(self):
+        return len(self.lines) >= self.count
+
+    def on_complete(self, sess):
+        self.on_lines(sess, self.lines)
+
+    def close(self):
+        pass
+
+
+class MultiDownloadTransfer:
+    direction = 'send'
+
+    def __init__(self, entries, codec=None):
+        self.entries = deque(entries)
+        self.codec = codec
+        self.current = None
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    def on_writable(self, sess, limit=SENDFILE_CHUNK):
+        if self.current is None:
+            if not self.entries:
+                sess.sendall(b"END\n")
+                return True
+            idx, path, offset = self.entries.popleft()
+            try:
+                f = file_cache.acquire(path)
+            except OSError:
+                sess.sendall(f"ENTRY {idx} ERROR\n".encode())
+                return False
+            size = f.size
+            offset = min(offset, size)
+            file_cache.served(size - offset)
+            sess.sendall(f"ENTRY {idx} {size} {offset}\n".encode())
+            self.files += 1
+            self.bytes += size - offset
+            if offset >= size:
+                f.close()
+            elif self.codec:
+                self.current = CompressedDownloadTransfer(f, offset, size - offset, self.codec)
+            else:
+                self.current = DownloadTransfer(f, offset, size - offset)
+            return False
+        if self.current.on_writable(sess, limit):
+            self.current.f.close()
+            self.current = None
+        return False
+
+    def close(self):
+        if self.current is not None:
+            self.current.f.close()
+        observe_transfer('download', self.bytes, self.started)
+        print(f"MGET: sent {self.files} files, {self.bytes} bytes")
+
+
+class MultiUploadTransfer:
+    direction = 'recv'
+
+    def __init__(self, paths, codec=None):
+        self.paths = paths
+        self.codec = codec
+        self.current = None
+        self.finished = False
+        self.files = 0
+
+    def on_data(self, reader):
+        progressed = False
+        while not self.finished:
+            if self.current is not None and self.current.done():
+                self.current.close()
+                self.current = None
+            if self.current is None:
+                line = reader.pop_line()
+                if line is None:
+                    break
+                progressed = True
+                parts = line.split()
+                if parts[0] == 'END':
+                    self.finished = True
+                    break
+                path = self.paths[int(parts[1])]
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.current = UploadTransfer(open(path, 'ab'), int(parts[2]), self.codec)
+                self.files += 1
                 continue
-            char = conn.recv(1)
-            if not char:
-                return None
-            line += char
-            if char == b'\n':
-                return line.decode('utf-8', errors='ignore').strip()
-        except:
-            return None
-    return None
+            if not reader or not self.current.on_data(reader):
+                break
+            progressed = True
+        return progressed
+
+    def done(self):
+        return self.finished
+
+    def on_complete(self, sess):
+        sess.sendall(f"OK {self.files}\n".encode())
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+
+
+class BackgroundJob:
+    def __init__(self, sess, fn, on_done):
+        self.on_done = on_done
+        self.future = executor.submit(fn)
+        self.future.add_done_callback(lambda fut: self._complete(sess))
+
+    def _complete(self, sess):
+        completions.put((sess, self))
+        try:
+            wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def close(self):
+        self.future.cancel()
+
+
+class PartWait(BackgroundJob):
+    """Waits for a PartFile to be seeded and preallocated; the part may be shared with other sessions."""
+
+    def __init__(self, sess, part, on_done):
+        self.part = part
+        self.on_done = on_done
+        self.future = part.ready
+        self.future.add_done_callback(lambda fut: self._complete(sess))
+
+    def close(self):
+        self.part.close()
+
+
+def run_completions():
+    try:
+        while wake_r.recv(4096):
+            pass
+    except (BlockingIOError, InterruptedError):
+        pass
+    while not completions.empty():
+        sess, job = completions.get()
+        if sess.transfer is not job:
+            continue
+        sess.transfer = None
+        sess.last_active = time.monotonic()
+        try:
+            job.on_done(sess, job.future)
+            process_input(sess)
+            update_interest(sess)
+        except Exception:
+            close_session(sess)
 
 
-def handle_echo(conn, args):
+def handle_echo(sess, args):
     msg = " ".join(args) + "\n"
-    conn.sendall(msg.encode())
+    sess.sendall(msg.encode())
 
 
-def handle_time(conn):
+def handle_time(sess):
     time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\n"
-    conn.sendall(time_str.encode())
+    sess.sendall(time_str.encode())
 
 
-def handle_download(conn, args):
+def handle_download(sess, args):
+    args, offered = split_option(args)
+    codec = choose(offered)
     if len(args) < 2:
-        conn.sendall(b"ERROR invalid arguments\n")
+        sess.sendall(b"ERROR invalid arguments\n")
         return
     filename, offset_str = args[0], args[1]
 
     try:
         offset = int(offset_str)
-        if not os.path.exists(filename) or not os.path.isfile(filename):
-            conn.sendall(b"ERROR file not found\n")
+        end = int(args[2]) if len(args) > 2 else None
+        try:
+            f = file_cache.acquire(filename)
+        except OSError:
+            sess.sendall(b"ERROR file not found\n")
             return
 
-        filesize = os.path.getsize(filename)
-        conn.sendall(f"OK {filesize}\n".encode())
+        filesize = f.size
+        end = filesize if end is None else min(end, filesize)
+        sess.sendall(f"OK {filesize}{option(codec)}\n".encode())
 
-        if offset >= filesize:
+        if offset >= end:
+            f.close()
             return
 
-        with open(filename, 'rb') as f:
-            f.seek(offset)
-            while running:
-                chunk = f.read(4096)
-                if not chunk:
-                    break
-                conn.sendall(chunk)
+        file_cache.served(end - offset)
+        if codec:
+            sess.transfer = CompressedDownloadTransfer(f, offset, end - offset, codec)
+        else:
+            sess.transfer = DownloadTransfer(f, offset, end - offset)
     except Exception as e:
         pass
 
 
-def handle_upload(conn, args):
+def handle_upload(sess, args):
+    args, offered = split_option(args)
+    codec = choose(offered)
     if len(args) < 2:
-        conn.sendall(b"ERROR invalid arguments\n")
+        sess.sendall(b"ERROR invalid arguments\n")
         return
     filename, filesize_str = args[0], args[1]
 
     try:
         filesize = int(filesize_str)
+        if len(args) > 3:
+            handle_ranged_upload(sess, filename, filesize, int(args[2]), int(args[3]), codec)
+            return
         offset = os.path.getsize(filename) if os.path.exists(filename) else 0
 
-        conn.sendall(f"OK {offset}\n".encode())
+        sess.sendall(f"OK {offset}{option(codec)}\n".encode())
 
         if offset >= filesize:
             return
 
-        remaining = filesize - offset
-        with open(filename, 'ab') as f:
-            while remaining > 0 and running:
-                r, _, _ = select.select([conn], [], [], 0.5)
-                if not r:
-                    continue
-                chunk = conn.recv(min(4096, remaining))
-                if not chunk:
-                    break
-                f.write(chunk)
-                remaining -= len(chunk)
+        sess.transfer = UploadTransfer(open(filename, 'ab'), filesize - offset, codec)
     except Exception as e:
         pass
 
 
-def process_client(conn, addr):
-    global current_conn
-    current_conn = conn
-    print(f"Client connected: {addr}")
-    conn.settimeout(None)
+def handle_ranged_upload(sess, filename, filesize, start, end, codec=None):
+    if not (0 <= start <= end <= filesize):
+        sess.sendall(b"ERROR invalid range\n")
+        return
+    part = open_part(filename, filesize)
+    if part is None:
+        sess.sendall(b"ERROR upload in progress with another size\n")
+        return
+
+    def on_done(sess, future):
+        if future.exception() is not None:
+            part.close()
+            sess.sendall(b"ERROR cannot create file\n")
+            return
+        sess.sendall(f"OK {start}{option(codec)}\n".encode())
+        if start >= end:
+            part.close()
+            sess.sendall(b"DONE 0\n")
+            return
+        sess.transfer = RangedUploadTransfer(part, start, end - start, codec)
+
+    sess.transfer = PartWait(sess, part, on_done)
+
+
+def handle_commit(sess, args):
     try:
-        while running:
-            data = read_line(conn)
-            if data is None:
-                break
+        filename, filesize = args[0], int(args[1])
+    except (IndexError, ValueError):
+        sess.sendall(b"ERROR invalid arguments\n")
+        return
+    if os.path.abspath(filename) in part_files:
+        sess.sendall(b"ERROR upload in progress\n")
+        return
+    tmp = filename + PART_SUFFIX
+    if not os.path.isfile(tmp) or os.path.getsize(tmp) != filesize:
+        sess.sendall(b"ERROR no staged upload\n")
+        return
+
+    def commit():
+        fd = os.open(tmp, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, filename)
+
+    def on_done(sess, future):
+        if future.exception() is not None:
+            sess.sendall(b"ERROR commit failed\n")
+            return
+        sess.sendall(f"OK {filesize}\n".encode())
+
+    sess.transfer = BackgroundJob(sess, commit, on_done)
+
+
+def handle_hashes(sess, args):
+    if len(args) < 1:
+        sess.sendall(b"ERROR invalid arguments\n")
+        return
+    filename = args[0]
+
+    try:
+        block_size = clamp_block_size(int(args[1])) if len(args) > 1 else DIGEST_BLOCK_SIZE
+    except ValueError:
+        sess.sendall(b"ERROR invalid arguments\n")
+        return
+    if not os.path.isfile(filename):
+        sess.sendall(b"ERROR file not found\n")
+        return
+
+    def on_done(sess, future):
+        try:
+            size, digests = future.result()
+        except Exception:
+            sess.sendall(b"ERROR cannot read file\n")
+            return
+        sess.sendall(f"OK {size} {block_size} {len(digests)}\n".encode() + b''.join(digests))
 
-            parts = data.split()
-            if not parts:
+    sess.transfer = BackgroundJob(sess, lambda: digest_index.get(filename, block_size), on_done)
+
+
+def list_files(root):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
                 continue
+            rel = os.path.relpath(path, root).replace(os.sep, '/')
+            entries.append(f"{size} {quote(rel)}\n")
+    return entries
 
-            cmd = parts[0].upper()
-            if cmd == 'ECHO':
-                handle_echo(conn, parts[1:])
-            elif cmd == 'TIME':
-                handle_time(conn)
-            elif cmd in ('CLOSE', 'EXIT', 'QUIT'):
-                break
-            elif cmd == 'DOWNLOAD':
-                handle_download(conn, parts[1:])
-            elif cmd == 'UPLOAD':
-                handle_upload(conn, parts[1:])
-            else:
-                conn.sendall(b"UNKNOWN COMMAND\n")
-    except ConnectionResetError:
-        pass
-    except Exception:
+
+def handle_list(sess, args):
+    root = args[0] if args else '.'
+    if not os.path.isdir(root):
+        sess.sendall(b"ERROR not a directory\n")
+        return
+
+    def on_done(sess, future):
+        try:
+            entries = future.result()
+        except Exception:
+            sess.sendall(b"ERROR cannot list directory\n")
+            return
+        sess.sendall(f"OK {len(entries)}\n{''.join(entries)}".encode())
+
+    sess.transfer = BackgroundJob(sess, lambda: list_files(root), on_done)
+
+
+def handle_mget(sess, args):
+    args, offered = split_option(args)
+    codec = choose(offered)
+    try:
+        count = int(args[0])
+    except (IndexError, ValueError):
+        sess.sendall(b"ERROR invalid arguments\n")
+        return
+
+    def on_lines(sess, lines):
+        entries = []
+        for idx, line in enumerate(lines):
+            parts = line.split()
+            entries.append((idx, unquote(parts[0]), int(parts[1]) if len(parts) > 1 else 0))
+        sess.sendall(f"OK {len(entries)}{option(codec)}\n".encode())
+        sess.transfer = MultiDownloadTransfer(entries, codec)
+
+    sess.transfer = LineCollector(count, on_lines)
+
+
+def handle_mput(sess, args):
+    args, offered = split_option(args)
+    codec = choose(offered)
+    try:
+        count = int(args[0])
+    except (IndexError, ValueError):
+        sess.sendall(b"ERROR invalid arguments\n")
+        return
+
+    def on_lines(sess, lines):
+        paths, offsets = [], []
+        for line in lines:
+            parts = line.split()
+            path = unquote(parts[0])
+            paths.append(path)
+            offsets.append(f"{os.path.getsize(path) if os.path.isfile(path) else 0}\n")
+        sess.sendall(f"OK {len(paths)}{option(codec)}\n{''.join(offsets)}".encode())
+        sess.transfer = MultiUploadTransfer(paths, codec)
+
+    sess.transfer = LineCollector(count, on_lines)
+
+
+def handle_stats(sess, args):
+    if args and args[0].upper() == 'ALL' and cluster_snapshot is not None:
+        sess.sendall(f"OK {metrics_summary(cluster_snapshot)}\n".encode())
+        return
+    prefix = f"worker={worker_id} " if worker_id is not None else ""
+    sess.sendall(f"OK {prefix}{metrics.summary()}\n".encode())
+
+
+def push_stats(link):
+    global reported_transfers
+    reported_transfers = {d: scheduler.active(d) for d in DIRECTIONS}
+    try:
+        link.sendall(json.dumps(metrics.snapshot()).encode() + b'\n')
+    except OSError:
         pass
+
+
+def read_cluster_stats(reader):
+    global cluster_snapshot
+    if not reader.fill():
+        return False
+    while True:
+        line = reader.pop_line()
+        if line is None:
+            return True
+        try:
+            cluster_snapshot = json.loads(line)
+        except ValueError:
+            continue
+        share_rate(cluster_snapshot)
+
+
+def share_rate(snapshot):
+    # The supervisor answers each push with the sum over all workers, ours included as just reported
+    for metric in snapshot:
+        if metric['name'] != 'shaped_transfers':
+            continue
+        for key, value in metric['samples']:
+            direction = dict(tuple(pair) for pair in key).get('direction')
+            if direction in reported_transfers:
+                scheduler.set_peers(direction, max(0, value - reported_transfers[direction]))
+
+
+def process_client(sess, data):
+    parts = data.split()
+    sess.tag = None
+    if parts and parts[0].startswith('#'):
+        sess.tag = parts.pop(0)
+    if not parts:
+        return
+
+    cmd = parts[0].upper()
+    label = cmd if cmd in COMMANDS else 'UNKNOWN'
+    sess.unanswered.append((label, time.perf_counter()))
+    try:
+        dispatch(sess, cmd, parts)
     finally:
-        print(f"Client disconnected: {addr}")
+        commands_total.inc(command=label)
+
+
+def observe_answered(sess):
+    # A reply is out once outbuf is flushed and nothing is still producing it: no background
+    # job (HASHES, LIST, MGET's file list) and no file data of DOWNLOAD/MGET left to send
+    if not sess.unanswered or sess.outbuf:
+        return
+    if sess.transfer is not None and getattr(sess.transfer, 'direction', None) != 'recv':
+        return
+    now = time.perf_counter()
+    for label, started in sess.unanswered:
+        command_latency.observe(now - started, command=label)
+    sess.unanswered.clear()
+
+
+def dispatch(sess, cmd, parts):
+    if cmd == 'ECHO':
+        handle_echo(sess, parts[1:])
+    elif cmd == 'TIME':
+        handle_time(sess)
+    elif cmd in ('CLOSE', 'EXIT', 'QUIT'):
+        sess.closing = True
+    elif cmd == 'DOWNLOAD':
+        handle_download(sess, parts[1:])
+    elif cmd == 'UPLOAD':
+        handle_upload(sess, parts[1:])
+    elif cmd == 'COMMIT':
+        handle_commit(sess, parts[1:])
+    elif cmd == 'HASHES':
+        handle_hashes(sess, parts[1:])
+    elif cmd == 'CACHE':
+        sess.sendall(("OK " + " ".join(f"{k}={v}" for k, v in file_cache.stats().items()) + "\n").encode())
+    elif cmd == 'STATS':
+        handle_stats(sess, parts[1:])
+    elif cmd == 'LIST':
+        handle_list(sess, parts[1:])
+    elif cmd == 'MGET':
+        handle_mget(sess, parts[1:])
+    elif cmd == 'MPUT':
+        handle_mput(sess, parts[1:])
+    else:
+        sess.sendall(b"UNKNOWN COMMAND\n")
+
+
+def process_input(sess):
+    while not sess.closing:
+        if hasattr(sess.transfer, 'on_data'):
+            transfer = sess.transfer
+            if not transfer.done():
+                if not sess.reader or not transfer.on_data(sess.reader):
+                    return
+            if transfer.done():
+                finish_transfer(sess)
+                if hasattr(transfer, 'on_complete'):
+                    transfer.on_complete(sess)
+            continue
+        if sess.transfer is not None:
+            return
+        line = sess.reader.pop_line()
+        if line is None:
+            return
+        process_client(sess, line)
+
+
+def finish_transfer(sess):
+    scheduler.stop(sess)
+    if sess.transfer is not None:
         try:
-            conn.close()
+            sess.transfer.close()
         except:
             pass
-        current_conn = None
+        sess.transfer = None
 
 
-def start_server():
-    global running
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+def update_interest(sess):
+    paused = sess.resume_timer is not None
+    events = selectors.EVENT_READ
+    if paused and getattr(sess.transfer, 'direction', None) == 'recv':
+        events = 0
+    if sess.outbuf or (hasattr(sess.transfer, 'on_writable') and not paused):
+        events |= selectors.EVENT_WRITE
+    if events != sess.events:
+        if not events:
+            sel.unregister(sess.conn)
+        elif not sess.events:
+            sel.register(sess.conn, events, sess)
+        else:
+            sel.modify(sess.conn, events, sess)
+        sess.events = events
+
 
+def on_readable(sess):
+    transfer = sess.transfer
+    limit = None
+    if getattr(transfer, 'direction', None) == 'recv' and not transfer.done():
+        limit = shape(sess, 'recv', UPLOAD_BUFFER)
+        if not limit:
+            return True
+    if hasattr(transfer, 'recv_into') and transfer.codec is None and not sess.reader and not transfer.done():
+        received = transfer.recv_into(sess.conn, limit)
+    else:
+        received = sess.reader.fill(limit and min(limit, RECV_SIZE))
+    if not received:
+        return False
+    bytes_received_total.inc(received)
+    if limit is not None:
+        scheduler.consume(sess, received)
+    process_input(sess)
+    return True
+
+
+def on_writable(sess):
+    if sess.outbuf:
+        sent = sess.conn.send(sess.outbuf)
+        bytes_sent_total.inc(sent)
+        scheduler.charge('send', sent)
+        del sess.outbuf[:sent]
+        return True
+    if hasattr(sess.transfer, 'on_writable'):
+        limit = shape(sess, 'send', SENDFILE_CHUNK)
+        if not limit:
+            return True
+        if sess.transfer.on_writable(sess, limit):
+            finish_transfer(sess)
+            process_input(sess)
+    return True
+
+
+def accept_client(s):
+    try:
+        conn, addr = s.accept()
+    except (BlockingIOError, InterruptedError):
+        return
+    conn.setblocking(False)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sess = Session(conn, addr)
+    sessions[conn.fileno()] = sess
+    sessions_total.inc()
+    sess.events = selectors.EVENT_READ
+    sel.register(conn, sess.events, sess)
+    watch(sess, sess.last_active)
+    print(f"Client connected: {addr}")
+
+
+def close_session(sess):
+    sessions.pop(sess.conn.fileno(), None)
+    for timer in (sess.watchdog, sess.resume_timer):
+        if timer is not None:
+            timer.cancel()
+    finish_transfer(sess)
+    print(f"Client disconnected: {sess.addr}")
+    try:
+        sel.unregister(sess.conn)
+    except Exception:
+        pass
+    try:
+        sess.conn.close()
+    except:
+        pass
+
+
+def lane(event):
+    sess = event[0].data
+    return 1 if isinstance(sess, Session) and hasattr(sess.transfer, 'direction') else 0
+
+
+def service_session(sess, mask):
+    sess.last_active = time.monotonic()
+    try:
+        if mask & selectors.EVENT_READ:
+            if not on_readable(sess):
+                close_session(sess)
+                return
+        if mask & selectors.EVENT_WRITE or sess.outbuf:
+            on_writable(sess)
+        observe_answered(sess)
+        if sess.closing and not sess.outbuf:
+            close_session(sess)
+            return
+        update_interest(sess)
+    except (BlockingIOError, InterruptedError):
+        update_interest(sess)
+    except ConnectionResetError:
+        close_session(sess)
+    except Exception:
+        close_session(sess)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="LAB_1 TCP file server")
+    parser.add_argument('--port', type=int, help="port to listen on (asked interactively when omitted)")
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BUDGET // (1024 * 1024),
+                        help="memory budget of the mmap hot-file cache in MB (per worker)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on 127.0.0.1:<port>/metrics")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="fork this many worker processes sharing the port through SO_REUSEPORT")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="close sessions with nothing in progress after this many quiet seconds (0 = never)")
+    parser.add_argument('--stall-timeout', type=float, default=STALL_TIMEOUT,
+                        help="close sessions whose transfer made no progress for this many seconds (0 = never)")
+    parser.add_argument('--max-rate', type=float, default=0,
+                        help="total transfer rate per direction in MB/s (0 = unlimited); with --workers each "
+                             "worker takes the part matching its share of the running transfers, rebalanced "
+                             "every second")
+    parser.add_argument('--client-rate', type=float, default=0,
+                        help="transfer rate per client IP and direction in MB/s (0 = unlimited); with --workers "
+                             "each worker limits the connections it accepted on its own, so a client whose "
+                             "connections land on N workers can reach N times this rate")
+    parser.add_argument('--weight', action='append', default=[], metavar='IP=W',
+                        help="fair-share weight of a client IP under --max-rate (default 1)")
+    return parser.parse_args()
+
+
+def resolve_port(args):
+    if args.port is not None:
+        potential_port = str(args.port)
+    else:
+        print("Enter port for server (default 9090): ")
+        potential_port = input().strip()
+    if not potential_port:
+        return PORT
+    try:
+        port = int(potential_port)
+        if not (0 <= port <= 65535):
+            raise ValueError("Port out of range")
+        return port
+    except ValueError:
+        print("Invalid input! Using default port.")
+        return PORT
+
+
+def open_listener(port, reuse_port=False):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     setup_keepalive(s)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((HOST, port))
+    s.listen(BACKLOG)
+    s.setblocking(False)
+    return s
 
-    print("Enter port for server (default 9090): ")
-    potential_port = input().strip()
-    port = PORT
-    if not potential_port:
-        s.bind((HOST, PORT))
-    else:
-        try:
-            port = int(potential_port)
-            if not (0 <= port <= 65535):
-                raise ValueError("Port out of range")
-            s.bind((HOST, port))
-        except ValueError:
-            print("Invalid input! Using default port.")
-            s.bind((HOST, PORT))
 
-    s.listen(1)
-    s.settimeout(0.5)
-
-    local_ip = get_local_ip()
-    print(f"Server is listening on 0.0.0.0:{port}")
-    print(f"Your Local IP for client to connect: {local_ip}")
+def serve(s, link=None):
+    sel.register(s, selectors.EVENT_READ, None)
+    wake_r.setblocking(False)
+    wake_w.setblocking(False)
+    sel.register(wake_r, selectors.EVENT_READ, run_completions)
+    link_reader = None
+    if link is not None:
+        link_reader = StreamReader(link)
+        sel.register(link, selectors.EVENT_READ, read_cluster_stats)
+    next_push = 0
+    deadline = None
 
     try:
         while running:
+            now = time.monotonic()
+            if draining:
+                if deadline is None:
+                    deadline = now + DRAIN_TIMEOUT
+                    sel.unregister(s)
+                    s.close()
+                    s = None
+                    print(f"Draining {len(sessions)} sessions (signal again to stop now)...")
+                for sess in list(sessions.values()):
+                    if sess.transfer is None and not sess.outbuf:
+                        close_session(sess)
+                if not sessions or now > deadline:
+                    break
+            if link is not None and now >= next_push:
+                push_stats(link)
+                next_push = now + STATS_INTERVAL
             try:
-                conn, addr = s.accept()
-                if running:
-                    process_client(conn, addr)
-            except socket.timeout:
+                events = sel.select(timeout=timers.timeout(0.5, now))
+            except InterruptedError:
                 continue
-            except Exception as e:
-                if running:
-                    print(f"Server error: {e}")
+            events.sort(key=lane)
+            for key, mask in events:
+                if key.data is None:
+                    accept_client(s)
+                elif key.data is run_completions:
+                    run_completions()
+                elif key.data is read_cluster_stats:
+                    if not read_cluster_stats(link_reader):
+                        sel.unregister(link)
+                        link = None
+                else:
+                    service_session(key.data, mask)
+            timers.advance()
+    except Exception as e:
+        if running:
+            print(f"Server error: {e}")
     finally:
         print("\nShutting down server...")
-        if current_conn:
-            try:
-                current_conn.close()
-            except:
-                pass
-        s.close()
+        for sess in list(sessions.values()):
+            close_session(sess)
+        if s is not None:
+            sel.unregister(s)
+            s.close()
+        executor.shutdown(wait=False)
+        file_cache.clear()
         print("Server stopped")
 
 
+def run_worker(wid, link, port):
+    global sel, wake_r, wake_w, worker_id
+    # Everything below was created before fork and would be shared with the other workers
+    sel.close()
+    wake_r.close()
+    wake_w.close()
+    sel = selectors.DefaultSelector()
+    wake_r, wake_w = socket.socketpair()
+    worker_id = wid
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal_handler)
+    serve(open_listener(port, reuse_port=True), link)
+
+
+def parse_weights(items):
+    weights = {}
+    for item in items:
+        ip, _, weight = item.partition('=')
+        try:
+            weights[ip] = max(0.01, float(weight))
+        except ValueError:
+            print(f"Ignoring bad weight {item!r}, expected IP=W")
+    return weights
+
+
+def start_server():
+    global scheduler
+    args = parse_args()
+    file_cache.budget = args.cache_mb * 1024 * 1024
+    port = resolve_port(args)
+    prefork = args.workers > 1
+    if prefork and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        print("Prefork mode needs fork() and SO_REUSEPORT; running a single process.")
+        prefork = False
+    workers = args.workers if prefork else 1
+    reap_after.update(idle=args.idle_timeout, stalled=args.stall_timeout)
+    # Workers share --max-rate through the supervisor's stats relay (share_rate); --client-rate stays
+    # per worker, since a client's connections may land on any of them
+    scheduler = Scheduler(args.max_rate * 1024 * 1024, args.client_rate * 1024 * 1024,
+                          parse_weights(args.weight))
+    if workers > 1 and args.client_rate:
+        print(f"Note: --client-rate is enforced per worker; a client spread over {workers} workers "
+              f"can reach up to {args.client_rate * workers:g} MB/s")
+
+    local_ip = get_local_ip()
+    if prefork:
+        aggregate = Aggregate(metrics.namespace)
+        if args.metrics_port is not None:
+            start_exporter(aggregate, args.metrics_port)
+            print(f"Metrics exported on http://127.0.0.1:{args.metrics_port}/metrics")
+        print(f"Server is listening on 0.0.0.0:{port} with {args.workers} workers")
+        print(f"Your Local IP for client to connect: {local_ip}")
+        supervise(args.workers, lambda wid, link: run_worker(wid, link, port), aggregate)
+        return
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    s = open_listener(port)
+
+    if args.metrics_port is not None:
+        start_exporter(metrics, args.metrics_port)
+        print(f"Metrics exported on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    print(f"Server is listening on 0.0.0.0:{port}")
+    print(f"Your Local IP for client to connect: {local_ip}")
+    serve(s)
+
+
 if __name__ == '__main__':
-    start_server()
\ No newline at end of file
+    start_server()
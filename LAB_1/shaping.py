@@ -0,0 +1,164 @@
+import time
+
+BURST_SECONDS = 0.05
+MIN_BURST = 64 * 1024
+QUANTUM = 256 * 1024
+MIN_DELAY = 0.001
+MIN_GRANT = 16 * 1024
+DIRECTIONS = ('send', 'recv')
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = 0.0
+        self.capacity = 0.0
+        self.set_rate(rate)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(MIN_BURST, self.rate * BURST_SECONDS)
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def available(self, now):
+        self.refill(now)
+        return int(self.tokens)
+
+    def consume(self, n):
+        self.tokens -= n
+
+    def delay(self, n, now):
+        self.refill(now)
+        missing = min(n, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 and self.rate > 0 else 0.0
+
+
+class Flow:
+    def __init__(self, client, direction):
+        self.client = client
+        self.direction = direction
+        self.weight = 1.0
+        self.bucket = None
+
+
+class Scheduler:
+    """Hierarchical token buckets: global rate, per-client rate, and a weighted fair share of the
+    global rate for every active transfer. Rates are bytes/s per direction, 0 means unlimited.
+
+    Control replies are never held back; they are charged to the global bucket so bulk transfers
+    pay for them.
+
+    Prefork workers share the global rate: each one takes the part of it matching its share of the
+    transfers running in the whole server, with the other workers' count reported via set_peers().
+    """
+
+    def __init__(self, rate=0, client_rate=0, weights=None, quantum=QUANTUM):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.weights = dict(weights or {})
+        self.quantum = quantum
+        self.buckets = {d: TokenBucket(rate) if rate else None for d in DIRECTIONS}
+        self.clients = {}
+        self.flows = {}
+        self.peers = dict.fromkeys(DIRECTIONS, 0)
+
+    @property
+    def enabled(self):
+        return bool(self.rate or self.client_rate)
+
+    def start(self, key, client, direction):
+        flow = self.flows.get(key)
+        if flow is not None and flow.direction == direction and flow.client == client:
+            return flow
+        if flow is not None:
+            self.stop(key)
+        flow = self.flows[key] = Flow(client, direction)
+        if self.client_rate:
+            entry = self.clients.get((client, direction))
+            if entry is None:
+                entry = self.clients[(client, direction)] = [TokenBucket(self.client_rate), 0]
+            entry[1] += 1
+        self._reshare(direction)
+        return flow
+
+    def stop(self, key):
+        flow = self.flows.pop(key, None)
+        if flow is None:
+            return
+        entry = self.clients.get((flow.client, flow.direction))
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.clients[(flow.client, flow.direction)]
+        self._reshare(flow.direction)
+
+    def set_peers(self, direction, count):
+        """Transfers in this direction running on the other workers."""
+        if self.peers[direction] != count:
+            self.peers[direction] = count
+            self._reshare(direction)
+
+    def share(self, direction):
+        """This process's part of the global rate."""
+        local = max(1, self.active(direction))
+        return self.rate * local / (local + self.peers[direction])
+
+    def _reshare(self, direction):
+        flows = [f for f in self.flows.values() if f.direction == direction]
+        per_client = {}
+        for flow in flows:
+            per_client[flow.client] = per_client.get(flow.client, 0) + 1
+        for flow in flows:
+            flow.weight = self.weights.get(flow.client, 1.0) / per_client[flow.client]
+        if not self.rate:
+            return
+        rate = self.share(direction)
+        self.buckets[direction].set_rate(rate)
+        total = sum(flow.weight for flow in flows)
+        for flow in flows:
+            share = rate * flow.weight / total
+            if flow.bucket is None:
+                flow.bucket = TokenBucket(share)
+            else:
+                flow.bucket.set_rate(share)
+
+    def _chain(self, flow):
+        chain = [self.buckets[flow.direction], flow.bucket]
+        entry = self.clients.get((flow.client, flow.direction))
+        if entry is not None:
+            chain.append(entry[0])
+        return [bucket for bucket in chain if bucket is not None]
+
+    def grant(self, key, want, now=None):
+        """Bytes the flow may move right now, and how long to wait when that is 0."""
+        flow = self.flows.get(key)
+        if flow is None or not self.enabled:
+            return want, 0.0
+        want = min(want, self.quantum)
+        now = time.monotonic() if now is None else now
+        chain = self._chain(flow)
+        allowed = min([want] + [bucket.available(now) for bucket in chain])
+        floor = min(want, MIN_GRANT)
+        if allowed >= floor:
+            return allowed, 0.0
+        return 0, max(MIN_DELAY, max(bucket.delay(floor, now) for bucket in chain))
+
+    def consume(self, key, n):
+        flow = self.flows.get(key)
+        if flow is None or not n:
+            return
+        for bucket in self._chain(flow):
+            bucket.consume(n)
+
+    def charge(self, direction, n):
+        bucket = self.buckets[direction]
+        if bucket is not None and n:
+            bucket.consume(n)
+
+    def active(self, direction):
+        return sum(1 for flow in self.flows.values() if flow.direction == direction)
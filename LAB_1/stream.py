@@ -0,0 +1,149 @@
+import errno
+import os
+import select
+import weakref
+
+BLOCK_SIZE = 65536
+SENDFILE_CHUNK = 8 * 1024 * 1024
+COPY_CHUNK = 262144
+SENDFILE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP)
+PART_SUFFIX = '.part'
+
+_readers = weakref.WeakKeyDictionary()
+
+
+class StreamReader:
+    """Per-connection receive buffer: pulls big blocks, hands out lines and raw bytes."""
+
+    def __init__(self, sock, block_size=BLOCK_SIZE):
+        self.sock = sock
+        self.block_size = block_size
+        self.buf = bytearray()
+        self.eof = False
+
+    def __len__(self):
+        return len(self.buf)
+
+    def fill(self, size=None):
+        data = self.sock.recv(size or self.block_size)
+        if not data:
+            self.eof = True
+        self.buf += data
+        return len(data)
+
+    def pop_line(self):
+        pos = self.buf.find(b'\n')
+        if pos < 0:
+            return None
+        line = bytes(self.buf[:pos + 1])
+        del self.buf[:pos + 1]
+        return line.decode('utf-8', errors='ignore').strip()
+
+    def take(self, n=None):
+        if n is None or n >= len(self.buf):
+            data = bytes(self.buf)
+            self.buf.clear()
+        else:
+            data = bytes(self.buf[:n])
+            del self.buf[:n]
+        return data
+
+    def wait_readable(self, keep_going=None):
+        while keep_going is None or keep_going():
+            r, _, _ = select.select([self.sock], [], [], 0.5)
+            if r:
+                return True
+        return False
+
+    def read_line(self, keep_going=None):
+        while True:
+            line = self.pop_line()
+            if line is not None:
+                return line
+            if self.eof or not self.wait_readable(keep_going):
+                return None
+            if not self.fill():
+                return None
+
+    def read(self, n, keep_going=None):
+        if self.buf:
+            return self.take(n)
+        if self.eof or not self.wait_readable(keep_going):
+            return b''
+        return self.sock.recv(min(n, self.block_size))
+
+    def readinto(self, view, keep_going=None):
+        if self.buf:
+            n = min(len(view), len(self.buf))
+            view[:n] = self.buf[:n]
+            del self.buf[:n]
+            return n
+        if self.eof or not self.wait_readable(keep_going):
+            return 0
+        return self.sock.recv_into(view)
+
+
+def reader_for(sock, block_size=BLOCK_SIZE):
+    reader = _readers.get(sock)
+    if reader is None:
+        reader = StreamReader(sock, block_size)
+        _readers[sock] = reader
+    return reader
+
+
+def send_file_chunk(sock, f, offset, count, kernel=True):
+    """Send up to count bytes of f starting at offset; returns (sent, went_through_sendfile)."""
+    if kernel and hasattr(os, 'sendfile'):
+        try:
+            return os.sendfile(sock.fileno(), f.fileno(), offset, count), True
+        except OSError as e:
+            if isinstance(e, (BlockingIOError, InterruptedError)) or e.errno not in SENDFILE_UNSUPPORTED:
+                raise
+    if hasattr(f, 'view'):
+        return sock.send(f.view[offset:offset + min(count, COPY_CHUNK)]), False
+    f.seek(offset)
+    data = f.read(min(count, COPY_CHUNK))
+    if not data:
+        return 0, False
+    return sock.send(data), False
+
+
+def preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+def write_at(fd, data, pos):
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, pos)
+            data = data[written:]
+            pos += written
+    else:
+        os.lseek(fd, pos, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def copy_into(src, fd, size):
+    """Copy the first size bytes of path src into fd, in the kernel when copy_file_range is there."""
+    copied = 0
+    with open(src, 'rb') as f:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(f.fileno(), fd, size - copied, copied, copied)
+                    if not n:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        f.seek(copied)
+        while copied < size:
+            data = f.read(min(COPY_CHUNK * 4, size - copied))
+            if not data:
+                break
+            write_at(fd, data, copied)
+            copied += len(data)
+    return copied
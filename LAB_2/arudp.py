@@ -0,0 +1,265 @@
+import asyncio
+import socket
+import time
+
+import congestion
+from rudp import (RUDPConnection, MessageReceiver, MessageSender, BulkSender, StreamReceiver,
+                  TYPE_SYN, TYPE_ACK, TYPE_DATA, TYPE_FIN)
+
+HANDSHAKE_TIMEOUT = 0.3
+HANDSHAKE_RETRIES = 10
+RCVBUF = 16 * 1024 * 1024
+
+
+class _TransportSocket:
+    """RUDPConnection от сокета нужен только sendto - отдаем его через транспорт asyncio"""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def setblocking(self, flag):
+        pass
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+class _Run:
+    """Ведет машину состояний из rudp в цикле событий: пакеты приходят из datagram_received,
+    таймаут - через loop.call_later. Когда дедлайн отодвигается (обычно на каждом ACK), таймер
+    не перевзводится: он сработает раньше и просто поставит себя заново"""
+
+    def __init__(self, loop, machine):
+        self.loop = loop
+        self.machine = machine
+        self.future = loop.create_future()
+        self.handle = None
+        self.armed = None
+
+    def start(self):
+        self.step(self.machine.start, time.monotonic())
+        return self.future
+
+    def step(self, method, *args):
+        try:
+            method(*args)
+        except Exception as e:
+            self.fail(e)
+            return
+        self.update()
+
+    def update(self):
+        machine = self.machine
+        if machine.done:
+            self.finish()
+        elif self.armed is None or machine.deadline < self.armed:
+            if self.handle is not None:
+                self.handle.cancel()
+            self.armed = machine.deadline
+            self.handle = self.loop.call_later(max(0.0, machine.deadline - time.monotonic()), self._fire)
+
+    def _fire(self):
+        self.handle = None
+        self.armed = None
+        now = time.monotonic()
+        if now >= self.machine.deadline:
+            self.step(self.machine.on_timeout, now)
+        else:
+            self.update()
+
+    def finish(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.machine.close()
+        if not self.future.done():
+            self.future.set_result(self.machine)
+
+    def fail(self, exc):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.machine.close()
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class RUDPProtocol(asyncio.DatagramProtocol):
+    """RUDP поверх loop.create_datagram_endpoint. Протокол и машины состояний те же, что у
+    блокирующего RUDPConnection, поэтому с сервером LAB_2 совместим полностью.
+
+    Одновременно может идти одна исходящая передача (сообщение или файл) и один прием файла;
+    входящие сообщения складываются в очередь. Без передач соединение не держит ни одного
+    таймера и не занимает процессор."""
+
+    def __init__(self, addr, cc=congestion.DEFAULT):
+        self.addr = addr
+        self.cc = cc
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.conn = None
+        self.receiver = None
+        self.sending = None     # _Run исходящей передачи
+        self.stream = None      # _Run приема файла
+        self.handshake = None
+        self.messages = asyncio.Queue()
+        self.closed = None      # ConnectionResetError, когда пир закрыл соединение
+        self.trailing_fin = None    # номер FIN после последнего принятого файла: хвост, не закрытие
+        self.lock = asyncio.Lock()
+
+    @property
+    def stats(self):
+        return self.conn.stats
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn = RUDPConnection(_TransportSocket(transport), self.addr, self.cc)
+        self.receiver = MessageReceiver(self.conn)
+
+    def datagram_received(self, data, addr):
+        if addr != self.addr: return
+        packet = self.conn.parse(data)
+        if packet is None: return
+        seq, type_val, payload = packet
+        if type_val == TYPE_ACK and self.handshake is not None:
+            if not self.handshake.done(): self.handshake.set_result(True)
+            return
+        now = time.monotonic()
+        if type_val == TYPE_DATA:
+            if self.stream is not None:
+                self.stream.step(self.stream.machine.on_packet, seq, type_val, payload, now)
+            else:
+                message = self.receiver.on_data(seq, payload)
+                if message is not None: self.messages.put_nowait(message)
+        elif type_val == TYPE_ACK:
+            if self.sending is not None:
+                self.sending.step(self.sending.machine.on_packet, seq, type_val, payload, now)
+        elif type_val == TYPE_FIN:
+            # FIN в конце файла закрывает прием; иначе пир закрыл соединение
+            if self.stream is not None:
+                self.stream.step(self.stream.machine.on_packet, seq, type_val, payload, now)
+            elif seq != self.trailing_fin and (self.handshake is None or self.handshake.done()):
+                self._reset(ConnectionResetError("Closed"))
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        self._reset(exc or ConnectionResetError("Closed"))
+
+    def _reset(self, exc):
+        if self.closed is None:
+            self.closed = exc
+        for run in (self.sending, self.stream):
+            if run is not None: run.fail(exc)
+        self.messages.put_nowait(None)
+
+    async def _run(self, slot, machine):
+        if self.closed is not None: raise self.closed
+        run = _Run(self.loop, machine)
+        setattr(self, slot, run)
+        try:
+            return await run.start()
+        finally:
+            setattr(self, slot, None)
+            run.finish()
+
+    async def _handshake(self, timeout):
+        self.handshake = self.loop.create_future()
+        try:
+            for _ in range(HANDSHAKE_RETRIES):
+                self.conn.send_packet(0, TYPE_SYN, self.cc.encode())
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.handshake), timeout)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+            raise ConnectionRefusedError(f"No answer from {self.addr[0]}:{self.addr[1]}")
+        finally:
+            self.handshake = None
+
+    async def send(self, data):
+        """Надежно отправить одно сообщение; возвращается, когда пир подтвердил все пакеты"""
+        await self._run('sending', MessageSender(self.conn, data))
+
+    async def recv(self, timeout=None):
+        """Следующее входящее сообщение; None по таймауту или после закрытия"""
+        if self.closed is not None and self.messages.empty(): return None
+        try:
+            message = await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is None:
+            self.messages.put_nowait(None)
+        return message
+
+    async def request(self, line, timeout=5.0):
+        """Команда серверу и его ответ одной строкой"""
+        async with self.lock:
+            return await self._request(line, timeout)
+
+    async def _request(self, line, timeout):
+        # Как flush в блокирующем клиенте: сообщения до команды - повторы прошлых ответов,
+        # которые сервер переслал, не дождавшись нашего ACK; номера в сообщениях с нуля,
+        # и от нового ответа их не отличить
+        while not self.messages.empty():
+            if self.messages.get_nowait() is None:
+                self.messages.put_nowait(None)
+                break
+        await self.send((line + "\n").encode())
+        resp = await self.recv(timeout)
+        if not resp: raise ConnectionResetError("No response")
+        return resp.decode().strip()
+
+    async def send_file(self, filename):
+        """Отдать файл пиру, который ждет его в recv_to_file"""
+        return not (await self._run('sending', BulkSender(self.conn, filename))).failed
+
+    async def recv_to_file(self, filename, size, progress_callback=None):
+        """Принять size байт от BulkSender пира в файл"""
+        machine = await self._run('stream', StreamReceiver(self.conn, filename, size, progress_callback))
+        # Отправитель шлет несколько FIN после файла, остальные придут уже после нас
+        self.trailing_fin = machine.expected_seq
+        return size
+
+    async def download(self, name, filename=None, progress_callback=None):
+        """DOWNLOAD с сервером LAB_2: размер, READY и сам файл; возвращает размер"""
+        async with self.lock:
+            resp = await self._request(f"DOWNLOAD {name}", 5.0)
+            if not resp.startswith("OK"): raise FileNotFoundError(resp)
+            size = int(resp.split()[1])
+            # Прием ставим до READY: данные пойдут сразу за ACK на него
+            receive = asyncio.ensure_future(self.recv_to_file(filename or name, size, progress_callback))
+            await asyncio.sleep(0)
+            try:
+                await self.send(b"READY\n")
+            except BaseException:
+                receive.cancel()
+                raise
+            return await receive
+
+    def close(self):
+        if self.transport is None or self.transport.is_closing(): return
+        if self.closed is None:
+            self.conn.send_packet(0, TYPE_FIN)
+        self.transport.close()
+
+
+async def connect(host, port, cc=congestion.DEFAULT, timeout=HANDSHAKE_TIMEOUT):
+    """Открыть RUDP-соединение с сервером LAB_2 (SYN/ACK, алгоритм cc просим в SYN)"""
+    loop = asyncio.get_running_loop()
+    family, _, _, _, addr = (await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM))[0]
+    addr = addr[:2]
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    # Окно отправителя - до 2 МБ за раз; со стандартным буфером ядро отбросит большую часть
+    try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+    except OSError: pass
+    sock.connect(addr)
+    _, protocol = await loop.create_datagram_endpoint(lambda: RUDPProtocol(addr, cc), sock=sock)
+    try:
+        await protocol._handshake(timeout)
+    except BaseException:
+        protocol.transport.close()
+        raise
+    return protocol
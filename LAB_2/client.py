@@ -2,19 +2,26 @@ import socket
 import sys
 import time
 import os
+import argparse
+import queue
+import threading
 from rudp import RUDPConnection, TYPE_SYN, TYPE_FIN
+import congestion
 
-def connect_udp(host, port):
+def connect_udp(host, port, cc=congestion.DEFAULT):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setblocking(0)
     try: s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024) # Еще больше буфер
     except: pass
     
-    conn = RUDPConnection(s, (host, port))
+    conn = RUDPConnection(s, (host, port), cc)
+    # Если сервер шлет пачками GSO, забираем их тоже пачками; без поддержки ядра - как раньше
+    conn.enable_gro()
     print(f"Connecting to {host}:{port}...")
     
     for _ in range(3):
-        conn.send_packet(0, TYPE_SYN)
+        # Тот же алгоритм просим у сервера: он управляет окном при скачивании
+        conn.send_packet(0, TYPE_SYN, cc.encode())
         # Маленькая пауза перед проверкой ACK для локальной сети
         time.sleep(0.1)
         # Проверяем неблокирующим чтением
@@ -41,7 +48,7 @@ def print_progress(current, total):
         sys.stdout.flush()
         print_progress.last_time = now
 
-def do_download(conn, filename):
+def do_download(conn, filename, progress=print_progress):
     conn.flush()
     print(f"Requesting {filename}...")
     conn.send_reliable_data(f"DOWNLOAD {filename}\n".encode())
@@ -49,15 +56,15 @@ def do_download(conn, filename):
     resp = conn.recv_reliable_data(timeout=5.0)
     if not resp:
         print("No response.")
-        return
+        return False
         
     msg = resp.decode().strip()
     if not msg.startswith('OK'):
         print(f"Server: {msg}")
-        return
+        return False
         
     try: filesize = int(msg.split()[1])
-    except: return
+    except: return False
 
     print(f"Size: {filesize/1024/1024:.2f} MB. Starting...")
     
@@ -67,25 +74,49 @@ def do_download(conn, filename):
     
     start = time.time()
     try:
-        conn.recv_stream_to_file(filename, filesize, progress_callback=print_progress)
-        print() 
+        conn.recv_stream_to_file(filename, filesize, progress_callback=progress)
+        if progress is not None: print()
     except Exception as e:
         print(f"\nStopped: {e}")
     
     duration = time.time() - start
+    # После передачи сервер шлет несколько FIN подряд: ждем и выбрасываем их,
+    # иначе следующая команда примет их за закрытие соединения
+    time.sleep(0.05)
+    conn.flush()
     
     if os.path.exists(filename):
         actual = os.path.getsize(filename)
         if actual == filesize:
             mbps = (actual * 8) / (duration * 1024 * 1024) if duration > 0 else 0
             print(f"Done! {duration:.2f}s. Speed: {mbps:.2f} Mbps")
-        else:
-            print(f"\nFAILED! {actual}/{filesize} bytes.")
+            return True
+        print(f"\nFAILED! {actual}/{filesize} bytes.")
     else:
         print("File creation failed.")
+    return False
 
-def main_loop(host, port):
-    conn = connect_udp(host, port)
+def do_command(conn, cmd):
+    conn.send_reliable_data((cmd + "\n").encode())
+    resp = conn.recv_reliable_data(timeout=2.0)
+    if not resp:
+        print("No response.")
+        return False
+    msg = resp.decode().strip()
+    print(msg)
+    return not msg.startswith(('ERROR', 'UNKNOWN'))
+
+def run_command(conn, cmd, progress=print_progress):
+    parts = cmd.split()
+    if parts[0].lower() != 'download':
+        return do_command(conn, cmd)
+    if len(parts) < 2:
+        print("Usage: download <filename>")
+        return False
+    return do_download(conn, parts[1], progress)
+
+def main_loop(host, port, cc=congestion.DEFAULT):
+    conn = connect_udp(host, port, cc)
     if not conn:
         print("Connection failed.")
         return False
@@ -97,15 +128,7 @@ def main_loop(host, port):
             
             if cmd.lower() in ('exit', 'quit'): break
                 
-            if cmd.lower().startswith('download'):
-                parts = cmd.split()
-                if len(parts) > 1: do_download(conn, parts[1])
-                else: print("Usage: download <filename>")
-            else:
-                conn.send_reliable_data((cmd + "\n").encode())
-                resp = conn.recv_reliable_data(timeout=2.0)
-                if resp: print(resp.decode().strip())
-                else: print("No response.")
+            run_command(conn, cmd)
                 
     except (ConnectionResetError, socket.timeout):
         print("\nConnection lost.")
@@ -123,18 +146,117 @@ def main_loop(host, port):
 
     return True
 
+def load_manifest(path):
+    f = sys.stdin if path == '-' else open(path)
+    with f:
+        lines = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    for n, line in enumerate(lines):
+        if line.split()[0].lower() in ('exit', 'quit'):
+            return lines[:n]
+    return lines
+
+def run_headless(host, port, commands, parallel, cc=congestion.DEFAULT):
+    conns = []
+    for _ in range(max(1, min(parallel, len(commands)))):
+        conn = connect_udp(host, port, cc)
+        if not conn: break
+        conns.append(conn)
+    if not conns:
+        print("Connection failed.")
+        return 2
+
+    # Каждое соединение берет из общей очереди следующую команду; сервер ведет все сессии сразу
+    pending = queue.Queue()
+    for cmd in commands:
+        pending.put(cmd)
+    lock = threading.Lock()
+    failed = [0]
+    # Строку прогресса рисуем, только когда соединение одно - иначе потоки затирают ее друг другу
+    progress = print_progress if len(conns) == 1 else None
+
+    def runner(conn):
+        while True:
+            try: cmd = pending.get_nowait()
+            except queue.Empty: return
+            ok = False
+            try:
+                ok = run_command(conn, cmd, progress)
+            except (ConnectionResetError, socket.timeout) as e:
+                print(f"Connection lost: {e}")
+            with lock:
+                if not ok:
+                    failed[0] += 1
+                print(f"[{'ok' if ok else 'failed'}] {cmd}")
+
+    start = time.time()
+    workers = [threading.Thread(target=runner, args=(conn,), daemon=True) for conn in conns]
+    try:
+        for w in workers:
+            w.start()
+        for w in workers:
+            while w.is_alive():
+                w.join(0.2)
+    except KeyboardInterrupt:
+        # Несделанные команды не начинаем; начатые оборвутся вместе с сокетами
+        while not pending.empty():
+            pending.get_nowait()
+        failed[0] = max(failed[0], 1)
+    finally:
+        for conn in conns:
+            try:
+                conn.send_packet(0, TYPE_FIN)
+                conn.sock.close()
+            except: pass
+
+    print(f"Finished {len(commands)} commands in {time.time() - start:.3f}s, {failed[0]} failed.")
+    return 1 if failed[0] else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="LAB_2 RUDP file client. Without a command or --manifest it starts the interactive prompt.",
+        epilog="Exit status in headless mode: 0 when every command succeeded, 1 when some failed, "
+               "2 when the server is unreachable or the manifest cannot be read.")
+    parser.add_argument('--host', help="server address (asked interactively when omitted)")
+    parser.add_argument('--port', type=int, help="server port (asked interactively when omitted)")
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="run the commands in FILE, one per line ('-' for stdin), and exit")
+    parser.add_argument('--parallel', type=int, default=1,
+                        help="manifest commands run at once, each runner over its own RUDP connection")
+    parser.add_argument('--cc', choices=sorted(congestion.ALGORITHMS), default=congestion.DEFAULT,
+                        help="congestion control for this connection, also requested from the server")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="run a single command and exit, e.g. download f.zip")
+    return parser.parse_args()
+
 def start_client():
+    args = parse_args()
     default_ip = "127.0.0.1"
     default_port = 9090
+
+    if args.command or args.manifest:
+        commands = [' '.join(args.command)] if args.command else []
+        if args.manifest:
+            try:
+                commands += load_manifest(args.manifest)
+            except OSError as e:
+                print(f"Cannot read manifest: {e}")
+                sys.exit(2)
+        sys.exit(run_headless(args.host or default_ip, args.port or default_port, commands, args.parallel, args.cc))
     
-    host_in = input(f"Enter IP (default {default_ip}): ").strip()
-    HOST = host_in if host_in else default_ip
+    if args.host is None:
+        host_in = input(f"Enter IP (default {default_ip}): ").strip()
+        HOST = host_in if host_in else default_ip
+    else:
+        HOST = args.host
     
-    port_in = input(f"Enter Port (default {default_port}): ").strip()
-    PORT = int(port_in) if port_in else default_port
+    if args.port is None:
+        port_in = input(f"Enter Port (default {default_port}): ").strip()
+        PORT = int(port_in) if port_in else default_port
+    else:
+        PORT = args.port
 
     while True:
-        if main_loop(HOST, PORT) is True: sys.exit(0)
+        if main_loop(HOST, PORT, args.cc) is True: sys.exit(0)
         if input("Retry? (y/n): ").lower() != 'y': sys.exit(0)
 
 if __name__ == '__main__':
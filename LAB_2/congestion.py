@@ -0,0 +1,112 @@
+import time
+from abc import ABC, abstractmethod
+
+INITIAL_WINDOW = 10     # пакетов, как IW10 в TCP
+MIN_WINDOW = 2
+LOSS_WINDOW = 1         # окно после RTO
+LEDBAT_TARGET = 0.1     # допустимая задержка в очереди, RFC 6817 разрешает не больше 100 мс
+LEDBAT_GAIN = 1.0
+BASE_HISTORY = 10       # сколько минутных минимумов помнит LEDBAT
+BASE_INTERVAL = 60.0
+
+
+class Controller(ABC):
+    """Общая часть алгоритмов: окно в пакетах, порог медленного старта и одна реакция
+    на потери за окно (NewReno: повторные потери до recovery уже учтены)"""
+
+    name = None
+
+    def __init__(self, max_window):
+        self.max_window = max_window
+        self.cwnd = float(min(INITIAL_WINDOW, max_window))
+        self.ssthresh = float(max_window)
+        self.recovery = -1
+        self.events = 0
+
+    @property
+    def window(self):
+        return max(LOSS_WINDOW, min(int(self.cwnd), self.max_window))
+
+    @abstractmethod
+    def on_ack(self, acked, rtt, now=None):
+        """acked - сколько пакетов впервые подтверждено, rtt - замер по Карну или None"""
+
+    def on_loss(self, seq, next_seq):
+        """Потеря обнаружена быстрой перепосылкой; seq - потерянный пакет"""
+        if seq < self.recovery:
+            return False
+        self.recovery = next_seq
+        self.events += 1
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = self.ssthresh
+        return True
+
+    def on_timeout(self, next_seq):
+        self.recovery = next_seq
+        self.events += 1
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = LOSS_WINDOW
+
+
+class Reno(Controller):
+    """AIMD: медленный старт до ssthresh, дальше +1 пакет за RTT, половина окна при потере"""
+
+    name = 'reno'
+
+    def on_ack(self, acked, rtt, now=None):
+        if self.cwnd < self.ssthresh:
+            self.cwnd = min(self.cwnd + acked, self.ssthresh + 1)
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+
+class Ledbat(Controller):
+    """LEDBAT (RFC 6817): держит задержку в очереди около LEDBAT_TARGET и уступает полосу TCP.
+    В заголовке нет временных меток, поэтому вместо односторонней задержки берется RTT:
+    базовая задержка - минимум RTT за последние BASE_HISTORY минут."""
+
+    name = 'ledbat'
+
+    def __init__(self, max_window, target=LEDBAT_TARGET):
+        super().__init__(max_window)
+        self.target = target
+        self.history = []       # [начало минуты, минимум RTT за нее]
+        self.delay = None       # последняя оценка задержки в очереди
+
+    def base_delay(self, rtt, now):
+        if not self.history or now - self.history[-1][0] >= BASE_INTERVAL:
+            self.history.append([now, rtt])
+            del self.history[:-BASE_HISTORY]
+        elif rtt < self.history[-1][1]:
+            self.history[-1][1] = rtt
+        return min(entry[1] for entry in self.history)
+
+    def on_ack(self, acked, rtt, now=None):
+        if rtt is not None:
+            now = time.monotonic() if now is None else now
+            self.delay = rtt - self.base_delay(rtt, now)
+        if self.delay is None:
+            return
+        if self.cwnd < self.ssthresh:
+            # Медленный старт заканчивается, как только очередь заполнилась наполовину
+            if self.delay > self.target / 2:
+                self.ssthresh = self.cwnd
+            else:
+                self.cwnd = min(self.cwnd + acked, self.ssthresh + 1)
+                self.cwnd = min(self.cwnd, self.max_window)
+                return
+        off_target = (self.target - self.delay) / self.target
+        self.cwnd += LEDBAT_GAIN * off_target * acked / self.cwnd
+        self.cwnd = max(MIN_WINDOW, min(self.cwnd, self.max_window))
+
+
+ALGORITHMS = {cls.name: cls for cls in (Reno, Ledbat)}
+DEFAULT = 'reno'
+
+
+def create(name, max_window):
+    try:
+        return ALGORITHMS[name](max_window)
+    except KeyError:
+        raise ValueError(f"unknown congestion control '{name}', expected one of: {', '.join(ALGORITHMS)}")
@@ -1,278 +1,826 @@
 import socket
 import struct
 import select
+import sys
 import time
 
+import congestion
+
 PACKET_SIZE = 32768
 HEADER_FMT = '!IB'
-HEADER_SIZE = struct.calcsize(HEADER_FMT)
-WINDOW_SIZE = 64
-ACK_FREQUENCY = 16
-MAX_RETRIES = 70
+HEADER = struct.Struct(HEADER_FMT)
+HEADER_SIZE = HEADER.size
+WINDOW_SIZE = 64       # верхняя граница cwnd: больше буфер переупорядочивания получателя не примет
+ACK_FREQUENCY = 2       # как в TCP: ACK на каждые два пакета держит ACK-clocking для cwnd
+ACK_DELAY = 0.02
+MAX_RETRIES = 15
+INITIAL_RTO = 0.5
+MIN_RTO = 0.03      # больше ACK_DELAY, иначе отложенный ACK выглядел бы как потеря
+MAX_RTO = 4.0
+CLOCK_GRANULARITY = 0.001
+REORDER_LIMIT = 2 * WINDOW_SIZE     # буфер приема файла, в пакетах по PACKET_SIZE
+MAX_RWND = 0xFFFF
+# Окно и частота ACK в байтах: с пакетами меньше PACKET_SIZE (GSO по MTU) их столько же в сети
+WINDOW_BYTES = WINDOW_SIZE * PACKET_SIZE
+ACK_BYTES = ACK_FREQUENCY * PACKET_SIZE
+DUP_THRESHOLD = 3
+FIN_COUNT = 5
+FIN_INTERVAL = 0.005
+MAX_WRITE_BUFFER = 1024 * 1024
+PING_AFTER = 10.0
+PING_INTERVAL = 1.0
+RECV_TIMEOUT = 30.0
+SACK_FMT = struct.Struct('!IH')     # следующий ожидаемый номер и окно получателя
+RECV_BUFFER = 65536     # больше датаграмма UDP (и пачка GRO) не бывает
+
+# Linux UDP GSO/GRO (4.18+/5.0+): одна sendmsg отдает ядру пачку пакетов одного размера,
+# а recvmsg забирает их склеенными. В модуле socket этих констант может не быть
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+GSO_MAX_BYTES = 65507       # больше одна датаграмма UDP/IPv4 не вместит, даже нарезаемая ядром
+GSO_MAX_SEGMENTS = 64
+DEFAULT_MTU = 1500
+GRO_CMSG_SPACE = socket.CMSG_SPACE(4) if hasattr(socket, 'CMSG_SPACE') else 0
+SEGMENT_FMT = struct.Struct('=H')   # UDP_SEGMENT
+GRO_FMT = struct.Struct('=i')       # UDP_GRO
 
 TYPE_DATA = 0
 TYPE_ACK = 1
 TYPE_SYN = 2
 TYPE_FIN = 3
 
+STAT_KEYS = ('packets_sent', 'packets_received', 'bytes_sent', 'bytes_received',
+             'retransmissions', 'fast_retransmits', 'dup_acks', 'timeouts', 'out_of_order',
+             'window_occupancy', 'window_peak', 'srtt_ms', 'rto_ms', 'cwnd', 'ssthresh',
+             'congestion_events', 'send_calls', 'recv_calls', 'rwnd', 'rwnd_limited')
+# Мгновенные значения, а не счетчики: их нельзя суммировать по соединениям
+GAUGE_KEYS = ('window_occupancy', 'window_peak', 'srtt_ms', 'rto_ms', 'cwnd', 'ssthresh', 'rwnd')
+
+
+_offload = None
+
+def offload_support():
+    """{'gso': bool, 'gro': bool}: что умеет ядро, проверяется один раз пробным сокетом"""
+    global _offload
+    if _offload is None:
+        _offload = {'gso': False, 'gro': False}
+        if sys.platform.startswith('linux'):
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for name, opt, value in (('gso', UDP_SEGMENT, DEFAULT_MTU - 28), ('gro', UDP_GRO, 1)):
+                try:
+                    probe.setsockopt(SOL_UDP, opt, value)
+                    _offload[name] = True
+                except OSError:
+                    pass
+            probe.close()
+    return _offload
+
+def path_mtu(addr):
+    """MTU маршрута до addr (Linux IP_MTU на подключенном сокете) или None"""
+    probe = socket.socket(socket.AF_INET6 if ':' in addr[0] else socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(addr)
+        return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+    finally:
+        probe.close()
+
+
+class RTTEstimator:
+    """RFC 6298: сглаженный RTT, его разброс и RTO с экспоненциальным откатом"""
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + max(4 * self.rttvar, CLOCK_GRANULARITY)))
+        self.backoff = 1
+
+    def timeout(self):
+        return min(MAX_RTO, self.rto * self.backoff)
+
+    def expired(self):
+        self.backoff = min(self.backoff * 2, 64)
+
+
+def build_sack(expected_seq, received, window):
+    """Полезная нагрузка ACK: следующий ожидаемый номер, окно получателя (сколько пакетов начиная
+    с expected_seq он еще примет) и битовая карта принятых после дыры пакетов.
+    Бит i (старший бит первым) означает, что пакет expected_seq + 1 + i уже лежит у получателя."""
+    header = SACK_FMT.pack(expected_seq, min(window, MAX_RWND))
+    if not received:
+        return header
+    bitmap = bytearray((max(received) - expected_seq + 7) // 8)
+    for seq in received:
+        i = seq - expected_seq - 1
+        bitmap[i >> 3] |= 0x80 >> (i & 7)
+    return header + bytes(bitmap)
+
+
+def parse_sack(seq, payload):
+    """(следующий ожидаемый, множество SACK, окно) из ACK; пустой ACK - обычный кумулятивный
+    на seq, окна в нем нет (None)"""
+    if len(payload) < SACK_FMT.size:
+        return seq + 1, set(), None
+    expected_seq, window = SACK_FMT.unpack_from(payload)
+    received = set()
+    for n, byte in enumerate(payload[SACK_FMT.size:]):
+        while byte:
+            bit = byte.bit_length() - 1
+            received.add(expected_seq + 1 + n * 8 + 7 - bit)
+            byte &= ~(1 << bit)
+    return expected_seq, received, window
+
+
+class MessageReceiver:
+    """Сборка входящего сообщения (команды) до '\\n'; каждый пакет подтверждается сразу.
+    Номера пакетов начинаются с нуля заново в каждом сообщении."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.expected_seq = 0
+        self.chunks = []
+
+    def on_data(self, seq, payload):
+        if seq == self.expected_seq:
+            payload = bytes(payload)
+            self.chunks.append(payload)
+            self.expected_seq += 1
+            self.conn.send_packet(seq, TYPE_ACK)
+            if payload.endswith(b'\n'):
+                message = b''.join(self.chunks)
+                self.expected_seq = 0
+                self.chunks = []
+                return message
+        elif seq < self.expected_seq:
+            self.conn.send_packet(self.expected_seq - 1, TYPE_ACK)
+        return None
+
+
+class MessageSender:
+    """Отправка одного сообщения окном из 16 пакетов по 4 КБ с кумулятивными ACK.
+
+    Машины отправки не читают сокет сами: пакеты пира приходят в on_packet, а когда наступает
+    deadline, вызывается on_timeout. Так их может вести и блокирующий RUDPConnection._drive,
+    и общий цикл сервера с таймерами на TimerWheel."""
+
+    def __init__(self, conn, data):
+        if not isinstance(data, bytes): raise ValueError("Only bytes allowed")
+        self.conn = conn
+        self.chunks = [data[i:i+4096] for i in range(0, len(data), 4096)] or [b'']
+        self.base = 0
+        self.next_seq = 0
+        self.retries = 0
+        self.sent_at = {}
+        self.resent = set()
+        self.deadline = None
+        self.done = False
+
+    def start(self, now):
+        self._fill(now)
+
+    def _fill(self, now):
+        while self.next_seq < self.base + 16 and self.next_seq < len(self.chunks):
+            self.conn.send_packet(self.next_seq, TYPE_DATA, self.chunks[self.next_seq])
+            self.sent_at[self.next_seq] = now
+            self.next_seq += 1
+        self.deadline = now + self.conn.rtt.timeout()
+
+    def on_packet(self, seq, type_val, payload, now):
+        if type_val == TYPE_FIN and seq != self.conn.trailing_fin: raise ConnectionResetError("Closed")
+        if type_val != TYPE_ACK or not self.base <= seq < self.next_seq: return
+        # Karn: RTT меряем только по пакетам, посланным один раз
+        if seq not in self.resent:
+            self.conn._rtt_sample(now - self.sent_at[seq])
+        self.base = seq + 1
+        self.retries = 0
+        if self.base == len(self.chunks):
+            self.done = True
+            self.deadline = None
+        else:
+            self._fill(now)
+
+    def on_timeout(self, now):
+        self.retries += 1
+        self.conn._rto_expired()
+        if self.retries > MAX_RETRIES: raise ConnectionResetError("Timeout sending command")
+        self.conn.stats['retransmissions'] += self.next_seq - self.base
+        self.resent.update(range(self.base, self.next_seq))
+        self.next_seq = self.base
+        self._fill(now)
+
+    def delivered(self):
+        self.done = True
+        self.deadline = None
+
+    def close(self):
+        pass
+
+
+class BulkSender:
+    """Передача файла: selective repeat с SACK, окно - cwnd алгоритма управления перегрузкой,
+    но не дальше окна, объявленного получателем. Один таймер RTO на самый старый
+    неподтвержденный пакет. В конце - FIN_COUNT пакетов FIN с интервалом FIN_INTERVAL."""
+
+    def __init__(self, conn, filename):
+        self.conn = conn
+        self.cc = conn.cc
+        self.f = open(filename, 'rb')
+        self.base = 0
+        self.next_seq = 0
+        self.end_seq = None     # номер первого пакета за концом файла, когда он уже прочитан
+        # Окно файла читается readinto в кольцо слотов: пакет seq лежит в слоте seq % window,
+        # а слот освобождается раньше, чем до него дойдет пакет на окно дальше
+        self.ring = memoryview(bytearray(conn.window * conn.packet_size))
+        self.file_buffer = {}   # номер -> срез кольца, пока пакет не подтвержден
+        self.sent_at = {}       # время последней отправки каждого пакета в окне
+        self.retransmitted = set()  # посланные больше одного раза: по ним RTT не меряем (Karn)
+        self.sacked = set()     # пакеты выше base, которые получатель подтвердил через SACK
+        self.resent = set()     # дыры, уже перепосланные быстро после последнего RTO
+        self.lost = set()       # после RTO: ждут перепосылки, когда cwnd позволит
+        self.peer_edge = conn.window    # первый номер за окном получателя (до его первого ACK - наше)
+        self.dupacks = 0
+        self.retries = 0
+        self.rto_at = None      # RTO самого старого неподтвержденного пакета
+        self.fins = 0           # сколько FIN осталось послать; > 0 - передача уже закончена
+        self.failed = False
+        self.deadline = None
+        self.done = False
+
+    def start(self, now):
+        self._pump(now)
+
+    def _resend(self, seq):
+        self.conn.send_packet(seq, TYPE_DATA, self.file_buffer[seq])
+        self.sent_at[seq] = time.monotonic()
+        self.retransmitted.add(seq)
+        self.conn.stats['retransmissions'] += 1
+
+    def _fast_retransmit(self, seq):
+        self._resend(seq)
+        self.resent.add(seq)
+        self.conn.stats['fast_retransmits'] += 1
+        self.cc.on_loss(seq, self.next_seq)
+
+    def _pump(self, now):
+        # Досылаем, пока пакетов в сети меньше cwnd: сначала потерянные, потом новые.
+        # Новые читаются из файла одним блоком и уходят одной пачкой - с GSO это один
+        # системный вызов на пачку
+        conn = self.conn
+        size = conn.packet_size
+        window = self.cc.window
+        in_flight = self.next_seq - self.base - len(self.sacked) - len(self.lost)
+        while self.lost and in_flight < window:
+            seq = min(self.lost)
+            self.lost.discard(seq)
+            self._resend(seq)
+            in_flight += 1
+        first = self.next_seq
+        batch = []
+        room = min(window - in_flight, self.base + conn.window - self.next_seq)
+        if self.peer_edge - self.next_seq < room:
+            # Дальше окна получателя не шлем: пока он занят (диск, цикл событий), лишнее
+            # пропало бы в переполненном сокете
+            room = self.peer_edge - self.next_seq
+            conn.stats['rwnd_limited'] += 1
+        while room > 0 and self.end_seq is None:
+            # Кусок кольца до его конца одним readinto, остаток - со следующего круга
+            slot = self.next_seq % conn.window
+            count = min(room, conn.window - slot)
+            start = slot * size
+            got = self.f.readinto(self.ring[start:start + count * size])
+            for offset in range(start, start + got, size):
+                chunk = self.ring[offset:min(offset + size, start + got)]
+                self.file_buffer[self.next_seq] = chunk
+                self.sent_at[self.next_seq] = now
+                batch.append(chunk)
+                self.next_seq += 1
+            room -= count
+            if got < count * size:
+                self.end_seq = self.next_seq
+        in_flight += len(batch)
+        if batch:
+            conn.send_batch(first, batch)
+        conn._set_window(in_flight)
+        self.conn._update_cc()
+        if self.base == self.end_seq:
+            self._finish(now)
+            return
+        if self.rto_at is None:
+            self.rto_at = now + self.conn.rtt.timeout()
+        self.deadline = self.rto_at
+
+    def _finish(self, now):
+        self.close()
+        self.fins = FIN_COUNT
+        self._send_fin(now)
+
+    def _send_fin(self, now):
+        self.conn.send_packet(self.next_seq, TYPE_FIN)
+        self.fins -= 1
+        if self.fins:
+            self.deadline = now + FIN_INTERVAL
+        else:
+            self.deadline = None
+            self.done = True
+
+    def on_timeout(self, now):
+        if self.fins:
+            self._send_fin(now)
+            return
+        self.retries += 1
+        self.conn._rto_expired()
+        if self.retries > MAX_RETRIES:
+            print(f"\n[!] Transfer timed out. Base: {self.base}")
+            self.failed = True
+            self._finish(now)
+            return
+        # Все неподтвержденное считаем потерянным, окно сбрасывается до LOSS_WINDOW;
+        # перепосылаем по мере того, как оно снова растет
+        self.cc.on_timeout(self.next_seq)
+        self.lost = {seq for seq in range(self.base, self.next_seq) if seq not in self.sacked}
+        self.resent.clear()
+        self.dupacks = 0
+        self.rto_at = now + self.conn.rtt.timeout()
+        self._pump(now)
+
+    def on_packet(self, seq, type_val, payload, now):
+        if type_val != TYPE_ACK or self.fins: return
+        cc = self.cc
+        cumulative, received, rwnd = parse_sack(seq, payload)
+        base, next_seq = self.base, self.next_seq
+        # Окно отсчитывается от кумулятивного номера; запоздавший ACK его не двигает
+        if rwnd is not None and cumulative >= base:
+            self.peer_edge = cumulative + max(rwnd, 1)
+            self.conn.stats['rwnd'] = rwnd
+        fresh = {n for n in received if base <= n < next_seq} - self.sacked
+        newest = max(fresh) if fresh else None
+        sample = None
+        if cumulative > base:
+            top = min(cumulative, next_seq)
+            if newest is None:
+                newest = top - 1
+            if newest not in self.retransmitted:
+                sample = now - self.sent_at[newest]
+            delivered = len(fresh | set(range(base, top)) - self.sacked)
+            for n in range(base, top):
+                self.file_buffer.pop(n, None)
+                self.sent_at.pop(n, None)
+                self.retransmitted.discard(n)
+            self.sacked = {n for n in self.sacked if n >= top}
+            self.resent = {n for n in self.resent if n >= top}
+            self.lost = {n for n in self.lost if n >= top}
+            self.base = base = top
+            self.retries = 0
+            self.dupacks = 0
+            self.rto_at = now + self.conn.rtt.timeout() if base < next_seq else None
+        else:
+            self.conn.stats['dup_acks'] += 1
+            self.dupacks += 1
+            if newest is not None and newest not in self.retransmitted:
+                sample = now - self.sent_at[newest]
+            delivered = len(fresh)
+            # Классическая быстрая перепосылка по DUP_THRESHOLD повторным ACK
+            if self.dupacks == DUP_THRESHOLD and base < next_seq and \
+               base not in self.sacked and base not in self.resent and base not in self.lost:
+                self._fast_retransmit(base)
+        self.sacked |= fresh
+        self.lost -= fresh
+        if sample is not None:
+            self.conn._rtt_sample(sample)
+        if delivered:
+            cc.on_ack(delivered, sample, now)
+
+        # Быстрая перепосылка по SACK: дыра, над которой получатель уже принял
+        # DUP_THRESHOLD пакетов, почти наверняка потеряна
+        if len(self.sacked) >= DUP_THRESHOLD:
+            limit = sorted(self.sacked)[-DUP_THRESHOLD]
+            for n in range(base, limit):
+                if n not in self.sacked and n not in self.resent and n not in self.lost:
+                    self._fast_retransmit(n)
+        self._pump(now)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+            self.conn._update_cc()
+
+
+class StreamReceiver:
+    """Прием файла от BulkSender. Пакеты из будущего ждут в кольце слотов: пакет seq лежит в слоте
+    seq % slots, пока дыра перед ним не закроется. В каждом SACK получатель объявляет окно -
+    сколько пакетов после подтвержденного он примет без потерь, даже если занят (пишет на диск):
+    столько, сколько поместится и в кольцо, и в буфер сокета. Отправитель дальше окна не шлет,
+    и медленный получатель его притормаживает, а не теряет пакеты. SACK - на каждые ACK_BYTES
+    байт или через ACK_DELAY, запись на диск блоками по MAX_WRITE_BUFFER. Размер слота - размер
+    первого пакета: отправитель с GSO шлет пакеты по MTU, и слотов во столько же раз больше"""
+
+    def __init__(self, conn, filename, expected_size, progress_callback=None):
+        self.conn = conn
+        self.expected_size = expected_size
+        self.progress_callback = progress_callback
+        self.f = open(filename, 'wb')
+        self.expected_seq = 0
+        self.bytes_written = 0
+        self.unacked = 0
+        self.unacked_bytes = 0
+        # Кольцо и окно выделяются по первому пакету
+        self.slots = None
+        self.slot_size = None
+        self.ring = None
+        self.lengths = None
+        self.rwnd = REORDER_LIMIT
+        self.held = set()       # номера пакетов, которые ждут в кольце
+        # Буфер записи: пакеты копируются в него из буфера приема, на диск уходит по 1МБ
+        self.write_buffer = memoryview(bytearray(MAX_WRITE_BUFFER))
+        self.write_buffer_size = 0
+        self.last_activity = self.last_ack_time = time.monotonic()
+        self.deadline = None
+        self.done = False
+
+    def start(self, now):
+        if self.expected_size <= 0:
+            self._finish()
+        else:
+            self._schedule(now)
+
+    def _schedule(self, now):
+        # Отложенный ACK уходит по таймеру, даже если пакетов больше нет: при маленьком cwnd
+        # отправитель иначе ждал бы RTO. Без данных долго - пингуем отправителя раз в секунду
+        if self.unacked:
+            self.deadline = self.last_ack_time + ACK_DELAY
+        elif now - self.last_activity < PING_AFTER:
+            self.deadline = self.last_activity + PING_AFTER
+        else:
+            self.deadline = now + PING_INTERVAL
+
+    def _allocate(self, size):
+        slots = REORDER_LIMIT * max(1, PACKET_SIZE // size)
+        # Маленькому файлу кольцо больше него самого не нужно
+        self.slots = max(1, min(slots, -(-self.expected_size // size)))
+        self.slot_size = size
+        self.ring = memoryview(bytearray(self.slots * size))
+        self.lengths = [0] * self.slots
+        # Пока получатель занят, пакеты копятся в сокете. Linux удваивает SO_RCVBUF
+        # под служебные данные, так что полезных в нем - половина
+        self.rwnd = self.slots
+        try:
+            rcvbuf = self.conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            self.rwnd = max(1, min(self.slots, rcvbuf // 2 // size))
+        except (AttributeError, OSError):
+            pass
+        self.conn.stats['rwnd'] = self.rwnd
+
+    def _sack(self):
+        self.conn._send_sack(self.expected_seq, self.held, self.rwnd)
+
+    def _ack(self, now):
+        self._sack()
+        self.last_ack_time = now
+        self.unacked = 0
+        self.unacked_bytes = 0
+
+    def _buffer(self, payload):
+        size = len(payload)
+        if self.write_buffer_size + size > MAX_WRITE_BUFFER:
+            self._flush_buffer()
+        self.write_buffer[self.write_buffer_size:self.write_buffer_size + size] = payload
+        self.write_buffer_size += size
+        self.expected_seq += 1
+        self.unacked += 1
+        self.unacked_bytes += size
+
+    def _flush_buffer(self):
+        self.f.write(self.write_buffer[:self.write_buffer_size])
+        self.bytes_written += self.write_buffer_size
+        self.write_buffer_size = 0
+        if self.progress_callback: self.progress_callback(self.bytes_written, self.expected_size)
+
+    def _finish(self):
+        # Дописываем остатки
+        if self.write_buffer_size:
+            self._flush_buffer()
+        # Финальные подтверждения
+        for _ in range(3): self._sack()
+        self.close()
+        self.deadline = None
+        self.done = True
+
+    def on_timeout(self, now):
+        if self.unacked:
+            self._ack(now)
+        elif now - self.last_activity > RECV_TIMEOUT:
+            raise ConnectionResetError("Receive timeout")
+        elif now - self.last_activity >= PING_AFTER:
+            self._sack() # Пингуем сервер
+        self._schedule(now)
+
+    def on_packet(self, seq, type_val, payload, now):
+        if type_val == TYPE_FIN:
+            self._finish()
+            return
+        if type_val != TYPE_DATA: return
+        self.last_activity = now
+        if self.slots is None:
+            self._allocate(max(len(payload), 1))
+
+        if seq == self.expected_seq:
+            # Добавляем в буфер записи вместе со всем, что ждало за дырой
+            gap_closed = bool(self.held)
+            self._buffer(payload)
+            while gap_closed and self.expected_seq in self.held:
+                self.held.discard(self.expected_seq)
+                i = self.expected_seq % self.slots
+                offset = i * self.slot_size
+                self._buffer(self.ring[offset:offset + self.lengths[i]])
+
+            if self.bytes_written + self.write_buffer_size >= self.expected_size:
+                self._finish()
+                return
+
+            # LOGIC: Cumulative ACK + SACK
+            # Шлем ACK если:
+            # 1. Пришло ACK_BYTES байт (ACK_FREQUENCY пакетов полного размера)
+            # 2. ИЛИ Прошло много времени (> ACK_DELAY)
+            # 3. ИЛИ закрылась дыра - отправитель должен сдвинуть окно сразу
+            # Последний кусок подтверждают финальные SACK в _finish
+            if gap_closed or self.unacked_bytes >= ACK_BYTES or now - self.last_ack_time > ACK_DELAY:
+                self._ack(now)
+
+        elif seq > self.expected_seq:
+            # Пакет из будущего: храним в его слоте, если он помещается в кольцо
+            # (пакет крупнее слота - только если первым пришел короткий хвост файла),
+            # и сразу сообщаем отправителю о дыре через SACK
+            if seq < self.expected_seq + self.slots and seq not in self.held and len(payload) <= self.slot_size:
+                # payload - срез буфера приема, следующее чтение его перезапишет
+                i = seq % self.slots
+                offset = i * self.slot_size
+                self.ring[offset:offset + len(payload)] = payload
+                self.lengths[i] = len(payload)
+                self.held.add(seq)
+                self.conn.stats['out_of_order'] += 1
+            self._ack(now)
+
+        else:
+            # Если пришел повтор, значит наш ACK потерялся.
+            # Срочно подтверждаем текущее состояние.
+            self._sack()
+        self._schedule(now)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
 class RUDPConnection:
-    def __init__(self, sock, addr=None):
+    def __init__(self, sock, addr=None, cc=congestion.DEFAULT):
         self.sock = sock
         self.addr = addr
         self.sock.setblocking(0)
+        # Счетчики соединения для STATS и экспорта метрик
+        self.stats = dict.fromkeys(STAT_KEYS, 0)
+        # Общая оценка RTT для команд и bulk-передачи: путь до пира один и тот же
+        self.rtt = RTTEstimator()
+        self.stats['rto_ms'] = round(self.rtt.timeout() * 1000, 3)
+        # Управление перегрузкой своё у каждого соединения, алгоритм выбирается по имени
+        self.cc = congestion.create(cc, WINDOW_SIZE)
+        self._update_cc()
+        # Размер пакета данных и предел окна в пакетах; меняются, когда включен GSO
+        self.packet_size = PACKET_SIZE
+        self.window = WINDOW_SIZE
+        self.gso = False
+        self.gro = False
+        # Номер FIN после последнего принятого файла: отправитель шлет их несколько, и запоздавшие
+        # не должны выглядеть как закрытие соединения
+        self.trailing_fin = None
+        # Заголовки собираются в готовый буфер и уходят вместе с данными одной sendmsg,
+        # прием - recvfrom_into в свой буфер: на горячем пути ни копий, ни новых bytes.
+        # Полезная нагрузка принятого пакета - срез recv_buffer, живет до следующего чтения
+        self.header = bytearray(HEADER_SIZE * GSO_MAX_SEGMENTS)
+        self.headers = [memoryview(self.header)[i:i + HEADER_SIZE]
+                        for i in range(0, len(self.header), HEADER_SIZE)]
+        self.recv_buffer = bytearray(RECV_BUFFER)
+        self.recv_view = memoryview(self.recv_buffer)
+        # sendmsg нет в Windows и у транспорта asyncio - там склеиваем заголовок с данными
+        self._sendmsg = getattr(sock, 'sendmsg', None)
+
+    def enable_gso(self, mtu=None):
+        """Пакеты данных по MTU пути (без IP-фрагментации) и пачки окна одной sendmsg с
+        UDP_SEGMENT. На loopback MTU 64К, и пакет остается PACKET_SIZE. False, если ядро не умеет"""
+        if not offload_support()['gso'] or self.addr is None:
+            return False
+        mtu = mtu or path_mtu(self.addr) or DEFAULT_MTU
+        overhead = 48 if ':' in self.addr[0] else 28
+        self.packet_size = max(512, min(PACKET_SIZE, mtu - overhead - HEADER_SIZE))
+        self.window = WINDOW_BYTES // self.packet_size
+        self.cc.max_window = self.window
+        self.cc.ssthresh = float(self.window)
+        self.gso = True
+        return True
+
+    def enable_gro(self):
+        """Принимать пачки GSO склеенными (UDP_GRO); только для своего, не общего сокета"""
+        if not offload_support()['gro'] or not GRO_CMSG_SPACE:
+            return False
+        try:
+            self.sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            return False
+        self.gro = True
+        return True
+
+    def _update_cc(self):
+        self.stats['cwnd'] = self.cc.window
+        self.stats['ssthresh'] = round(self.cc.ssthresh, 1)
+        self.stats['congestion_events'] = self.cc.events
+
+    def _rtt_sample(self, rtt):
+        self.rtt.sample(rtt)
+        self.stats['srtt_ms'] = round(self.rtt.srtt * 1000, 3)
+        self.stats['rto_ms'] = round(self.rtt.timeout() * 1000, 3)
+
+    def _rto_expired(self):
+        self.stats['timeouts'] += 1
+        self.rtt.expired()
+        self.stats['rto_ms'] = round(self.rtt.timeout() * 1000, 3)
+
+    def _count_received(self, data):
+        self.stats['packets_received'] += 1
+        self.stats['bytes_received'] += len(data)
+
+    def _set_window(self, in_flight):
+        self.stats['window_occupancy'] = in_flight
+        if in_flight > self.stats['window_peak']:
+            self.stats['window_peak'] = in_flight
         
     def flush(self):
         try:
             while True:
-                data, _ = self.sock.recvfrom(65536)
+                self.sock.recv_into(self.recv_buffer)
         except (BlockingIOError, OSError):
             pass
 
     def send_packet(self, seq, type_val, data=b''):
         try:
-            header = struct.pack(HEADER_FMT, seq, type_val)
-            self.sock.sendto(header + data, self.addr)
+            if self._sendmsg is not None:
+                HEADER.pack_into(self.header, 0, seq, type_val)
+                self._sendmsg([self.headers[0], data], (), 0, self.addr)
+            else:
+                self.sock.sendto(HEADER.pack(seq, type_val) + data, self.addr)
+            self.stats['packets_sent'] += 1
+            self.stats['bytes_sent'] += HEADER_SIZE + len(data)
+            self.stats['send_calls'] += 1
         except (BlockingIOError, OSError):
             pass
 
-    def _wait_ack_nonblocking(self):
+    def send_batch(self, first_seq, chunks):
+        """Пакеты данных first_seq, first_seq + 1, ...: с GSO - группами по одной sendmsg, ядро
+        само режет буфер на датаграммы по segment байт (короче может быть только последняя)"""
+        if not self.gso or len(chunks) < 2:
+            for i, chunk in enumerate(chunks):
+                self.send_packet(first_seq + i, TYPE_DATA, chunk)
+            return
+        segment = HEADER_SIZE + self.packet_size
+        per_call = min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // segment)
+        control = [(SOL_UDP, UDP_SEGMENT, SEGMENT_FMT.pack(segment))]
+        for start in range(0, len(chunks), per_call):
+            group = chunks[start:start + per_call]
+            buffers = []
+            size = 0
+            for i, chunk in enumerate(group):
+                HEADER.pack_into(self.header, i * HEADER_SIZE, first_seq + start + i, TYPE_DATA)
+                buffers.append(self.headers[i])
+                buffers.append(chunk)
+                size += HEADER_SIZE + len(chunk)
+            try:
+                self.sock.sendmsg(buffers, control if len(group) > 1 else [], 0, self.addr)
+            except BlockingIOError:
+                continue
+            except OSError:
+                # EIO/EINVAL: устройство или маршрут не умеют GSO - дальше по одному пакету
+                self.gso = False
+                self.send_batch(first_seq + start, chunks[start:])
+                return
+            self.stats['packets_sent'] += len(group)
+            self.stats['bytes_sent'] += size
+            self.stats['send_calls'] += 1
+
+    def parse(self, data):
+        """Разбор датаграммы от пира: (seq, тип, полезная нагрузка) или None для мусора"""
+        self._count_received(data)
+        if len(data) < HEADER_SIZE: return None
+        seq, type_val = HEADER.unpack_from(data)
+        return seq, type_val, memoryview(data)[HEADER_SIZE:]
+
+    def _recv_packet(self):
+        """Неблокирующее чтение одного пакета от пира; чужие датаграммы отбрасываются"""
         try:
-            data, addr = self.sock.recvfrom(65536)
-            if self.addr and addr != self.addr: return -1
-            if len(data) < HEADER_SIZE: return -1
-            seq, type_val = struct.unpack(HEADER_FMT, data[:HEADER_SIZE])
-            if type_val == TYPE_ACK: return seq
-            if type_val == TYPE_FIN: return -2
+            size, addr = self.sock.recvfrom_into(self.recv_buffer)
         except (BlockingIOError, OSError):
-            pass
+            return None
+        if self.addr is None: self.addr = addr
+        if addr != self.addr: return None
+        self.stats['recv_calls'] += 1
+        return self.parse(self.recv_view[:size])
+
+    def _recv_packets(self):
+        """Как _recv_packet, но с GRO одно чтение может вернуть пачку склеенных пакетов"""
+        if not self.gro:
+            packet = self._recv_packet()
+            return [packet] if packet is not None else []
+        try:
+            size, ancdata, _, addr = self.sock.recvmsg_into([self.recv_buffer], GRO_CMSG_SPACE)
+        except (BlockingIOError, OSError):
+            return []
+        if self.addr is None: self.addr = addr
+        if addr != self.addr: return []
+        self.stats['recv_calls'] += 1
+        segment = size
+        for level, kind, value in ancdata:
+            if level == SOL_UDP and kind == UDP_GRO:
+                segment = GRO_FMT.unpack_from(value)[0]
+        view = self.recv_view
+        if segment >= size:
+            packet = self.parse(view[:size])
+            return [packet] if packet is not None else []
+        packets = []
+        for offset in range(0, size, segment):
+            packet = self.parse(view[offset:min(offset + segment, size)])
+            if packet is not None: packets.append(packet)
+        return packets
+
+    def _send_sack(self, expected_seq, received, window):
+        self.send_packet(max(expected_seq - 1, 0), TYPE_ACK, build_sack(expected_seq, received, window))
+
+    def _wait_ack_nonblocking(self):
+        packet = self._recv_packet()
+        if packet is None: return -1
+        seq, type_val, _ = packet
+        if type_val == TYPE_ACK: return seq
+        if type_val == TYPE_FIN: return -2
         return -1
 
+    def _drive(self, machine):
+        """Блокирующий режим (клиент, bench): сами читаем сокет и ждем дедлайнов машины.
+        Сервер вместо этого раздает пакеты и таймеры машинам всех сессий из одного цикла."""
+        try:
+            machine.start(time.monotonic())
+            while not machine.done:
+                now = time.monotonic()
+                if now >= machine.deadline:
+                    machine.on_timeout(now)
+                elif select.select([self.sock], [], [], machine.deadline - now)[0]:
+                    for packet in self._recv_packets():
+                        machine.on_packet(*packet, time.monotonic())
+                        if machine.done: break
+        finally:
+            machine.close()
+        return machine
+
     def send_reliable_data(self, data_source):
         self.flush()
-        if isinstance(data_source, bytes):
-            chunks = [data_source[i:i+4096] for i in range(0, len(data_source), 4096)]
-            if not chunks: chunks = [b'']
-        else: raise ValueError("Only bytes allowed")
-
-        base = 0
-        next_seq = 0
-        retries = 0
-
-        while base < len(chunks):
-            while next_seq < base + 16 and next_seq < len(chunks):
-                self.send_packet(next_seq, TYPE_DATA, chunks[next_seq])
-                next_seq += 1
-            
-            # Ждем ACK с таймаутом
-            start = time.time()
-            ack_received = -1
-            while time.time() - start < 0.5:
-                ready = select.select([self.sock], [], [], 0.05)
-                if ready[0]:
-                    ack_received = self._wait_ack_nonblocking()
-                    if ack_received >= base or ack_received == -2: break
-            
-            if ack_received >= base:
-                base = ack_received + 1
-                retries = 0
-            elif ack_received == -2: raise ConnectionResetError("Closed")
-            else:
-                retries += 1
-                if retries > 20: raise ConnectionResetError("Timeout sending command")
-                next_seq = base
+        self._drive(MessageSender(self, data_source))
 
     def recv_reliable_data(self, timeout=None):
         """Прием команд"""
-        expected_seq = 0
-        received_chunks = {}
-        start_wait = time.time()
+        receiver = MessageReceiver(self)
+        deadline = None if timeout is None else time.monotonic() + timeout
         
         while True:
-            if timeout is not None and (time.time() - start_wait > timeout):
-                return None
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return None
 
-            ready = select.select([self.sock], [], [], 0.1)
-            if not ready[0]: continue
-            
-            try:
-                data, addr = self.sock.recvfrom(65536)
-                
-                if len(data) >= HEADER_SIZE:
-                    seq, type_val = struct.unpack(HEADER_FMT, data[:HEADER_SIZE])
-                    if type_val == TYPE_SYN:
-                        self.addr = addr
-                        self.send_packet(0, TYPE_ACK)
-                        return None # Сброс
-
-                if self.addr is None: self.addr = addr
-                if addr != self.addr: continue
-                if len(data) < HEADER_SIZE: continue
-                
-                seq, type_val = struct.unpack(HEADER_FMT, data[:HEADER_SIZE])
-                payload = data[HEADER_SIZE:]
-                
-                if type_val == TYPE_FIN: return b''
-
-                if type_val == TYPE_DATA:
-                    if timeout is not None: start_wait = time.time()
-                    if seq == expected_seq:
-                        received_chunks[seq] = payload
-                        expected_seq += 1
-                        self.send_packet(expected_seq - 1, TYPE_ACK)
-                        if payload.endswith(b'\n'):
-                             return b''.join(received_chunks[i] for i in sorted(received_chunks.keys()))
-                    elif seq < expected_seq:
-                        self.send_packet(expected_seq - 1, TYPE_ACK)
-            except OSError: pass
+            if not select.select([self.sock], [], [], wait)[0]: continue
+            for seq, type_val, payload in self._recv_packets():
+                # Повтор SYN от того же пира: наш ACK на рукопожатие потерялся
+                if type_val == TYPE_SYN:
+                    self.send_packet(0, TYPE_ACK)
+                elif type_val == TYPE_FIN:
+                    if seq != self.trailing_fin: return b''
+                elif type_val == TYPE_DATA:
+                    if timeout is not None: deadline = time.monotonic() + timeout
+                    message = receiver.on_data(seq, payload)
+                    if message is not None:
+                        return message
 
     def send_file_bulk(self, filename):
         self.flush()
-        base = 0
-        next_seq = 0
-        file_buffer = {}
-        f = open(filename, 'rb')
-        retries = 0
-        
-        try:
-            while True:
-                # 1. Заполняем окно "до отказа"
-                while next_seq < base + WINDOW_SIZE:
-                    if next_seq not in file_buffer:
-                        chunk = f.read(PACKET_SIZE)
-                        if not chunk: 
-                            file_buffer[next_seq] = None
-                            break
-                        file_buffer[next_seq] = chunk
-                    if file_buffer[next_seq] is None: break
-                    
-                    self.send_packet(next_seq, TYPE_DATA, file_buffer[next_seq])
-                    next_seq += 1
-                
-                # Условие выхода
-                if base == next_seq and (base in file_buffer and file_buffer[base] is None):
-                    break
-                if base == next_seq and not file_buffer: 
-                    break
-
-                # 2. Неблокирующая проверка ACK
-                # Мы не ждем ACK, мы проверяем, есть ли он. 
-                # Если окно полно и ACK нет -> тогда ждем.
-                
-                ack = -1
-                # Если окно заполнено, мы обязаны ждать ACK, иначе крутимся впустую
-                if next_seq >= base + WINDOW_SIZE:
-                    ready = select.select([self.sock], [], [], 0.5) # Ждем
-                    if ready[0]:
-                        ack = self._wait_ack_nonblocking()
-                else:
-                    # Если окно не полно, проверяем быстро без ожидания
-                    ack = self._wait_ack_nonblocking()
-
-                if ack >= base:
-                    # Cumulative ACK: удаляем все до ack включительно
-                    # Удаление из словаря может быть медленным, но на таких скоростях приемлемо
-                    # Оптимизация: удаляем диапазоном
-                    keys_to_del = [k for k in file_buffer.keys() if k <= ack]
-                    for k in keys_to_del: del file_buffer[k]
-                    
-                    base = ack + 1
-                    retries = 0
-                else:
-                    # ACK не пришел (или старый)
-                    # Если окно заполнено и таймаут прошел - это потеря
-                    if next_seq >= base + WINDOW_SIZE and ack == -1:
-                        retries += 1
-                        if retries > MAX_RETRIES:
-                            print(f"\n[!] Transfer timed out. Base: {base}")
-                            break
-                        # Go-Back-N (Упрощенно: сбрасываем next_seq, чтобы цикл while перепослал)
-                        # В реальной жизни лучше Fast Retransmit, но тут пересылаем всё окно
-                        next_seq = base
-        finally:
-            f.close()
-            # Посылаем FIN
-            for _ in range(5): 
-                self.send_packet(next_seq, TYPE_FIN)
-                time.sleep(0.005)
+        self._drive(BulkSender(self, filename))
 
     def recv_stream_to_file(self, filename, expected_size, progress_callback=None):
-        self.flush()
-        expected_seq = 0
-        bytes_written = 0
-        last_activity = time.time()
-        last_ack_time = time.time()
-        
-        # Буфер записи: пишем на диск не по 32КБ, а по 1МБ для скорости
-        write_buffer = []
-        write_buffer_size = 0
-        MAX_WRITE_BUFFER = 1024 * 1024 
-
-        f = open(filename, 'wb')
-        try:
-            while bytes_written < expected_size:
-                # Ожидание данных
-                ready = select.select([self.sock], [], [], 1.0)
-                if not ready[0]: 
-                    if time.time() - last_activity > 10.0:
-                        self.send_packet(expected_seq - 1, TYPE_ACK) # Пингуем сервер
-                    if time.time() - last_activity > 30.0:
-                        raise ConnectionResetError("Receive timeout")
-                    continue 
-                
-                try:
-                    data, addr = self.sock.recvfrom(65536)
-                    if addr != self.addr: continue
-                    
-                    if len(data) < HEADER_SIZE: continue
-                    seq, type_val = struct.unpack(HEADER_FMT, data[:HEADER_SIZE])
-                    payload = data[HEADER_SIZE:]
-                    
-                    if type_val == TYPE_FIN: break
-                    
-                    if type_val == TYPE_DATA:
-                        last_activity = time.time()
-                        
-                        if seq == expected_seq:
-                            # Добавляем в буфер записи
-                            write_buffer.append(payload)
-                            write_buffer_size += len(payload)
-                            expected_seq += 1
-                            
-                            # Сбрасываем буфер на диск если он большой
-                            if write_buffer_size >= MAX_WRITE_BUFFER:
-                                f.write(b''.join(write_buffer))
-                                bytes_written += write_buffer_size
-                                write_buffer = []
-                                write_buffer_size = 0
-                                if progress_callback: progress_callback(bytes_written, expected_size)
-
-                            # LOGIC: Cumulative ACK
-                            # Шлем ACK если:
-                            # 1. Прошло N пакетов (ACK_FREQUENCY)
-                            # 2. ИЛИ Прошло много времени (>0.02с)
-                            # 3. ИЛИ Это последний кусок
-                            if (expected_seq % ACK_FREQUENCY == 0) or \
-                               (time.time() - last_ack_time > 0.02) or \
-                               (bytes_written + write_buffer_size >= expected_size):
-                                
-                                self.send_packet(expected_seq - 1, TYPE_ACK)
-                                last_ack_time = time.time()
-                                
-                        elif seq < expected_seq:
-                            # Если пришел повтор, значит наш ACK потерялся. 
-                            # Срочно подтверждаем текущее состояние.
-                            self.send_packet(expected_seq - 1, TYPE_ACK)
-                            
-                except OSError: pass
-            
-            # Дописываем остатки
-            if write_buffer:
-                f.write(b''.join(write_buffer))
-                bytes_written += write_buffer_size
-                if progress_callback: progress_callback(bytes_written, expected_size)
-
-            # Финальные подтверждения
-            for _ in range(3): self.send_packet(expected_seq - 1, TYPE_ACK)
-
-        finally:
-            f.close()
\ No newline at end of file
+        # Без flush: READY уже отправлен, и все, что лежит в сокете, - начало файла
+        self.trailing_fin = self._drive(StreamReceiver(self, filename, expected_size, progress_callback)).expected_seq
@@ -1,8 +1,170 @@
 import socket
 import os
-import struct
+import sys
 import select
-from rudp import RUDPConnection, TYPE_SYN, TYPE_ACK
+import time
+import argparse
+from collections import deque
+from rudp import (RUDPConnection, MessageReceiver, MessageSender, BulkSender, HEADER, HEADER_SIZE, RECV_BUFFER,
+                  TYPE_SYN, TYPE_ACK, TYPE_FIN, TYPE_DATA, STAT_KEYS, GAUGE_KEYS, offload_support)
+import congestion
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.metrics import Registry, start_exporter, THROUGHPUT_BUCKETS
+from common.timerwheel import TimerWheel
+
+COMMANDS = ('ECHO', 'TIME', 'DOWNLOAD', 'UPLOAD', 'EXIT', 'QUIT', 'STATS')
+IDLE_TIMEOUT = 300.0
+POLL_INTERVAL = 1.0
+READY_TIMEOUT = 10.0
+RECV_BATCH = 64
+
+sessions = {}
+connections = {}
+retired = dict.fromkeys(STAT_KEYS, 0)
+timers = TimerWheel()
+idle_timeout = IDLE_TIMEOUT
+
+metrics = Registry('rudp')
+sessions_total = metrics.counter('sessions_total', "Accepted RUDP sessions")
+metrics.callback('sessions_active', "Currently connected clients", lambda: len(connections))
+commands_total = metrics.counter('commands_total', "Commands handled, by command")
+command_latency = metrics.histogram('command_latency_seconds', "Time until a command is answered, by command")
+sessions_reaped = metrics.counter('sessions_reaped_total', "Sessions closed by the idle watchdog, by reason")
+metrics.callback('timers_pending', "Timers waiting in the timer wheel", lambda: len(timers))
+transfer_throughput = metrics.histogram('transfer_throughput_mbps', "Per-transfer throughput in MB/s, by direction",
+                                        THROUGHPUT_BUCKETS)
+for _key in STAT_KEYS:
+    if _key in GAUGE_KEYS:
+        metrics.callback(_key, f"Connection {_key.replace('_', ' ')}, by peer",
+                         lambda _key=_key: [({'peer': f"{a[0]}:{a[1]}", 'cc': c.cc.name}, c.stats[_key])
+                                            for a, c in list(connections.items())])
+    else:
+        metrics.callback(f'{_key}_total', f"RUDP {_key.replace('_', ' ')} over all sessions",
+                         lambda _key=_key: retired[_key] + sum(c.stats[_key] for c in list(connections.values())),
+                         'counter')
+
+
+class Session:
+    """Состояние одного клиента в общем цикле сервера: прием команд, текущая машина отправки
+    (ответ или файл) и очередь команд, пришедших, пока она занята"""
+
+    def __init__(self, addr, conn):
+        self.addr = addr
+        self.conn = conn
+        self.receiver = MessageReceiver(conn)
+        self.sender = None
+        self.requests = deque()
+        self.download = None        # (файл, размер, таймер): ждем READY после "OK <size>"
+        self.latency = None         # (команда, начало) для command_latency, пока ответ не подтвержден
+        self.transfer = None        # (размер, начало) идущей передачи файла
+        self.commands = 0
+        self.active = time.monotonic()
+        self.timer = None           # сторож простоя
+        self.send_timer = None      # дедлайн машины отправки на общем колесе
+        self.closed = False
+
+def retire_connection(addr):
+    rudp = connections.pop(addr, None)
+    if rudp is None: return
+    for key in STAT_KEYS:
+        if key not in GAUGE_KEYS:
+            retired[key] += rudp.stats[key]
+
+def close_session(session, reason):
+    if session.closed: return
+    session.closed = True
+    print(f"Client {session.addr} disconnected ({reason}).")
+    for timer in (session.timer, session.send_timer, session.download and session.download[2]):
+        if timer is not None:
+            timer.cancel()
+    if session.sender is not None:
+        session.sender.close()
+    sessions.pop(session.addr, None)
+    retire_connection(session.addr)
+
+def watch_idle(session, now):
+    if idle_timeout:
+        delay = max(idle_timeout - (now - session.active), timers.tick)
+        session.timer = timers.schedule(delay, check_idle, session)
+
+def check_idle(session):
+    now = time.monotonic()
+    # Идущая передача - тоже активность, даже если команд давно не было
+    if session.sender is None and now - session.active >= idle_timeout:
+        sessions_reaped.inc(reason='idle')
+        close_session(session, 'idle timeout')
+    else:
+        watch_idle(session, now)
+
+def start_sender(session, machine, now):
+    session.sender = machine
+    machine.start(now)
+    sender_progress(session, now)
+
+def sender_progress(session, now):
+    """После каждого события машины отправки: переставить ее таймер или закончить"""
+    machine = session.sender
+    if not machine.done:
+        delay = max(machine.deadline - now, 0)
+        if session.send_timer is None:
+            session.send_timer = timers.schedule(delay, sender_timeout, session)
+        else:
+            timers.reschedule(session.send_timer, delay, now)
+        return
+    if session.send_timer is not None:
+        session.send_timer.cancel()
+    session.sender = None
+    if isinstance(machine, BulkSender):
+        size, started = session.transfer
+        session.transfer = None
+        if size and not machine.failed and now > started:
+            transfer_throughput.observe(size / (now - started) / (1024 * 1024), direction='download')
+    elif session.latency is not None:
+        label, started = session.latency
+        command_latency.observe(time.perf_counter() - started, command=label)
+        session.latency = None
+    session.active = time.monotonic()
+    process_requests(session)
+
+def sender_timeout(session):
+    machine = session.sender
+    if machine is None or session.closed: return
+    now = time.monotonic()
+    try:
+        # Колесо срабатывает с точностью до тика, раньше дедлайна не трогаем машину
+        if now >= machine.deadline - 0.001:
+            machine.on_timeout(now)
+        sender_progress(session, now)
+    except ConnectionResetError as e:
+        close_session(session, str(e))
+    except Exception as e:
+        print(f"Server Error: {e}")
+        close_session(session, 'error')
+
+def reply(session, data):
+    start_sender(session, MessageSender(session.conn, data), time.monotonic())
+
+def ready_timeout(session):
+    if session.download is not None:
+        print(f"Client {session.addr} did not confirm the download.")
+        session.download = None
+
+def process_requests(session):
+    while session.sender is None and session.requests and not session.closed:
+        req = session.requests.popleft()
+        session.active = time.monotonic()
+        session.commands += 1
+        if session.download is not None:
+            filename, size, timer = session.download
+            session.download = None
+            timer.cancel()
+            if b'READY' in req:
+                session.transfer = (size, session.active)
+                start_sender(session, BulkSender(session.conn, filename), session.active)
+            continue
+        if not handle_request(session, req):
+            close_session(session, 'EXIT')
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -15,7 +177,7 @@ def get_local_ip():
         s.close()
     return IP
 
-def handle_request(rudp, data):
+def handle_request(session, data):
     try:
         msg = data.decode('utf-8', errors='ignore').strip()
     except: return True
@@ -23,47 +185,159 @@ def handle_request(rudp, data):
     if not msg: return True
     parts = msg.split()
     cmd = parts[0].upper()
+    label = cmd if cmd in COMMANDS else 'UNKNOWN'
+    commands_total.inc(command=label)
+    session.latency = (label, time.perf_counter())
     
     if cmd == 'ECHO':
-        rudp.send_reliable_data((" ".join(parts[1:]) + "\n").encode())
+        reply(session, (" ".join(parts[1:]) + "\n").encode())
         
     elif cmd == 'TIME':
         import datetime
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\n"
-        rudp.send_reliable_data(now.encode())
+        reply(session, now.encode())
         
     elif cmd == 'DOWNLOAD':
-        if len(parts) < 2: return True
+        if len(parts) < 2:
+            session.latency = None
+            return True
         filename = parts[1]
         if not os.path.exists(filename):
-            rudp.send_reliable_data(b"ERROR file not found\n")
+            reply(session, b"ERROR file not found\n")
             return True
-            
         size = os.path.getsize(filename)
-        rudp.send_reliable_data(f"OK {size}\n".encode())
-        
-        confirm = rudp.recv_reliable_data(timeout=10.0)
-        if confirm and b'READY' in confirm:
-            rudp.send_file_bulk(filename)
+        # Сам файл пойдет, когда клиент ответит READY
+        session.download = (filename, size, timers.schedule(READY_TIMEOUT, ready_timeout, session))
+        reply(session, f"OK {size}\n".encode())
         
     elif cmd == 'UPLOAD':
-        rudp.send_reliable_data(b"ERROR Not implemented\n")
+        reply(session, b"ERROR Not implemented\n")
+        
+    elif cmd == 'STATS':
+        reply(session, f"OK {metrics.summary()}\n".encode())
         
     elif cmd in ('EXIT', 'QUIT'):
+        session.latency = None
         return False
     else:
-        rudp.send_reliable_data(b"UNKNOWN COMMAND\n")
+        reply(session, b"UNKNOWN COMMAND\n")
         
     return True
 
+def accept(sock, addr, payload, default_cc, gso=None):
+    # Клиент может попросить алгоритм управления перегрузкой в теле SYN
+    cc = bytes(payload).decode(errors='replace').strip()
+    if cc not in congestion.ALGORITHMS: cc = default_cc
+    print(f"Client connected: {addr} (cc: {cc})")
+    conn = RUDPConnection(sock, addr, cc)
+    conn.stats['recv_calls'] += 1   # сам SYN
+    if gso is not None and conn.enable_gso(gso or None):
+        print(f"GSO: {conn.packet_size}-byte packets, window up to {conn.window}")
+    conn.send_packet(0, TYPE_ACK)
+    session = sessions[addr] = Session(addr, conn)
+    connections[addr] = conn
+    sessions_total.inc()
+    watch_idle(session, session.active)
+
+def dispatch(sock, data, addr, default_cc, gso=None):
+    """Один датаграмм: по адресу отправителя находим сессию и отдаем пакет ее машинам"""
+    session = sessions.get(addr)
+    if session is None:
+        if len(data) < HEADER_SIZE: return
+        type_val = HEADER.unpack_from(data)[1]
+        if type_val == TYPE_SYN:
+            accept(sock, addr, data[HEADER_SIZE:], default_cc, gso)
+        elif type_val == TYPE_DATA:
+            # Команда без сессии (например, ее закрыл сторож простоя): FIN вместо долгих перепосылок
+            try: sock.sendto(HEADER.pack(0, TYPE_FIN), addr)
+            except OSError: pass
+        return
+    # Сокет читает serve, а не соединение: recvfrom_into засчитываем сессии, чья это датаграмма
+    session.conn.stats['recv_calls'] += 1
+    packet = session.conn.parse(data)
+    if packet is None: return
+    seq, type_val, payload = packet
+    now = time.monotonic()
+    try:
+        if type_val == TYPE_SYN:
+            # Повтор рукопожатия, если наш ACK потерялся; после команд - клиент перезапустился
+            if session.commands == 0 and not session.requests:
+                session.conn.send_packet(0, TYPE_ACK)
+            else:
+                close_session(session, 'reconnected')
+                accept(sock, addr, payload, default_cc, gso)
+        elif type_val == TYPE_FIN:
+            close_session(session, 'FIN')
+        elif type_val == TYPE_DATA:
+            req = session.receiver.on_data(seq, payload)
+            if req is not None:
+                # Новую команду клиент шлет, только прочитав ответ целиком: ответ доставлен,
+                # даже если ACK на него потерялся, и перепосылать его уже нельзя
+                if isinstance(session.sender, MessageSender):
+                    session.sender.delivered()
+                    sender_progress(session, now)
+                session.requests.append(req)
+                process_requests(session)
+        elif session.sender is not None:
+            session.sender.on_packet(seq, type_val, payload, now)
+            sender_progress(session, now)
+    except ConnectionResetError as e:
+        close_session(session, str(e))
+    except Exception as e:
+        print(f"Server Error: {e}")
+        close_session(session, 'error')
+
+def serve(sock, default_cc, gso=None):
+    """Один сокет на всех: датаграммы раздаются сессиям по адресу пира, все таймауты
+    (RTO, FIN, READY, простой) живут на общем колесе таймеров. Датаграммы читаются в один
+    буфер, и сессии получают его срезы: все нужное копируется, пока буфер не перезаписан"""
+    buffer = bytearray(RECV_BUFFER)
+    view = memoryview(buffer)
+    while True:
+        readable, _, _ = select.select([sock], [], [], timers.timeout(POLL_INTERVAL))
+        if readable:
+            # Берем пачку датаграмм за раз, но не бесконечно: таймеры тоже должны успевать
+            for _ in range(RECV_BATCH):
+                try:
+                    size, addr = sock.recvfrom_into(buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    continue
+                try:
+                    dispatch(sock, view[:size], addr, default_cc, gso)
+                except Exception as e:
+                    print(f"Server Error: {e}")
+        timers.advance()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="LAB_2 RUDP file server")
+    parser.add_argument('--port', type=int, help="port to listen on (asked interactively when omitted)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve Prometheus metrics on 127.0.0.1:<port>/metrics")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="drop a session after this many seconds without commands (0 = never)")
+    parser.add_argument('--cc', choices=sorted(congestion.ALGORITHMS), default=congestion.DEFAULT,
+                        help="congestion control for clients that do not ask for one in SYN")
+    parser.add_argument('--gso', type=int, nargs='?', const=0, metavar='MTU',
+                        help="Linux: send MTU-sized packets, a window burst per sendmsg via UDP_SEGMENT "
+                             "(MTU of the route to each client unless given)")
+    return parser.parse_args()
+
 def start_server():
+    global idle_timeout
+    args = parse_args()
+    idle_timeout = args.idle_timeout
     default_ip = "0.0.0.0"
     default_port = 9090
     
     print(f"Detected Local IP: {get_local_ip()}")
     
-    port_input = input(f"Enter Port (default {default_port}): ").strip()
-    PORT = int(port_input) if port_input else default_port
+    if args.port is not None:
+        PORT = args.port
+    else:
+        port_input = input(f"Enter Port (default {default_port}): ").strip()
+        PORT = int(port_input) if port_input else default_port
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -78,51 +352,19 @@ def start_server():
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8 * 1024 * 1024)
     except: pass
     
+    if args.metrics_port is not None:
+        start_exporter(metrics, args.metrics_port)
+        print(f"Metrics exported on http://127.0.0.1:{args.metrics_port}/metrics")
+
     print(f"UDP Server listening on {default_ip}:{PORT}")
     
-    while True:
-        try:
-            readable, _, _ = select.select([sock], [], [], 0.5)
-            if readable:
-                try:
-                    data, addr = sock.recvfrom(1024)
-                    if len(data) >= 5:
-                        _, type_val = struct.unpack('!IB', data[:5])
-                        if type_val == TYPE_SYN:
-                            print(f"Client connected: {addr}")
-                            rudp = RUDPConnection(sock, addr)
-                            rudp.send_packet(0, TYPE_ACK)
-                            
-                            while True:
-                                try:
-                                    req = rudp.recv_reliable_data(timeout=300.0)
-                                    
-                                    if rudp.addr != addr:
-                                        print(f"Session hijacked by new client: {rudp.addr}")
-                                        addr = rudp.addr
-                                        if req is None: continue 
-                                        
-                                    if req is None: 
-                                        print("Client idle timeout.")
-                                        break 
-                                    if req == b'':
-                                        print("Client sent FIN.")
-                                        break
-                                        
-                                    if not handle_request(rudp, req): 
-                                        break
-                                except ConnectionResetError:
-                                    break
-                                except Exception:
-                                    break
-                                    
-                            print(f"Client disconnected. Waiting for new...")
-                except OSError: pass
-        except KeyboardInterrupt:
-            print("\nServer shutting down.")
-            break
-        except Exception as e:
-            print(f"Server Error: {e}")
+    try:
+        if args.gso is not None and not offload_support()['gso']:
+            print("UDP GSO is not available here, sending one datagram per packet.")
+            args.gso = None
+        serve(sock, args.cc, args.gso)
+    except KeyboardInterrupt:
+        print("\nServer shutting down.")
             
     sock.close()
 
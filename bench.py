@@ -0,0 +1,453 @@
+import argparse
+import datetime
+import json
+import os
+import select
+import platform
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+LAB_1 = os.path.join(ROOT, 'LAB_1')
+LAB_2 = os.path.join(ROOT, 'LAB_2')
+sys.path.insert(0, LAB_2)
+
+import rudp  # noqa: E402
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    s = socket.socket(socket.AF_INET, kind)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def proc_stat(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        return f.read().rsplit(')', 1)[1].split()
+
+
+def proc_cpu_seconds(pid):
+    """User+system CPU time of a process and its direct children (prefork workers), from /proc (Linux only)."""
+    try:
+        fields = proc_stat(pid)
+    except (OSError, IndexError):
+        return None
+    total = int(fields[11]) + int(fields[12])
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            child = proc_stat(entry)
+            if child[1] == str(pid):
+                total += int(child[11]) + int(child[12])
+        except (OSError, IndexError):
+            continue
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+class Server:
+    def __init__(self, name, argv, stdin_text, workdir):
+        self.name = name
+        self.proc = subprocess.Popen(argv, cwd=workdir, stdin=subprocess.PIPE,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.proc.stdin.write(stdin_text.encode())
+        self.proc.stdin.close()
+
+    def cpu(self):
+        return proc_cpu_seconds(self.proc.pid)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def wait_tcp(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"TCP server on port {port} did not start")
+
+
+class TCPClient:
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = b''
+
+    def read_line(self):
+        while b'\n' not in self.buf:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionResetError()
+            self.buf += data
+        line, self.buf = self.buf.split(b'\n', 1)
+        return line.decode().strip()
+
+    def command(self, line):
+        self.sock.sendall(line.encode() + b'\n')
+        return self.read_line()
+
+    def download(self, name, chunk):
+        resp = self.command(f"DOWNLOAD {name} 0").split()
+        size = int(resp[1])
+        got = len(self.buf)
+        self.buf = b''
+        view = memoryview(bytearray(chunk))
+        while got < size:
+            n = self.sock.recv_into(view, min(chunk, size - got))
+            if not n:
+                raise ConnectionResetError()
+            got += n
+        return got
+
+    def close(self):
+        try:
+            self.sock.sendall(b"EXIT\n")
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class RUDPClient:
+    def __init__(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+        except OSError:
+            pass
+        self.conn = rudp.RUDPConnection(sock, ('127.0.0.1', port))
+        self.conn.enable_gro()
+        for _ in range(20):
+            self.conn.send_packet(0, rudp.TYPE_SYN)
+            time.sleep(0.1)
+            if self.conn._wait_ack_nonblocking() != -1:
+                return
+        raise RuntimeError(f"RUDP server on port {port} did not answer")
+
+    def command(self, line):
+        self.conn.send_reliable_data((line + "\n").encode())
+        resp = self.conn.recv_reliable_data(timeout=5.0)
+        if not resp:
+            raise ConnectionResetError()
+        return resp.decode().strip()
+
+    def download(self, name, chunk):
+        size = int(self.command(f"DOWNLOAD {name}").split()[1])
+        self.conn.send_reliable_data(b"READY\n")
+        self.conn.recv_stream_to_file(os.devnull, size)
+        return size
+
+    def close(self):
+        try:
+            self.conn.send_packet(0, rudp.TYPE_FIN)
+        finally:
+            self.conn.sock.close()
+
+
+def measure_latency(client, samples):
+    times = []
+    for i in range(samples):
+        start = time.perf_counter()
+        client.command(f"ECHO ping {i}")
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'samples': samples,
+        'p50_ms': round(percentile(times, 50), 3),
+        'p90_ms': round(percentile(times, 90), 3),
+        'p99_ms': round(percentile(times, 99), 3),
+        'max_ms': round(max(times), 3),
+    }
+
+
+def measure_throughput(server, make_client, name, size, chunk, concurrency):
+    clients = [make_client() for _ in range(concurrency)]
+    errors = []
+
+    def worker(client):
+        try:
+            client.download(name, chunk)
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+    server_cpu = server.cpu()
+    client_cpu = time.process_time()
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    client_cpu = time.process_time() - client_cpu
+    server_cpu = server.cpu() - server_cpu if server_cpu is not None else None
+    for c in clients:
+        c.close()
+
+    total = size * concurrency
+    gb = total / UNITS['G']
+    return {
+        'bytes': total,
+        'seconds': round(elapsed, 4),
+        'mb_per_s': round(total / UNITS['M'] / elapsed, 2) if elapsed > 0 else None,
+        'server_cpu_s_per_gb': round(server_cpu / gb, 3) if server_cpu is not None else None,
+        'client_cpu_s_per_gb': round(client_cpu / gb, 3),
+        'errors': errors,
+    }
+
+
+UDP_IO_MODES = ('sendto-32K', 'sendto-mtu', 'gso-mtu', 'gso+gro-mtu')
+UDP_IO_BUFFER = 16 * 1024 * 1024
+
+
+def measure_udp_io(mode, path, size, mtu):
+    """Syscall cost of the RUDP datagram path without the protocol: data packets pushed through
+    send_batch/_recv_packets over loopback, packets per call and CPU seconds per GB on each side."""
+    socks = []
+    for _ in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, UDP_IO_BUFFER)
+            except OSError:
+                pass
+        socks.append(sock)
+    sender = rudp.RUDPConnection(socks[0], socks[1].getsockname())
+    receiver = rudp.RUDPConnection(socks[1], socks[0].getsockname())
+    if mode != 'sendto-32K':
+        # MTU-sized packets as enable_gso picks them on a real link; loopback would keep 32K
+        sender.packet_size = mtu - 28 - rudp.HEADER_SIZE
+        sender.gso = mode.startswith('gso') and rudp.offload_support()['gso']
+    if mode == 'gso+gro-mtu':
+        receiver.enable_gro()
+    received = {'cpu': 0.0}
+
+    def receive():
+        cpu = time.thread_time()
+        while select.select([receiver.sock], [], [], 0.2)[0]:
+            receiver._recv_packets()
+        received['cpu'] = time.thread_time() - cpu
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    cpu = time.thread_time()
+    start = time.perf_counter()
+    seq = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = memoryview(f.read(rudp.GSO_MAX_SEGMENTS * sender.packet_size))
+            if not block:
+                break
+            chunks = [block[i:i + sender.packet_size] for i in range(0, len(block), sender.packet_size)]
+            sender.send_batch(seq, chunks)
+            seq += len(chunks)
+    send_cpu = time.thread_time() - cpu
+    elapsed = time.perf_counter() - start
+    thread.join()
+    for sock in socks:
+        sock.close()
+
+    sent, got = sender.stats, receiver.stats
+    return {
+        'mode': mode,
+        'packet_size': sender.packet_size,
+        'bytes': size,
+        'seconds': round(elapsed, 4),
+        'send_packets_per_call': round(sent['packets_sent'] / max(sent['send_calls'], 1), 2),
+        'recv_packets_per_call': round(got['packets_received'] / max(got['recv_calls'], 1), 2),
+        'send_cpu_s_per_gb': round(send_cpu / (sent['bytes_sent'] / UNITS['G']), 3) if sent['bytes_sent'] else None,
+        'recv_cpu_s_per_gb': round(received['cpu'] / (got['bytes_received'] / UNITS['G']), 3) if got['bytes_received'] else None,
+        'delivered': round(got['bytes_received'] / sent['bytes_sent'], 3) if sent['bytes_sent'] else None,
+    }
+
+
+def run_udp_io(args, workdir, files):
+    results = []
+    offload = rudp.offload_support()
+    if not offload['gso']:
+        print("[udpio] kernel has no UDP GSO/GRO, gso modes fall back to one packet per call")
+    for size in args.sizes:
+        for mode in UDP_IO_MODES:
+            row = {'transport': 'udpio', 'kind': 'syscalls', 'size': size,
+                   **measure_udp_io(mode, os.path.join(workdir, files[size]), size, args.mtu)}
+            results.append(row)
+            print(f"[udpio] size={size} {mode} ({row['packet_size']} B): "
+                  f"send {row['send_packets_per_call']} pkts/call {row['send_cpu_s_per_gb']} CPU-s/GB, "
+                  f"recv {row['recv_packets_per_call']} pkts/call {row['recv_cpu_s_per_gb']} CPU-s/GB, "
+                  f"delivered {row['delivered']}")
+    return results
+
+
+def run_transport(transport, args, workdir, files):
+    results = []
+    if transport == 'udpio':
+        return run_udp_io(args, workdir, files)
+    if transport == 'tcp':
+        port = free_port()
+        server = Server('tcp', [sys.executable, os.path.join(LAB_1, 'server.py'), '--port', str(port)]
+                        + shlex.split(args.tcp_args), '', workdir)
+        wait_tcp(port)
+        make_client = lambda: TCPClient(port)
+        chunks = args.chunks
+        levels = args.concurrency
+    else:
+        port = free_port(socket.SOCK_DGRAM)
+        server = Server('rudp', [sys.executable, os.path.join(LAB_2, 'server.py'), '--port', str(port)]
+                        + shlex.split(args.rudp_args), '', workdir)
+        make_client = lambda: RUDPClient(port)
+        chunks = [rudp.PACKET_SIZE]
+        levels = args.concurrency
+
+    try:
+        client = make_client()
+        latency = measure_latency(client, args.latency_samples)
+        client.close()
+        print(f"[{transport}] ECHO latency p50={latency['p50_ms']}ms p99={latency['p99_ms']}ms")
+        results.append({'transport': transport, 'kind': 'latency', **latency})
+
+        for size in args.sizes:
+            for chunk in chunks:
+                for concurrency in levels:
+                    runs = [measure_throughput(server, make_client, files[size], size, chunk, concurrency)
+                            for _ in range(args.repeat)]
+                    best = max(runs, key=lambda r: r['mb_per_s'] or 0)
+                    row = {'transport': transport, 'kind': 'download', 'size': size, 'chunk': chunk,
+                           'concurrency': concurrency, **best}
+                    results.append(row)
+                    print(f"[{transport}] size={size} chunk={chunk} conc={concurrency}: "
+                          f"{row['mb_per_s']} MB/s, server {row['server_cpu_s_per_gb']} CPU-s/GB"
+                          + (f", errors: {row['errors']}" if row['errors'] else ""))
+    finally:
+        server.stop()
+    return results
+
+
+def result_key(row):
+    return (row['transport'], row['kind'], row.get('size'), row.get('chunk'), row.get('concurrency'),
+            row.get('mode'))
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)['results']}
+    regressions = []
+    for row in results:
+        old = baseline.get(result_key(row))
+        if old is None:
+            continue
+        if row['kind'] == 'syscalls':
+            for side in ('send', 'recv'):
+                key = f'{side}_cpu_s_per_gb'
+                if old.get(key) and (row[key] or 0) > old[key] * (1 + threshold):
+                    regressions.append(f"udpio {row['mode']} size={row['size']} {side}: "
+                                       f"{old[key]} -> {row[key]} CPU-s/GB")
+        elif row['kind'] == 'latency':
+            if old['p99_ms'] and row['p99_ms'] > old['p99_ms'] * (1 + threshold):
+                regressions.append(f"{row['transport']} latency p99 {old['p99_ms']} -> {row['p99_ms']} ms")
+        elif old.get('mb_per_s') and (row['mb_per_s'] or 0) < old['mb_per_s'] * (1 - threshold):
+            regressions.append(f"{row['transport']} size={row['size']} chunk={row['chunk']} "
+                               f"conc={row['concurrency']}: {old['mb_per_s']} -> {row['mb_per_s']} MB/s")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark for the LAB_1 (TCP) and LAB_2 (RUDP) servers")
+    parser.add_argument('--transports', default='tcp,rudp',
+                        help="tcp, rudp and udpio (datagram syscall cost of the RUDP path, GSO/GRO vs sendto)")
+    parser.add_argument('--sizes', default='1M,16M,128M', help="file sizes, e.g. 1M,16M,1G")
+    parser.add_argument('--chunks', default='4K,64K,1M', help="client receive sizes for TCP")
+    parser.add_argument('--concurrency', default='1,4,16', help="parallel downloads, one connection each")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per cell, best one is kept")
+    parser.add_argument('--latency-samples', type=int, default=500)
+    parser.add_argument('--tcp-args', default='', help="extra LAB_1 server arguments, e.g. '--workers 4'")
+    parser.add_argument('--rudp-args', default='', help="extra LAB_2 server arguments")
+    parser.add_argument('--mtu', type=int, default=rudp.DEFAULT_MTU, help="datagram size for the udpio MTU modes")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="baseline results file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed relative regression")
+    args = parser.parse_args()
+    args.sizes = [parse_size(x) for x in args.sizes.split(',')]
+    args.chunks = [parse_size(x) for x in args.chunks.split(',')]
+    args.concurrency = [int(x) for x in args.concurrency.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='spoirs-bench-')
+    try:
+        files = {}
+        for size in args.sizes:
+            files[size] = f"bench_{size}.bin"
+            with open(os.path.join(workdir, files[size]), 'wb') as f:
+                left = size
+                while left > 0:
+                    f.write(os.urandom(min(left, UNITS['M'])))
+                    left -= UNITS['M']
+
+        results = []
+        for transport in args.transports.split(','):
+            results.extend(run_transport(transport.strip(), args, workdir, files))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'server_args': {'tcp': args.tcp_args, 'rudp': args.rudp_args},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION: {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+THROUGHPUT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def _short_labels(key):
+    return '[' + ','.join(str(v) for _, v in key) + ']' if key else ''
+
+
+def _number(value):
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry, name, help):
+        self.lock = registry.lock
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            return [(key, ([*state[0]], state[1], state[2])) for key, state in self.values.items()]
+
+
+class Callback(Metric):
+    """Value computed when scraped: fn returns a number or a list of (labels dict, number)."""
+
+    def __init__(self, registry, name, help, kind, fn):
+        super().__init__(registry, name, help)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            return [((), value)]
+        return [(_key(labels), v) for labels, v in value]
+
+
+class Registry:
+    def __init__(self, namespace=''):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(self, name, help))
+
+    def gauge(self, name, help):
+        return self._add(Gauge(self, name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self, name, help, buckets))
+
+    def callback(self, name, help, fn, kind='gauge'):
+        return self._add(Callback(self, name, help, kind, fn))
+
+    def snapshot(self):
+        """JSON-friendly copy of every metric, for shipping to another process."""
+        return [{'name': m.name, 'help': m.help, 'kind': m.kind, 'buckets': list(getattr(m, 'buckets', ())),
+                 'samples': [[[list(pair) for pair in key], value] for key, value in m.samples()]}
+                for m in self.metrics]
+
+    def render(self):
+        return render(self.snapshot(), self.namespace)
+
+    def summary(self):
+        return summary(self.snapshot())
+
+
+def merge(snapshots):
+    """Sum several snapshots of the same registry layout (one per worker process)."""
+    merged = {}
+    for snap in snapshots:
+        for metric in snap:
+            entry = merged.setdefault(metric['name'], dict(metric, samples={}))
+            for key, value in metric['samples']:
+                key = tuple(tuple(pair) for pair in key)
+                old = entry['samples'].get(key)
+                if old is None:
+                    entry['samples'][key] = value
+                elif metric['kind'] == 'histogram':
+                    entry['samples'][key] = [[a + b for a, b in zip(old[0], value[0])], old[1] + value[1], old[2] + value[2]]
+                else:
+                    entry['samples'][key] = old + value
+    return [dict(m, samples=list(m['samples'].items())) for m in merged.values()]
+
+
+def quantile(buckets, state, q):
+    """Upper bound of the bucket holding the q-quantile."""
+    counts, _, total = state
+    rank, seen = q * total, 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= rank and count:
+            return buckets[i] if i < len(buckets) else float('inf')
+    return 0.0
+
+
+def render(snapshot, namespace=''):
+    """Prometheus text exposition format."""
+    lines = []
+    for metric in snapshot:
+        name = f"{namespace}_{metric['name']}" if namespace else metric['name']
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in metric['samples']:
+            key = [tuple(pair) for pair in key]
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_format_labels(key)} {_number(value)}")
+                continue
+            counts, total, count = value
+            seen = 0
+            for bound, n in zip(list(metric['buckets']) + ['+Inf'], counts):
+                seen += n
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {seen}")
+            lines.append(f"{name}_sum{_format_labels(key)} {_number(total)}")
+            lines.append(f"{name}_count{_format_labels(key)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def summary(snapshot):
+    """Single-line key=value form used by the STATS protocol command."""
+    fields = []
+    for metric in snapshot:
+        for key, value in metric['samples']:
+            name = metric['name'] + _short_labels(key)
+            if metric['kind'] != 'histogram':
+                fields.append(f"{name}={_number(value)}")
+                continue
+            fields.append(f"{name}.count={value[2]}")
+            if value[2]:
+                fields.append(f"{name}.p50={_number(quantile(metric['buckets'], value, 0.5))}")
+                fields.append(f"{name}.p99={_number(quantile(metric['buckets'], value, 0.99))}")
+    return ' '.join(fields)
+
+
+class Aggregate:
+    """Render/summary view over snapshots pushed by worker processes."""
+
+    def __init__(self, namespace=''):
+        self.namespace = namespace
+        self.snapshots = {}
+
+    def update(self, source, snapshot):
+        self.snapshots[source] = snapshot
+
+    def drop(self, source):
+        self.snapshots.pop(source, None)
+
+    def snapshot(self):
+        return merge(list(self.snapshots.values()))
+
+    def render(self):
+        return render(self.snapshot(), self.namespace)
+
+    def summary(self):
+        return summary(self.snapshot())
+
+
+def start_exporter(registry, port, host='127.0.0.1'):
+    """Serve registry.render() at http://host:port/metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,119 @@
+import time
+
+TICK = 0.01
+SLOTS = 64
+LEVELS = 4
+
+
+class Timer:
+    __slots__ = ('wheel', 'expires', 'callback', 'args', 'bucket')
+
+    def __init__(self, wheel, callback, args):
+        self.wheel = wheel
+        self.expires = 0
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+    @property
+    def active(self):
+        return self.bucket is not None
+
+    def cancel(self):
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+            self.wheel.count -= 1
+
+
+class TimerWheel:
+    """Hierarchical timing wheel: LEVELS wheels of SLOTS buckets, a bucket on level n spans
+    tick * SLOTS**n seconds. Scheduling and cancelling are O(1); advance() does O(1) work per
+    elapsed tick plus a cascade of one bucket when a lower wheel wraps around.
+
+    With the defaults a timer can be 46 hours away and fires within one 10 ms tick of its deadline.
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current = int((time.monotonic() if now is None else now) / tick)
+        self.count = 0
+        self.fired = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) from advance() once delay seconds have passed; returns the Timer."""
+        timer = Timer(self, callback, args)
+        self.reschedule(timer, delay)
+        return timer
+
+    def reschedule(self, timer, delay, now=None):
+        timer.cancel()
+        now = time.monotonic() if now is None else now
+        timer.expires = max(self.current + 1, -int(-(now + delay) // self.tick))
+        self._place(timer)
+        self.count += 1
+        return timer
+
+    def _place(self, timer):
+        delta = timer.expires - self.current
+        level, span = 0, self.slots
+        while delta >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        bucket = self.wheels[level][(timer.expires // (span // self.slots)) % self.slots]
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def _cascade(self, level):
+        wheel = self.wheels[level]
+        index = (self.current // self.slots ** level) % self.slots
+        moved, wheel[index] = wheel[index], set()
+        for timer in moved:
+            self._place(timer)
+
+    def advance(self, now=None):
+        """Fire every timer that is due; returns how many fired."""
+        target = int((time.monotonic() if now is None else now) / self.tick)
+        fired = 0
+        while self.current < target:
+            if not self.count:
+                self.current = target
+                break
+            self.current += 1
+            level = 1
+            while level < self.levels and self.current % self.slots ** level == 0:
+                level += 1
+            for upper in range(level - 1, 0, -1):
+                self._cascade(upper)
+            index = self.current % self.slots
+            due, self.wheels[0][index] = self.wheels[0][index], set()
+            # Callbacks may cancel or reschedule other timers of this tick: those leave `due`
+            # (and are counted off by cancel), so iterate over a copy and skip them
+            for timer in list(due):
+                if timer.bucket is not due:
+                    continue
+                due.discard(timer)
+                timer.bucket = None
+                self.count -= 1
+                timer.callback(*timer.args)
+                fired += 1
+        self.fired += fired
+        return fired
+
+    def timeout(self, limit, now=None):
+        """Seconds until advance() has something to do, capped at limit (for select timeouts)."""
+        if not self.count:
+            return limit
+        now = time.monotonic() if now is None else now
+        level0 = self.wheels[0]
+        for step in range(1, self.slots + 1):
+            if level0[(self.current + step) % self.slots]:
+                return min(limit, max(0.0, (self.current + step) * self.tick - now))
+        boundary = (self.current // self.slots + 1) * self.slots
+        return min(limit, max(0.0, boundary * self.tick - now))
@@ -6,24 +6,14 @@ rm -f f.zip
 
 echo l_1 
 
-python LAB_1/client.py << EOF
-192.168.84.99
-9090
-download f.zip
-exit
-EOF
+python LAB_1/client.py --host 192.168.84.99 --port 9090 download f.zip
 
 sha256sum f.zip
 rm -f f.zip
 
 echo l_2 
 
-python LAB_2/client.py << EOF
-192.168.84.99
-9091
-download f.zip
-exit
-EOF
+python LAB_2/client.py --host 192.168.84.99 --port 9091 download f.zip
 
 # Calculate and display the SHA256 checksum of the downloaded file
 sha256sum f.zip
\ No newline at end of file
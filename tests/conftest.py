@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The labs are flat directories of modules run as scripts; make them importable the same way
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for path in (ROOT, os.path.join(ROOT, 'LAB_1'), os.path.join(ROOT, 'LAB_2')):
+    sys.path.insert(0, path)
@@ -0,0 +1,67 @@
+import bz2
+import lzma
+import os
+import zlib
+
+import pytest
+
+from compression import (CODECS, FRAME, FRAME_RAW, FRAME_COMPRESSED, BLOCK_SIZE, encode_block, decode_payload,
+                         split_option, choose, option)
+
+
+def unframe(frame):
+    kind, wire, logical = FRAME.unpack_from(frame)
+    assert wire == len(frame) - FRAME.size
+    return kind, frame[FRAME.size:], logical
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_round_trip(codec):
+    text = b'hello world line\n' * 10000
+    kind, payload, logical = unframe(encode_block(codec, text))
+    assert kind == FRAME_COMPRESSED
+    assert len(payload) < len(text)
+    assert decode_payload(codec, kind, payload, logical) == text
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_incompressible_block_goes_raw(codec):
+    data = os.urandom(BLOCK_SIZE)
+    kind, payload, logical = unframe(encode_block(codec, data))
+    assert kind == FRAME_RAW
+    assert decode_payload(codec, kind, payload, logical) == data
+
+
+@pytest.mark.parametrize('codec, compress', [('zlib', zlib.compress), ('lzma', lzma.compress),
+                                             ('bz2', bz2.compress)])
+def test_rejects_frame_inflating_past_logical_length(codec, compress):
+    bomb = compress(b'\0' * (4 * BLOCK_SIZE))
+    with pytest.raises(ValueError):
+        decode_payload(codec, FRAME_COMPRESSED, bomb, 1000)
+
+
+def test_rejects_bad_frames():
+    packed = zlib.compress(b'abc')
+    with pytest.raises(ValueError):
+        decode_payload('zlib', FRAME_COMPRESSED, packed + b'junk', 3)
+    with pytest.raises(ValueError):
+        decode_payload('zlib', FRAME_COMPRESSED, packed[:-2], 3)
+    with pytest.raises(ValueError):
+        decode_payload('zlib', FRAME_COMPRESSED, b'not zlib', 3)
+    with pytest.raises(ValueError):
+        decode_payload('zlib', FRAME_COMPRESSED, packed, 4)
+    with pytest.raises(ValueError):
+        decode_payload('zlib', FRAME_RAW, b'abc', 2)
+    with pytest.raises(ValueError):
+        decode_payload('zlib', FRAME_RAW, b'', BLOCK_SIZE + 1)
+    with pytest.raises(ValueError):
+        decode_payload('zlib', 7, b'abc', 3)
+
+
+def test_option_negotiation():
+    assert split_option(['DOWNLOAD', 'f', 'z=LZMA,zlib']) == (['DOWNLOAD', 'f'], ['lzma', 'zlib'])
+    assert split_option(['DOWNLOAD', 'f']) == (['DOWNLOAD', 'f'], [])
+    assert choose(['brotli', 'bz2', 'zlib']) == 'bz2'
+    assert choose(['brotli']) is None
+    assert option('zlib') == ' Z=zlib'
+    assert option(None) == ''
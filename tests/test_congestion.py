@@ -0,0 +1,91 @@
+import pytest
+
+import congestion
+from congestion import Controller, Reno, Ledbat, INITIAL_WINDOW, MIN_WINDOW, LOSS_WINDOW, LEDBAT_TARGET
+
+
+def test_create_by_name():
+    assert isinstance(congestion.create('reno', 64), Reno)
+    assert isinstance(congestion.create('ledbat', 64), Ledbat)
+    with pytest.raises(ValueError):
+        congestion.create('cubic', 64)
+
+
+def test_controller_is_abstract():
+    with pytest.raises(TypeError):
+        Controller(64)
+
+
+def test_reno_slow_start_then_additive_increase():
+    cc = Reno(1000)
+    assert cc.window == INITIAL_WINDOW
+    cc.ssthresh = 20
+    cc.on_ack(5, 0.01)
+    assert cc.cwnd == INITIAL_WINDOW + 5
+    cc.on_ack(20, 0.01)
+    assert cc.cwnd == 21     # slow start stops one packet past ssthresh
+    before = cc.cwnd
+    cc.on_ack(int(before), 0.01)
+    assert before < cc.cwnd <= before + 1
+
+
+def test_reno_window_capped_by_max():
+    cc = Reno(16)
+    for _ in range(10):
+        cc.on_ack(16, 0.01)
+    assert cc.window == 16
+
+
+def test_one_reduction_per_window_of_losses():
+    cc = Reno(1000)
+    cc.cwnd = 40.0
+    assert cc.on_loss(seq=100, next_seq=140)
+    assert cc.cwnd == cc.ssthresh == 20
+    # Further losses from the same window are already accounted for
+    assert not cc.on_loss(seq=120, next_seq=150)
+    assert cc.cwnd == 20
+    assert cc.on_loss(seq=145, next_seq=160)
+    assert cc.cwnd == 10
+    assert cc.events == 2
+
+
+def test_timeout_collapses_window():
+    cc = Reno(1000)
+    cc.cwnd = 3.0
+    cc.on_timeout(next_seq=50)
+    assert cc.window == LOSS_WINDOW
+    assert cc.ssthresh == MIN_WINDOW
+    assert not cc.on_loss(seq=49, next_seq=60)
+
+
+def test_ledbat_grows_without_queueing_delay_and_backs_off_above_target():
+    cc = Ledbat(1000)
+    cc.ssthresh = cc.cwnd       # skip slow start
+    now = 0.0
+    cc.on_ack(1, 0.010, now)
+    start = cc.cwnd
+    for _ in range(20):
+        cc.on_ack(1, 0.010, now)
+    assert cc.cwnd > start
+    grown = cc.cwnd
+    for _ in range(20):
+        cc.on_ack(1, 0.010 + 2 * LEDBAT_TARGET, now)
+    assert cc.cwnd < grown
+    assert cc.cwnd >= MIN_WINDOW
+
+
+def test_ledbat_leaves_slow_start_when_queue_builds():
+    cc = Ledbat(1000)
+    cc.on_ack(1, 0.010, 0.0)
+    assert cc.cwnd == INITIAL_WINDOW + 1
+    cc.on_ack(1, 0.010 + LEDBAT_TARGET, 0.0)
+    assert cc.ssthresh <= INITIAL_WINDOW + 1
+
+
+def test_ledbat_base_delay_forgets_old_minutes():
+    cc = Ledbat(1000)
+    assert cc.base_delay(0.005, 0.0) == 0.005
+    assert cc.base_delay(0.050, 30.0) == 0.005
+    for minute in range(1, congestion.BASE_HISTORY + 1):
+        cc.base_delay(0.050, minute * congestion.BASE_INTERVAL)
+    assert cc.base_delay(0.050, (congestion.BASE_HISTORY + 1) * congestion.BASE_INTERVAL) == 0.050
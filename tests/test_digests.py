@@ -0,0 +1,58 @@
+import os
+
+from digests import DigestIndex, block_digests, mismatched_ranges, clamp_block_size, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def test_block_digests_cover_partial_last_block(tmp_path):
+    path = write(tmp_path / 'f', os.urandom(2500))
+    digests = block_digests(path, 1000)
+    assert len(digests) == 3
+    assert len(set(digests)) == 3
+    assert block_digests(write(tmp_path / 'empty', b''), 1000) == []
+
+
+def test_mismatched_ranges_merges_neighbours_and_clips_to_size():
+    want = [b'a', b'b', b'c', b'd', b'e']
+    have = [b'a', b'x', b'y', b'd']
+    assert mismatched_ranges(have, want, 10, 45) == [[10, 30], [40, 45]]
+    assert mismatched_ranges(want, want, 10, 45) == []
+    assert mismatched_ranges([], want[:2], 10, 15) == [[0, 15]]
+
+
+def test_clamp_block_size():
+    assert clamp_block_size(1) == MIN_BLOCK_SIZE
+    assert clamp_block_size(1 << 40) == MAX_BLOCK_SIZE
+
+
+def test_index_follows_file_changes(tmp_path):
+    index = DigestIndex(str(tmp_path / 'index'))
+    path = write(tmp_path / 'f', b'a' * 3000)
+    size, digests = index.get(path, 1000)
+    assert (size, digests) == (3000, block_digests(path, 1000))
+    write(path, b'a' * 2000 + b'b' * 1500)
+    size, digests = index.get(path, 1000)
+    assert size == 3500
+    assert digests == block_digests(path, 1000)
+
+
+def test_index_survives_restart(tmp_path):
+    path = write(tmp_path / 'f', os.urandom(5000))
+    expected = DigestIndex(str(tmp_path / 'index')).get(path, 1000)
+    assert DigestIndex(str(tmp_path / 'index')).get(path, 1000) == expected
+
+
+def test_index_keeps_only_recent_entries_in_memory(tmp_path):
+    index = DigestIndex(str(tmp_path / 'index'), max_entries=2)
+    paths = [write(tmp_path / f'f{i}', os.urandom(100)) for i in range(4)]
+    for path in paths:
+        index.get(path, 1000)
+    index.get(paths[2], 1000)
+    assert [key[0] for key in index.entries] == [os.path.abspath(p) for p in (paths[3], paths[2])]
+    # Evicted entries come back from disk
+    assert index.get(paths[0], 1000) == (100, block_digests(paths[0], 1000))
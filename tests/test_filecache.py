@@ -0,0 +1,66 @@
+import os
+
+from filecache import FileCache
+
+
+def make_files(tmp_path, count, size):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f'f{i}'
+        path.write_bytes(os.urandom(size))
+        paths.append(str(path))
+    return paths
+
+
+def test_hits_and_shared_entry(tmp_path):
+    cache = FileCache()
+    path, = make_files(tmp_path, 1, 1000)
+    first = cache.acquire(path)
+    second = cache.acquire(path)
+    assert first is second
+    assert bytes(first.view[:10]) == open(path, 'rb').read(10)
+    first.close()
+    second.close()
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    cache.clear()
+
+
+def test_budget_counts_only_mapped_files(tmp_path):
+    cache = FileCache(budget=2500)
+    paths = make_files(tmp_path, 4, 1000)
+    for path in paths:
+        cache.acquire(path).close()
+    # Opened for sendfile only: nothing mapped, nothing evicted
+    assert cache.stats()['mapped_bytes'] == 0
+    assert cache.stats()['entries'] == 4
+    for path in paths:
+        entry = cache.acquire(path)
+        entry.view
+        entry.close()
+    stats = cache.stats()
+    assert stats['mapped_bytes'] == 2000
+    assert stats['entries'] == 2
+    assert stats['evictions'] == 2
+    cache.clear()
+    assert cache.stats()['mapped_bytes'] == 0
+
+
+def test_entry_count_is_capped(tmp_path):
+    cache = FileCache(max_entries=2)
+    for path in make_files(tmp_path, 5, 10):
+        cache.acquire(path).close()
+    assert cache.stats()['entries'] == 2
+    cache.clear()
+
+
+def test_changed_file_is_reopened(tmp_path):
+    cache = FileCache(revalidate=0)
+    path, = make_files(tmp_path, 1, 100)
+    old = cache.acquire(path)
+    old.close()
+    with open(path, 'ab') as f:
+        f.write(b'more')
+    new = cache.acquire(path)
+    assert new is not old and new.size == 104
+    new.close()
+    cache.clear()
@@ -0,0 +1,51 @@
+from rudp import (RTTEstimator, build_sack, parse_sack, INITIAL_RTO, MIN_RTO, MAX_RTO, MAX_RWND,
+                  SACK_FMT)
+
+
+def test_sack_round_trip():
+    received = {12, 13, 20, 31}
+    payload = build_sack(10, received, 48)
+    assert len(payload) == SACK_FMT.size + 3
+    assert parse_sack(0, payload) == (10, received, 48)
+
+
+def test_cumulative_ack_without_holes():
+    payload = build_sack(7, set(), 100)
+    assert parse_sack(0, payload) == (7, set(), 100)
+    # An empty payload is a plain cumulative ACK for seq, without a window
+    assert parse_sack(41, b'') == (42, set(), None)
+
+
+def test_sack_window_is_clamped():
+    assert parse_sack(0, build_sack(0, set(), 10 ** 6))[2] == MAX_RWND
+
+
+def test_rto_follows_rfc6298():
+    rtt = RTTEstimator()
+    assert rtt.timeout() == INITIAL_RTO
+    rtt.sample(0.1)
+    assert rtt.srtt == 0.1
+    assert rtt.rttvar == 0.05
+    assert abs(rtt.timeout() - 0.3) < 1e-9
+    rtt.sample(0.2)
+    assert abs(rtt.srtt - 0.1125) < 1e-9
+    assert abs(rtt.rttvar - 0.0625) < 1e-9
+
+
+def test_rto_bounds_and_backoff():
+    rtt = RTTEstimator()
+    rtt.sample(0.0001)
+    assert rtt.timeout() == MIN_RTO
+    base = rtt.timeout()
+    rtt.expired()
+    rtt.expired()
+    assert rtt.timeout() == 4 * base
+    for _ in range(20):
+        rtt.expired()
+    assert rtt.timeout() == 64 * base   # the backoff stops doubling at 64
+    rtt.sample(0.0001)
+    assert rtt.timeout() == base
+    rtt.sample(1.0)
+    rtt.expired()
+    rtt.expired()
+    assert rtt.timeout() == MAX_RTO
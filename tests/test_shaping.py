@@ -0,0 +1,49 @@
+from shaping import Scheduler, TokenBucket, MIN_GRANT
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(1000000)
+    bucket.stamp = 0.0
+    bucket.tokens = 0
+    assert bucket.available(0.01) == 10000
+    bucket.consume(10000)
+    assert abs(bucket.delay(5000, 0.01) - 0.005) < 1e-9
+
+
+def test_unlimited_scheduler_grants_everything():
+    scheduler = Scheduler()
+    scheduler.start('a', '10.0.0.1', 'send')
+    assert scheduler.grant('a', 1 << 30) == (1 << 30, 0.0)
+
+
+def test_fair_share_between_clients_and_weights():
+    scheduler = Scheduler(rate=3000000, weights={'10.0.0.2': 2})
+    a = scheduler.start('a', '10.0.0.1', 'send')
+    b = scheduler.start('b', '10.0.0.2', 'send')
+    assert a.bucket.rate == 1000000
+    assert b.bucket.rate == 2000000
+    scheduler.stop('b')
+    assert a.bucket.rate == 3000000
+
+
+def test_global_rate_is_shared_with_other_workers():
+    scheduler = Scheduler(rate=2000000)
+    flow = scheduler.start('a', '10.0.0.1', 'send')
+    assert scheduler.buckets['send'].rate == 2000000
+    scheduler.set_peers('send', 3)
+    assert scheduler.share('send') == 500000
+    assert scheduler.buckets['send'].rate == 500000
+    assert flow.bucket.rate == 500000
+    scheduler.set_peers('send', 0)
+    assert flow.bucket.rate == 2000000
+    assert scheduler.buckets['recv'].rate == 2000000
+
+
+def test_grant_waits_when_bucket_is_empty():
+    scheduler = Scheduler(client_rate=1000000)
+    scheduler.start('a', '10.0.0.1', 'recv')
+    allowed, delay = scheduler.grant('a', 1 << 20, now=0.0)
+    scheduler.consume('a', allowed)
+    allowed, delay = scheduler.grant('a', 1 << 20, now=0.0)
+    assert allowed == 0
+    assert delay >= MIN_GRANT / 1000000 / 2
@@ -0,0 +1,97 @@
+from common.timerwheel import TimerWheel, Timer, TICK
+
+
+def schedule(wheel, delay, callback, *args):
+    return wheel.reschedule(Timer(wheel, callback, args), delay, now=0)
+
+
+def test_fires_once_due_and_not_before():
+    wheel = TimerWheel(now=0)
+    fired = []
+    schedule(wheel, 0.05, fired.append, 'a')
+    assert wheel.advance(now=0.05 - TICK) == 0
+    # Deadlines round up to the next tick: a timer fires within one tick after it
+    assert wheel.advance(now=0.05 + TICK) == 1
+    assert fired == ['a']
+    assert len(wheel) == 0
+
+
+def test_cascades_from_upper_levels():
+    wheel = TimerWheel(now=0)
+    fired = []
+    # Past one turn of level 0 (0.64 s) and of level 1 (40.96 s)
+    schedule(wheel, 1.0, fired.append, 'near')
+    schedule(wheel, 50.0, fired.append, 'far')
+    wheel.advance(now=1.0 - TICK)
+    assert fired == []
+    wheel.advance(now=1.0 + TICK)
+    assert fired == ['near']
+    wheel.advance(now=50.0 - TICK)
+    assert fired == ['near']
+    wheel.advance(now=50.0 + TICK)
+    assert fired == ['near', 'far']
+    assert len(wheel) == 0
+
+
+def test_cancel_and_reschedule():
+    wheel = TimerWheel(now=0)
+    fired = []
+    timer = schedule(wheel, 0.1, fired.append, 'x')
+    timer.cancel()
+    timer.cancel()
+    assert not timer.active
+    assert len(wheel) == 0
+    wheel.reschedule(timer, 0.3, now=0)
+    wheel.reschedule(timer, 0.2, now=0)
+    assert len(wheel) == 1
+    wheel.advance(now=0.2 + TICK)
+    assert fired == ['x']
+    assert wheel.advance(now=1.0) == 0
+
+
+def test_callback_cancels_timer_due_in_same_tick():
+    wheel = TimerWheel(now=0)
+    fired = []
+    timers = {}
+
+    def fire(name, other):
+        fired.append(name)
+        timers[other].cancel()
+
+    timers['a'] = schedule(wheel, 0.05, fire, 'a', 'b')
+    timers['b'] = schedule(wheel, 0.05, fire, 'b', 'a')
+    schedule(wheel, 5.0, fired.append, 'later')
+    assert wheel.advance(now=0.1) == 1
+    assert len(fired) == 1
+    assert not timers['a'].active and not timers['b'].active
+    assert len(wheel) == 1
+    wheel.advance(now=5.0 + TICK)
+    assert fired[-1] == 'later'
+    assert len(wheel) == 0
+
+
+def test_callback_reschedules_timer_due_in_same_tick():
+    wheel = TimerWheel(now=0)
+    fired = []
+    timers = {}
+
+    def push(name, other):
+        fired.append(name)
+        if timers[other].active:
+            wheel.reschedule(timers[other], 1.0, now=0.06)
+
+    timers['a'] = schedule(wheel, 0.05, push, 'a', 'b')
+    timers['b'] = schedule(wheel, 0.05, push, 'b', 'a')
+    assert wheel.advance(now=0.06) == 1
+    assert len(wheel) == 1
+    assert wheel.advance(now=1.07) == 1
+    assert len(wheel) == 0
+    assert sorted(fired) == ['a', 'b']
+
+
+def test_timeout_points_at_next_due_tick():
+    wheel = TimerWheel(now=0)
+    assert wheel.timeout(0.5, now=0) == 0.5
+    schedule(wheel, 0.03, lambda: None)
+    assert 0.03 <= wheel.timeout(0.5, now=0) <= 0.03 + TICK
+    assert wheel.timeout(0.01, now=0) == 0.01